@@ -0,0 +1,182 @@
+"""Starts a whole PyHDFS cluster on ephemeral localhost ports for benchmarks.
+
+Every service runs as a subprocess of the real entry point with its working directory
+(DataNode blocks, the metadata database, logs) under one temporary directory, and reads
+a generated config.ini through PYHDFS_CONFIG.
+
+    with LocalCluster(data_nodes=3, block_size=4 * 1024 * 1024) as cluster, cluster.client() as client:
+        ...
+"""
+
+import configparser
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import rpyc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'data_service'))
+
+from block_transfer import BlockTransferConnection  # noqa: E402
+from client import FilesystemClient  # noqa: E402
+from connection_pool import ConnectionPool  # noqa: E402
+
+
+def port_is_free(port):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        try:
+            sock.bind(('localhost', port))
+        except OSError:
+            return False
+        return True
+
+
+def free_ports(count):
+    """count distinct ports the kernel hands out as ephemeral, all held open at once"""
+    sockets = []
+    try:
+        for _ in range(count):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.bind(('localhost', 0))
+            sockets.append(sock)
+        return [sock.getsockname()[1] for sock in sockets]
+    finally:
+        for sock in sockets:
+            sock.close()
+
+
+def wait_for_port(port, timeout=15):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"nothing listening on port {port} after {timeout}s")
+
+
+class LocalCluster:
+    def __init__(self, data_nodes=3, block_size=4 * 1024 * 1024, replication_factor=2, keep_dir=False,
+                 metadata_shards=1, storage_engine='file'):
+        self.data_node_count = data_nodes
+        self.storage_engine = storage_engine
+        self.metadata_shards = metadata_shards
+        self.block_size = block_size
+        self.replication_factor = replication_factor
+        self.keep_dir = keep_dir
+        self.dir = None
+        self.processes = []
+
+    def allocate_ports(self):
+        ports = free_ports(2 + self.metadata_shards + self.data_node_count)
+        zk_port, name_node_port = ports[:2]
+        metadata_ports = ports[2:2 + self.metadata_shards]
+        data_node_ports = ports[2 + self.metadata_shards:]
+        # the transfer port of every data node is its rpyc port + one shared offset
+        for _ in range(100):
+            offset = random.randint(1000, 20000)
+            if all(port + offset < 65536 and port_is_free(port + offset) for port in data_node_ports):
+                return zk_port, metadata_ports, name_node_port, data_node_ports, offset
+        raise RuntimeError("no free transfer port offset found")
+
+    def write_config(self):
+        zk_port, metadata_ports, name_node_port, data_node_ports, offset = self.allocate_ports()
+        config = configparser.ConfigParser()
+        config['name_node'] = {'block_size': self.block_size, 'replication_factor': self.replication_factor,
+                               'name_name_hosts': f"localhost:{name_node_port}"}
+        config['client'] = {'max_in_flight_blocks': 4, 'max_block_retries': 2, 'read_ahead_blocks': 4}
+        config['connection_pool'] = {'max_per_host': 64, 'idle_timeout': 60, 'health_check_after': 5}
+        config['data_node'] = {'transfer_port_offset': offset, 'heartbeat_interval': 1,
+                               'storage_engine': self.storage_engine,
+                               'data_node_hosts': ','.join(f"localhost:{port}" for port in data_node_ports)}
+        config['metadata'] = {'metadata_hosts': ','.join(f"localhost:{port}" for port in metadata_ports)}
+        config['zookeeper'] = {'zookeeper_hosts': f"localhost:{zk_port}"}
+        self.config_path = os.path.join(self.dir, 'config.ini')
+        with open(self.config_path, 'w') as f:
+            config.write(f)
+        self.config = config
+        self.ports = {'zookeeper': zk_port, 'metadata': metadata_ports[0], 'metadata_shards': metadata_ports,
+                      'name_node': name_node_port,
+                      'data_nodes': data_node_ports, 'transfer_port_offset': offset}
+
+    def spawn(self, name, script, *args):
+        work_dir = os.path.join(self.dir, name)
+        os.makedirs(work_dir, exist_ok=True)
+        log = open(os.path.join(self.dir, f"{name}.log"), 'wb')
+        env = dict(os.environ, PYHDFS_CONFIG=self.config_path, PYTHONUNBUFFERED='1')
+        process = subprocess.Popen([sys.executable, os.path.join(ROOT, script), *map(str, args)],
+                                   cwd=work_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        self.processes.append((process, log))
+        return process
+
+    def start(self):
+        self.dir = tempfile.mkdtemp(prefix='pyhdfs-bench-')
+        self.write_config()
+        try:
+            self.spawn('zookeeper', 'zookeeper/zk.py', self.ports['zookeeper'])
+            for index, port in enumerate(self.ports['metadata_shards']):
+                # every shard keeps its database in its own working directory
+                self.spawn('metadata' if index == 0 else f"metadata_{port}", 'metadata_serivce/metadata.py', port)
+            wait_for_port(self.ports['zookeeper'])
+            for port in self.ports['metadata_shards']:
+                wait_for_port(port)
+            for index, port in enumerate(self.ports['data_nodes']):
+                self.spawn(f"data_node_{port}", 'data_service/data_node.py', index)
+            for port in self.ports['data_nodes']:
+                wait_for_port(port)
+                wait_for_port(port + self.ports['transfer_port_offset'])
+            self.spawn('name_node', 'data_service/name_node.py')
+            wait_for_port(self.ports['name_node'])
+            self.wait_for_data_nodes()
+        except BaseException:
+            self.stop()
+            raise
+        return self
+
+    def wait_for_data_nodes(self, timeout=15):
+        """until the NameNode's watch has seen every data node"""
+        deadline = time.time() + timeout
+        conn = rpyc.connect('localhost', self.ports['name_node'])
+        try:
+            while time.time() < deadline:
+                if len(conn.root.NameNodeService().live_data_nodes()) == self.data_node_count:
+                    return
+                time.sleep(0.05)
+        finally:
+            conn.close()
+        raise TimeoutError(f"the NameNode did not see {self.data_node_count} data nodes after {timeout}s")
+
+    def client(self, **kwargs):
+        pool_size = kwargs.pop('pool_size', 64)
+        return FilesystemClient(
+            self.block_size, transfer_port_offset=self.ports['transfer_port_offset'],
+            pool=ConnectionPool(max_per_host=pool_size),
+            transfer_pool=ConnectionPool(max_per_host=pool_size, connect=BlockTransferConnection),
+            name_node=('localhost', self.ports['name_node']), **kwargs)
+
+    def stop(self):
+        for process, _ in self.processes:
+            process.terminate()
+        for process, log in self.processes:
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+            log.close()
+        self.processes = []
+        if self.dir and not self.keep_dir:
+            shutil.rmtree(self.dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
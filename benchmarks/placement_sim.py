@@ -0,0 +1,109 @@
+"""Simulates block placement on 10-1000 data nodes without starting any service.
+
+For every cluster size it reports, as JSON:
+    load_ratio_max/min  blocks stored by a node / blocks expected from its free space share
+    load_cv             coefficient of variation of those ratios (0 is a perfect spread)
+    rack_conflicts      blocks whose copies share a rack although enough racks exist
+    moved_on_add        share of primaries that move when one node joins (ideal 1/(N+1))
+    moved_on_remove     share of primaries that move when one node leaves (ideal 1/N)
+    select_us           mean time of one placement decision
+
+    python3 benchmarks/placement_sim.py --nodes 10,100,1000 --blocks 50000
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_service'))
+
+from placement import PlacementRing  # noqa: E402
+
+TB = 1024 ** 4
+
+
+def simulated_nodes(count, seed):
+    rng = random.Random(seed)
+    racks = max(2, count // 10)
+    nodes = {}
+    for i in range(count):
+        capacity = rng.choice((4, 8, 12)) * TB
+        nodes[(f"10.0.{i // 250}.{i % 250}", 1801 + i % 2)] = {
+            'capacity': capacity, 'used': int(capacity * rng.uniform(0, 0.5)), 'rack': f"/rack-{i % racks}"}
+    return nodes
+
+
+def place(ring, block_ids, copies):
+    return {block_id: ring.select(block_id, copies) for block_id in block_ids}
+
+
+def moved(before, after):
+    return sum(before[block_id][0] != after[block_id][0] for block_id in before) / len(before)
+
+
+def simulate(count, blocks, copies, vnodes, seed):
+    nodes = simulated_nodes(count, seed)
+    ring = PlacementRing(vnodes=vnodes)
+    ring.update(nodes)
+    block_ids = [f"block-{seed}-{i}" for i in range(blocks)]
+
+    start = time.perf_counter()
+    placement = place(ring, block_ids, copies)
+    select_us = (time.perf_counter() - start) / blocks * 1e6
+
+    stored = dict.fromkeys(nodes, 0)
+    rack_count = len({data['rack'] for data in nodes.values()})
+    rack_conflicts = 0
+    for data_nodes in placement.values():
+        for data_node in data_nodes:
+            stored[data_node] += 1
+        if len({nodes[data_node]['rack'] for data_node in data_nodes}) < min(len(data_nodes), rack_count):
+            rack_conflicts += 1
+    free = {node: data['capacity'] - data['used'] for node, data in nodes.items()}
+    total_free = sum(free.values())
+    ratios = [stored[node] / (blocks * copies * free[node] / total_free) for node in nodes]
+
+    grown = dict(nodes)
+    grown[('10.1.0.1', 1801)] = {'capacity': 8 * TB, 'used': 2 * TB, 'rack': '/rack-0'}
+    grown_ring = PlacementRing(vnodes=vnodes, reference_bytes=ring.reference_bytes)
+    grown_ring.update(grown)
+    shrunk = dict(nodes)
+    shrunk.pop(next(iter(nodes)))
+    shrunk_ring = PlacementRing(vnodes=vnodes, reference_bytes=ring.reference_bytes)
+    shrunk_ring.update(shrunk)
+
+    return {
+        'nodes': count,
+        'blocks': blocks,
+        'copies': copies,
+        'load_ratio_max': round(max(ratios), 3),
+        'load_ratio_min': round(min(ratios), 3),
+        'load_cv': round(statistics.pstdev(ratios) / statistics.mean(ratios), 3),
+        'rack_conflicts': rack_conflicts,
+        'moved_on_add': round(moved(placement, place(grown_ring, block_ids, 1)), 4),
+        'ideal_moved_on_add': round(1 / (count + 1), 4),
+        'moved_on_remove': round(moved(placement, place(shrunk_ring, block_ids, 1)), 4),
+        'ideal_moved_on_remove': round(1 / count, 4),
+        'select_us': round(select_us, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nodes', default='10,100,1000', help='comma separated cluster sizes')
+    parser.add_argument('--blocks', type=int, default=50000)
+    parser.add_argument('--copies', type=int, default=3)
+    parser.add_argument('--vnodes', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    results = [simulate(int(count), args.blocks, args.copies, args.vnodes, args.seed)
+               for count in args.nodes.split(',')]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
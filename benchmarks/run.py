@@ -0,0 +1,153 @@
+"""Throughput and latency suite over a LocalCluster.
+
+Starts one cluster per (block size, replication factor) and runs put, get and range read
+workloads for every file size and client concurrency. Each result reports MB/s, ops/s and
+p50/p99 latency. Results are printed as JSON; --baseline compares them against an earlier
+run and exits with 1 if any workload got slower than --tolerance allows.
+
+    python3 -m benchmarks.run --block-sizes 1048576,4194304 --file-sizes 1048576,16777216 \\
+        --replication 1,2 --concurrency 1,4 --output results.json
+    python3 -m benchmarks.run ... --baseline results.json
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.cluster import LocalCluster
+
+KEY_FIELDS = ('workload', 'block_size', 'replication', 'file_size', 'concurrency')
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def measure(operation, ops, concurrency):
+    """runs operation(i) for i in range(ops) on concurrency threads
+       returns (elapsed seconds, latencies, bytes moved)
+    """
+    def timed(i):
+        start = time.perf_counter()
+        moved = operation(i)
+        return time.perf_counter() - start, moved
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, range(ops)))
+    return time.perf_counter() - start, [latency for latency, _ in results], sum(moved for _, moved in results)
+
+
+def summary(workload, params, elapsed, latencies, moved):
+    return dict(params, workload=workload, ops=len(latencies), bytes=moved, seconds=round(elapsed, 4),
+                mb_s=round(moved / elapsed / 1024 ** 2, 2), ops_s=round(len(latencies) / elapsed, 2),
+                p50_ms=round(percentile(latencies, 0.5) * 1000, 2),
+                p99_ms=round(percentile(latencies, 0.99) * 1000, 2))
+
+
+def run_workloads(cluster, file_size, concurrency, ops, range_length, seed):
+    params = {'block_size': cluster.block_size, 'replication': cluster.replication_factor,
+              'file_size': file_size, 'concurrency': concurrency}
+    with cluster.client() as client:
+        local_path = os.path.join(cluster.dir, f"input-{file_size}")
+        with open(local_path, 'wb') as f:
+            f.write(os.urandom(file_size))
+        prefix = f"/bench/{file_size}/{concurrency}"
+        results = []
+
+        def put(i):
+            client.create_file(local_path, f"{prefix}/{i}")
+            return file_size
+
+        results.append(summary('put', params, *measure(put, ops, concurrency)))
+
+        def get(i):
+            return len(client.read_file(f"{prefix}/{i}"))
+
+        results.append(summary('get', params, *measure(get, ops, concurrency)))
+
+        rng = random.Random(seed)
+        length = min(range_length, file_size)
+        offsets = [rng.randrange(0, file_size - length + 1) for _ in range(ops * 4)]
+
+        def read_range(i):
+            return len(client.read_range(f"{prefix}/{i % ops}", offsets[i], length))
+
+        results.append(summary('range', dict(params, range_length=length),
+                               *measure(read_range, len(offsets), concurrency)))
+        return results
+
+
+def compare(results, baseline, tolerance):
+    """returns the regressions of results against baseline, workloads matched on KEY_FIELDS"""
+    previous = {tuple(result[field] for field in KEY_FIELDS): result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get(tuple(result[field] for field in KEY_FIELDS))
+        if before is None:
+            continue
+        if result['mb_s'] < before['mb_s'] * (1 - tolerance):
+            regressions.append(dict(result, metric='mb_s', baseline=before['mb_s']))
+        if result['p99_ms'] > before['p99_ms'] * (1 + tolerance):
+            regressions.append(dict(result, metric='p99_ms', baseline=before['p99_ms']))
+    return regressions
+
+
+def integers(value):
+    return [int(item) for item in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--data-nodes', type=int, default=3)
+    parser.add_argument('--block-sizes', type=integers, default=[1024 * 1024, 4 * 1024 * 1024])
+    parser.add_argument('--replication', type=integers, default=[1, 2])
+    parser.add_argument('--file-sizes', type=integers, default=[256 * 1024, 8 * 1024 * 1024])
+    parser.add_argument('--concurrency', type=integers, default=[1, 4])
+    parser.add_argument('--ops', type=int, default=8, help='files written and read per workload')
+    parser.add_argument('--range-length', type=int, default=64 * 1024)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='also write the results to this file')
+    parser.add_argument('--baseline', help='results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative drop of MB/s or rise of p99 latency')
+    parser.add_argument('--keep', action='store_true', help='keep the cluster directories and logs')
+    parser.add_argument('--storage-engine', default='file', choices=('file', 'log'),
+                        help='block storage engine of the DataNodes')
+    args = parser.parse_args()
+
+    results = []
+    for block_size in args.block_sizes:
+        for replication in args.replication:
+            with LocalCluster(args.data_nodes, block_size, replication, keep_dir=args.keep,
+                              storage_engine=args.storage_engine) as cluster:
+                for file_size in args.file_sizes:
+                    for concurrency in args.concurrency:
+                        results.extend(run_workloads(cluster, file_size, concurrency, args.ops,
+                                                     args.range_length, args.seed))
+                if args.keep:
+                    print(f"cluster directory kept at {cluster.dir}", file=sys.stderr)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression['workload']} " +
+                  ' '.join(f"{field}={regression[field]}" for field in KEY_FIELDS[1:]) +
+                  f" {regression['metric']} {regression[regression['metric']]} vs {regression['baseline']}",
+                  file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""Caches of block bytes keyed by block id.
+
+Block ids are never reused for other bytes (uuids, content hashes, container ids), an
+overwritten file gets new blocks, so a cached block never goes stale and no entry has to be
+invalidated when files change. DataNodes keep a BlockCache of the blocks read through rpyc,
+clients a TieredBlockCache of decompressed blocks: a BlockCache in memory in front of a
+DiskBlockCache in a local directory.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+logger = logging.getLogger('block_cache')
+
+
+class BlockCache:
+    """LRU cache of block_id -> bytes, evicts the least recently used blocks past max_bytes"""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.blocks = OrderedDict()
+        self.total_bytes = 0
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, block_id):
+        with self.lock:
+            data = self.blocks.get(block_id)
+            if data is None:
+                self.counters['misses'] += 1
+                return None
+            self.blocks.move_to_end(block_id)
+            self.counters['hits'] += 1
+            return data
+
+    def put(self, block_id, data):
+        with self.lock:
+            self.remove(block_id)
+            if len(data) > self.max_bytes:
+                return
+            self.blocks[block_id] = data
+            self.total_bytes += len(data)
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.blocks.popitem(last=False)
+                self.total_bytes -= len(evicted)
+                self.counters['evictions'] += 1
+
+    def remove(self, block_id):
+        data = self.blocks.pop(block_id, None)
+        if data is not None:
+            self.total_bytes -= len(data)
+
+    def invalidate(self, block_id):
+        with self.lock:
+            self.remove(block_id)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            lookups = stats['hits'] + stats['misses']
+            stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+            stats['blocks'] = len(self.blocks)
+            stats['bytes'] = self.total_bytes
+            return stats
+
+
+class DiskBlockCache:
+    """LRU cache of block_id -> bytes in files of directory, bounded by max_bytes
+       1) a block is one file named after the SHA-1 of its id, written to a temporary file and
+          renamed so a reader never sees half a block
+       2) the files found at start are ordered by modification time, which every hit refreshes,
+          so the cache keeps its contents and recency across restarts
+    """
+
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.files = OrderedDict()  # file name: size, least recently used first
+        self.total_bytes = 0
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+        os.makedirs(directory, exist_ok=True)
+        entries = []
+        for entry in os.scandir(directory):
+            if entry.name.endswith('.tmp'):
+                os.remove(entry.path)
+            elif entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self.files[name] = size
+            self.total_bytes += size
+        self.evict()
+
+    def file_name(self, block_id):
+        return hashlib.sha1(block_id.encode('utf-8')).hexdigest()
+
+    def get(self, block_id):
+        name = self.file_name(block_id)
+        with self.lock:
+            if name not in self.files:
+                self.counters['misses'] += 1
+                return None
+            self.files.move_to_end(name)
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            # evicted meanwhile
+            with self.lock:
+                self.counters['misses'] += 1
+            return None
+        with self.lock:
+            self.counters['hits'] += 1
+        return data
+
+    def put(self, block_id, data):
+        if len(data) > self.max_bytes:
+            return
+        name = self.file_name(block_id)
+        tmp_path = os.path.join(self.directory, f"{name}.{uuid.uuid4().hex}.tmp")
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, os.path.join(self.directory, name))
+        except OSError as e:
+            logger.warning("Failed to cache block %s on disk: %s", block_id, e)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        with self.lock:
+            self.total_bytes += len(data) - self.files.pop(name, 0)
+            self.files[name] = len(data)
+            self.evict()
+
+    def evict(self):
+        """removes the least recently used files past max_bytes, the caller holds lock"""
+        while self.total_bytes > self.max_bytes:
+            name, size = self.files.popitem(last=False)
+            self.total_bytes -= size
+            self.counters['evictions'] += 1
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            lookups = stats['hits'] + stats['misses']
+            stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+            stats['blocks'] = len(self.files)
+            stats['bytes'] = self.total_bytes
+            return stats
+
+
+class TieredBlockCache:
+    """a memory BlockCache in front of an optional DiskBlockCache, a disk hit is promoted"""
+
+    def __init__(self, memory_bytes=64 * 1024 * 1024, disk_dir=None, disk_bytes=1024 * 1024 * 1024):
+        self.memory = BlockCache(memory_bytes)
+        self.disk = DiskBlockCache(disk_dir, disk_bytes) if disk_dir else None
+
+    def get(self, block_id):
+        data = self.memory.get(block_id)
+        if data is None and self.disk is not None:
+            data = self.disk.get(block_id)
+            if data is not None:
+                self.memory.put(block_id, data)
+        return data
+
+    def put(self, block_id, data):
+        data = bytes(data)
+        self.memory.put(block_id, data)
+        if self.disk is not None:
+            self.disk.put(block_id, data)
+
+    def stats(self):
+        stats = {f"memory_{name}": value for name, value in self.memory.stats().items()}
+        if self.disk is not None:
+            stats.update((f"disk_{name}", value) for name, value in self.disk.stats().items())
+        return stats
+
+
+def block_cache_from_config(config):
+    """builds the TieredBlockCache of the [client] section, None if both tiers are off"""
+    memory_bytes = config.getint('client', 'block_cache_bytes', fallback=256 * 1024 * 1024)
+    disk_dir = os.path.expanduser(config.get('client', 'block_cache_dir', fallback='')) or None
+    if not memory_bytes and not disk_dir:
+        return None
+    return TieredBlockCache(memory_bytes, disk_dir,
+                            config.getint('client', 'block_cache_disk_bytes', fallback=1024 * 1024 * 1024))
@@ -0,0 +1,522 @@
+"""Block storage engines of a DataNode.
+
+FileBlockStore keeps one <block_id>.txt file per block under <destination>/<port>/, the
+layout DataNodes always had. LogBlockStore appends blocks to a few large segment files
+instead and finds them through a persistent index, so millions of blocks cost few inodes,
+sequential writes and a bounded amount of memory:
+
+    segment-<n>.log  records of RECORD_HEADER (magic, key length, data length), the block id
+                     and the block bytes, back to back
+    index.db         SQLite table blocks (block_id, segment, offset, length), offset is the
+                     first byte of the block inside its segment
+
+A writer reserves the whole record in the active segment up front, so concurrent writers
+write their chunks in parallel with pwrite as they arrive from the network. A finished block
+becomes visible once a committer thread fsyncs its segment and inserts its index row: every
+block that finished meanwhile shares that fsync and that transaction (group commit). A block
+whose commit never happened is dead space, like an overwritten or deleted one, and a
+background thread rewrites the live blocks of sealed segments that are mostly dead into the
+active segment and removes them.
+
+Both engines have the same surface, used by DataNodeService and BlockTransferServer:
+
+    writer(block_id, destination, length)  -> writer with write(chunk), commit(), abort()
+    put(block_id, destination, data)
+    read(block_id, source_path, offset=0, length=None)  -> bytes or None
+    open_block(block_id, source_path)  -> (file, offset, length) for sendfile, or None
+    block_file(block_id, source_path)  -> (path, offset, length) for short-circuit reads, or None
+    delete(block_id, source_path)  -> True if the block existed
+    delete_many(((block_id, source_path), ...))  -> number of those that existed
+
+Whole block reads go through a BlockCache, an LRU of block bytes bounded by a byte budget.
+"""
+
+import logging
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+
+from block_cache import BlockCache
+from dedup import CONTENT_PREFIX, is_content_addressed
+from packing import is_container
+
+logger = logging.getLogger('block_store')
+
+RECORD_HEADER = struct.Struct('!4sHQ')
+RECORD_MAGIC = b'PHB1'
+
+
+class BlockStore:
+    """read and put on top of the reads and writers of an engine, root is the directory
+       the engine stores under, the DataNode reports the disk holding it"""
+
+    def __init__(self, cache=None):
+        self.cache = cache if cache is not None else BlockCache()
+
+    def put(self, block_id, destination, data):
+        writer = self.writer(block_id, destination, len(data))
+        try:
+            writer.write(data)
+        except BaseException:
+            writer.abort()
+            raise
+        writer.commit()
+
+    def read(self, block_id, source_path, offset=0, length=None):
+        """the block or its byte range offset:offset+length, None if it is not stored
+           only whole block reads are cached, a range read would evict blocks for a slice
+        """
+        whole = not offset and length is None
+        if whole:
+            data = self.cache.get(block_id)
+            if data is not None:
+                return data
+        data = self.load(block_id, source_path, offset, length)
+        if whole and data is not None:
+            self.cache.put(block_id, data)
+        return data
+
+    def delete_many(self, blocks):
+        """deletes ((block_id, source_path), ...), returns how many of them were stored"""
+        return sum(1 for block_id, source_path in blocks if self.delete(block_id, source_path))
+
+    def stats(self):
+        return {}
+
+    def close(self):
+        pass
+
+
+class FileBlockWriter:
+    def __init__(self, path, on_commit):
+        self.path = path
+        # content addressed blocks can be written by several clients at once
+        self.tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        self.file = open(self.tmp_path, 'wb')
+        self.on_commit = on_commit
+
+    def write(self, chunk):
+        self.file.write(chunk)
+
+    def commit(self):
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+        self.on_commit()
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class FileBlockStore(BlockStore):
+    """one file per block under root"""
+
+    def __init__(self, root, port, cache=None):
+        super().__init__(cache)
+        self.root = root
+        self.port = port
+
+    def block_dir(self, destination, block_id='', create=True):
+        if is_content_addressed(block_id):
+            # shared by every file referencing the block, spread over 256 directories
+            digest = block_id[len(CONTENT_PREFIX):]
+            path = f"{self.root}/content_blocks/{self.port}/{digest[:2]}/"
+        elif is_container(block_id):
+            # packed small files, whatever their destinations
+            path = f"{self.root}/containers/{self.port}/"
+        else:
+            path = f"{self.root}/{destination}/{self.port}/"
+        if create and not os.path.isdir(path):
+            os.makedirs(path, exist_ok=True)
+        return path
+
+    def block_path(self, destination, block_id, create=False):
+        return f"{os.path.join(self.block_dir(destination, block_id, create), block_id)}.txt"
+
+    def writer(self, block_id, destination, length):
+        return FileBlockWriter(self.block_path(destination, block_id, True),
+                               lambda: self.cache.invalidate(block_id))
+
+    def open_block(self, block_id, source_path):
+        try:
+            f = open(self.block_path(source_path, block_id), 'rb')
+        except FileNotFoundError:
+            return None
+        return f, 0, os.fstat(f.fileno()).st_size
+
+    def block_file(self, block_id, source_path):
+        path = self.block_path(source_path, block_id)
+        try:
+            return path, 0, os.path.getsize(path)
+        except FileNotFoundError:
+            return None
+
+    def load(self, block_id, source_path, offset=0, length=None):
+        block = self.open_block(block_id, source_path)
+        if block is None:
+            return None
+        f, _, size = block
+        with f:
+            if not size:
+                return b''
+            end = size if length is None else min(size, offset + length)
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return mm[offset:end]
+
+    def delete(self, block_id, source_path):
+        self.cache.invalidate(block_id)
+        try:
+            os.remove(self.block_path(source_path, block_id))
+        except FileNotFoundError:
+            return False
+        return True
+
+
+class LogBlockWriter:
+    """writes one reserved record of the active segment, see LogBlockStore.reserve"""
+
+    def __init__(self, store, block_id, length):
+        self.store = store
+        self.block_id = block_id
+        self.length = length
+        self.segment, self.fd, self.offset = store.reserve(block_id, length)
+        self.written = 0
+        self.done = False
+
+    def write(self, chunk):
+        if self.written + len(chunk) > self.length:
+            raise ValueError(f"block {self.block_id} is longer than the {self.length} bytes reserved")
+        os.pwrite(self.fd, chunk, self.offset + self.written)
+        self.written += len(chunk)
+
+    def commit(self):
+        if self.written != self.length:
+            self.abort()
+            raise ValueError(f"block {self.block_id} has {self.written} of {self.length} bytes")
+        self.done = True
+        self.store.commit(self.segment, 'INSERT OR REPLACE INTO blocks (block_id, segment, offset, length) '
+                                        'VALUES (?, ?, ?, ?)', (self.block_id, self.segment, self.offset, self.length))
+        self.store.cache.invalidate(self.block_id)
+
+    def abort(self):
+        if not self.done:
+            self.done = True
+            self.store.release(self.segment)
+
+
+class PendingCommit:
+    def __init__(self, segment, statement, params):
+        self.segment = segment
+        self.statement = statement
+        self.params = params
+        self.error = None
+        self.done = threading.Event()
+
+
+class LogBlockStore(BlockStore):
+    """append-only segment files and a persistent index, see the module docstring
+       1) segment_bytes caps a segment, a longer block gets a segment of its own
+       2) with sync False the segments are left to the page cache, a crash may lose blocks
+          acknowledged in the last seconds
+       3) a sealed segment with less than compact_ratio of its bytes live is compacted, the
+          check runs every compact_interval seconds
+       4) max_maps bounds the segments kept mmap'd for reads
+    """
+
+    def __init__(self, directory, cache=None, segment_bytes=256 * 1024 * 1024, sync=True,
+                 compact_ratio=0.5, compact_interval=60, max_maps=256):
+        super().__init__(cache)
+        self.root = self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.sync = sync
+        self.compact_ratio = compact_ratio
+        self.compact_interval = compact_interval
+        self.max_maps = max_maps
+        os.makedirs(directory, exist_ok=True)
+        self.db_file = os.path.join(directory, 'index.db')
+        self.write_lock = threading.Lock()
+        self.local = threading.local()
+        self.write_connection = self.get_connection(check_same_thread=False)
+        with self.write_lock, self.write_connection as conn:
+            conn.executescript('''CREATE TABLE IF NOT EXISTS blocks (
+                                    block_id TEXT PRIMARY KEY,
+                                    segment INTEGER NOT NULL,
+                                    offset INTEGER NOT NULL,
+                                    length INTEGER NOT NULL
+                                  );
+                                  CREATE INDEX IF NOT EXISTS blocks_segment ON blocks (segment);''')
+        self.condition = threading.Condition()
+        self.segments = {}  # segment: bytes reserved in it
+        for name in os.listdir(directory):
+            if name.startswith('segment-') and name.endswith('.log'):
+                segment = int(name[len('segment-'):-len('.log')])
+                self.segments[segment] = os.path.getsize(self.segment_path(segment))
+        self.fds = {}  # segment: fd, of the active segment and the ones with writers left
+        self.writers = Counter()  # segment: writers with a reserved record in it
+        self.maps = OrderedDict()  # segment: mmap, least recently used first
+        self.pending = []
+        self.active = None
+        self.closed = False
+        self.counters = {'commits': 0, 'committed_writes': 0, 'compactions': 0, 'bytes_reclaimed': 0}
+        # records past the last committed block of the newest segment may be torn, new
+        # writes go to a fresh segment and leave them as dead space
+        self.roll()
+        self.committer = threading.Thread(target=self.run_commits, daemon=True)
+        self.committer.start()
+        if compact_interval:
+            threading.Thread(target=self.run_compactions, daemon=True).start()
+
+    def get_connection(self, check_same_thread=True):
+        conn = sqlite3.connect(self.db_file, check_same_thread=check_same_thread)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={'FULL' if self.sync else 'NORMAL'}")
+        return conn
+
+    def read_connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self.get_connection()
+        return conn
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f"segment-{segment:08d}.log")
+
+    def roll(self):
+        """starts a new active segment, the caller holds condition (or is __init__)"""
+        previous = self.active
+        self.active = max(self.segments, default=0) + 1
+        self.segments[self.active] = 0
+        self.fds[self.active] = os.open(self.segment_path(self.active), os.O_RDWR | os.O_CREAT, 0o644)
+        if self.sync:
+            # the new directory entry must survive a crash like the blocks written to it
+            directory = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+        if previous is not None:
+            self.close_sealed(previous)
+
+    def close_sealed(self, segment):
+        if segment != self.active and not self.writers[segment] and segment in self.fds:
+            os.close(self.fds.pop(segment))
+
+    def reserve(self, block_id, length):
+        """room for the record of block_id in the active segment, returns (segment, fd, offset
+           of the block bytes) after writing the record header
+        """
+        key = block_id.encode('utf-8')
+        header = RECORD_HEADER.pack(RECORD_MAGIC, len(key), length) + key
+        size = len(header) + length
+        with self.condition:
+            if self.closed:
+                raise ValueError("block store is closed")
+            if self.segments[self.active] and self.segments[self.active] + size > self.segment_bytes:
+                self.roll()
+            segment, start = self.active, self.segments[self.active]
+            self.segments[segment] += size
+            self.writers[segment] += 1
+            fd = self.fds[segment]
+        try:
+            os.pwrite(fd, header, start)
+        except BaseException:
+            self.release(segment)
+            raise
+        return segment, fd, start + len(header)
+
+    def release(self, segment):
+        with self.condition:
+            self.writers[segment] -= 1
+            if not self.writers[segment]:
+                del self.writers[segment]
+                self.close_sealed(segment)
+
+    def writer(self, block_id, destination, length):
+        return LogBlockWriter(self, block_id, length)
+
+    def commit(self, segment, statement, params):
+        """runs statement once the bytes written to segment are durable, in the next group
+           commit, and releases the writer's reservation
+        """
+        pending = PendingCommit(segment, statement, params)
+        with self.condition:
+            self.pending.append(pending)
+            self.condition.notify_all()
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+
+    def run_commits(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                batch, self.pending = self.pending, []
+                fds = [self.fds[segment] for segment in {pending.segment for pending in batch}]
+            error = None
+            try:
+                if self.sync:
+                    for fd in fds:
+                        os.fsync(fd)
+                with self.write_lock, self.write_connection as conn:
+                    for pending in batch:
+                        conn.execute(pending.statement, pending.params)
+            except Exception as e:
+                logger.error("error occurred at committing %s block(s): %s", len(batch), e)
+                error = e
+            with self.condition:
+                self.counters['commits'] += 1
+                self.counters['committed_writes'] += len(batch)
+            for pending in batch:
+                self.release(pending.segment)
+                pending.error = error
+                pending.done.set()
+
+    def locate(self, block_id):
+        return self.read_connection().execute(
+            "SELECT segment, offset, length FROM blocks WHERE block_id=?", (block_id,)).fetchone()
+
+    def segment_map(self, segment, end):
+        """an mmap of segment covering at least end bytes, remapped while the segment grows"""
+        with self.condition:
+            mm = self.maps.get(segment)
+            if mm is not None and len(mm) >= end:
+                self.maps.move_to_end(segment)
+                return mm
+        with open(self.segment_path(segment), 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with self.condition:
+            self.maps[segment] = mm
+            self.maps.move_to_end(segment)
+            while len(self.maps) > self.max_maps:
+                # not closed, a reader may still slice it, the last reference unmaps it
+                self.maps.popitem(last=False)
+        return mm
+
+    def load(self, block_id, source_path, offset=0, length=None):
+        # a compaction may move the block between the lookup and the read, look it up again
+        for _ in range(3):
+            location = self.locate(block_id)
+            if location is None:
+                return None
+            segment, start, size = location
+            if not size:
+                return b''
+            try:
+                mm = self.segment_map(segment, start + size)
+            except FileNotFoundError:
+                continue
+            end = size if length is None else min(size, offset + length)
+            return mm[start + min(offset, size):start + end]
+        return None
+
+    def open_block(self, block_id, source_path):
+        for _ in range(3):
+            location = self.locate(block_id)
+            if location is None:
+                return None
+            segment, start, size = location
+            try:
+                # an open segment stays readable after a compaction removed it
+                return open(self.segment_path(segment), 'rb'), start, size
+            except FileNotFoundError:
+                continue
+        return None
+
+    def block_file(self, block_id, source_path):
+        location = self.locate(block_id)
+        if location is None:
+            return None
+        segment, start, size = location
+        return self.segment_path(segment), start, size
+
+    def delete(self, block_id, source_path):
+        self.cache.invalidate(block_id)
+        with self.write_lock, self.write_connection as conn:
+            return conn.execute("DELETE FROM blocks WHERE block_id=?", (block_id,)).rowcount > 0
+
+    def delete_many(self, blocks):
+        """one index transaction for the whole batch, compaction reclaims the space"""
+        block_ids = [block_id for block_id, _ in blocks]
+        for block_id in block_ids:
+            self.cache.invalidate(block_id)
+        with self.write_lock, self.write_connection as conn:
+            return conn.executemany("DELETE FROM blocks WHERE block_id=?",
+                                    ((block_id,) for block_id in block_ids)).rowcount
+
+    def run_compactions(self):
+        while not self.closed:
+            time.sleep(self.compact_interval)
+            try:
+                self.compact()
+            except Exception as e:
+                logger.error("error occurred at compacting segments: %s", e)
+
+    def compact(self):
+        """rewrites the live blocks of mostly dead sealed segments, returns the bytes reclaimed"""
+        live = dict(self.read_connection().execute("SELECT segment, SUM(length) FROM blocks GROUP BY segment"))
+        with self.condition:
+            sealed = [(segment, size) for segment, size in self.segments.items()
+                      if segment != self.active and not self.writers[segment]]
+        reclaimed = 0
+        for segment, size in sorted(sealed):
+            if live.get(segment, 0) >= size * self.compact_ratio and live.get(segment):
+                continue
+            rows = self.read_connection().execute(
+                "SELECT block_id, offset, length FROM blocks WHERE segment=?", (segment,)).fetchall()
+            for block_id, start, length in rows:
+                self.move(segment, block_id, start, length)
+            with self.condition:
+                del self.segments[segment]
+                self.maps.pop(segment, None)
+                self.counters['compactions'] += 1
+                self.counters['bytes_reclaimed'] += size - live.get(segment, 0)
+            os.remove(self.segment_path(segment))
+            reclaimed += size - live.get(segment, 0)
+            logger.info("Compacted segment %s, %s live block(s) moved, %s bytes reclaimed",
+                        segment, len(rows), size - live.get(segment, 0))
+        return reclaimed
+
+    def move(self, segment, block_id, start, length, chunk=4 * 1024 * 1024):
+        """copies a live block into the active segment, its index row follows unless the block
+           was deleted or written again meanwhile
+        """
+        new_segment, fd, new_start = self.reserve(block_id, length)
+        try:
+            if length:
+                mm = self.segment_map(segment, start + length)
+                for position in range(0, length, chunk):
+                    os.pwrite(fd, mm[start + position:start + min(length, position + chunk)], new_start + position)
+        except BaseException:
+            self.release(new_segment)
+            raise
+        self.commit(new_segment, 'UPDATE blocks SET segment=?, offset=? WHERE block_id=? AND segment=? AND offset=?',
+                    (new_segment, new_start, block_id, segment, start))
+
+    def stats(self):
+        with self.condition:
+            stats = dict(self.counters)
+            stats['segments'] = len(self.segments)
+            stats['segment_bytes'] = sum(self.segments.values())
+            stats['mapped_segments'] = len(self.maps)
+            stats['writers'] = sum(self.writers.values())
+            return stats
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.committer.join()
+        with self.condition:
+            for fd in self.fds.values():
+                os.close(fd)
+            self.fds.clear()
+            self.maps.clear()
@@ -0,0 +1,326 @@
+"""Binary block transfer channel between clients and data nodes, rpyc stays for control calls.
+
+Every request and response starts with a 4 byte big endian length followed by a JSON header.
+A write header is followed by `length` raw bytes, a successful read response likewise:
+
+    write  {'op': 'write', 'block_id', 'destination', 'pipeline', 'length'} + payload
+           -> {'status': 'ok', 'acks': n}
+    read   {'op': 'read', 'block_id', 'source_path', 'offset', 'length'}
+           -> {'status': 'ok', 'length': n} + payload | {'status': 'missing'}
+           offset/length select a byte range of the block, length None reads to its end
+    copy   {'op': 'copy', 'block_id', 'source_path', 'pipeline', 'rate'}
+           -> {'status': 'ok', 'acks': n, 'length': n} | {'status': 'missing'}
+           the data node pushes its copy of the block down pipeline like a client write,
+           at most rate bytes per second if rate is set, acks counts the pipeline nodes only
+    delete {'op': 'delete', 'block_id', 'source_path'} -> {'status': 'ok', 'deleted': bool}
+    locate {'op': 'locate', 'block_id', 'source_path'}
+           -> {'status': 'ok', 'path', 'offset', 'length'} | {'status': 'missing'}
+           where the block lies on the data node's disk, for clients on the same host
+    ping   {'op': 'ping'} -> {'status': 'ok'}
+"""
+
+import json
+import logging
+import os
+import socket
+import socketserver
+import struct
+import time
+
+from metrics import REGISTRY
+
+HEADER_LENGTH = struct.Struct('!I')
+logger = logging.getLogger('block_transfer')
+
+
+class BlockTransferError(Exception):
+    pass
+
+
+def send_header(sock, header):
+    data = json.dumps(header).encode('utf-8')
+    sock.sendall(HEADER_LENGTH.pack(len(data)) + data)
+
+
+def recv_exact_into(sock, view):
+    while len(view):
+        received = sock.recv_into(view)
+        if received == 0:
+            raise EOFError("connection closed by peer")
+        view = view[received:]
+
+
+def recv_header(sock):
+    length = bytearray(HEADER_LENGTH.size)
+    recv_exact_into(sock, memoryview(length))
+    data = bytearray(HEADER_LENGTH.unpack(length)[0])
+    recv_exact_into(sock, memoryview(data))
+    return json.loads(data)
+
+
+class Throttle:
+    """paces a stream to rate bytes per second, no limit if rate is falsy"""
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.start = time.monotonic()
+        self.sent = 0
+
+    def wait(self, length):
+        if self.rate:
+            delay = self.start + self.sent / self.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        self.sent += length
+
+
+class BlockTransferConnection:
+    """client side of the channel, has the closed/ping/close surface ConnectionPool expects"""
+
+    def __init__(self, host, port, timeout=30):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.closed = False
+
+    def request(self, header):
+        send_header(self.sock, header)
+        return self.response()
+
+    def response(self):
+        header = recv_header(self.sock)
+        if header['status'] == 'error':
+            raise BlockTransferError(header['error'])
+        return header
+
+    def start_write(self, block_id, destination, pipeline, length):
+        send_header(self.sock, {'op': 'write', 'block_id': block_id, 'destination': destination,
+                                'pipeline': [list(node) for node in pipeline], 'length': length})
+
+    def finish_write(self):
+        return self.response()['acks']
+
+    def write_block(self, block_id, destination, pipeline, data):
+        """sends data (bytes or a memoryview, e.g. over an mmap) without copying it
+           returns the number of data nodes in the pipeline that stored the block
+        """
+        self.start_write(block_id, destination, pipeline, len(data))
+        self.sock.sendall(data)
+        return self.finish_write()
+
+    def read_block(self, block_id, source_path, offset=0, length=None):
+        """returns the block (or the byte range offset:offset+length of it) received straight
+           into a preallocated bytearray, None if missing
+        """
+        header = self.request({'op': 'read', 'block_id': block_id, 'source_path': source_path,
+                               'offset': offset, 'length': length})
+        if header['status'] == 'missing':
+            return None
+        data = bytearray(header['length'])
+        recv_exact_into(self.sock, memoryview(data))
+        return data
+
+    def copy_block(self, block_id, source_path, pipeline, rate=None):
+        """asks the data node to push its copy of block_id down pipeline, returns the number of
+           pipeline nodes that stored it, None if the data node does not hold the block
+        """
+        header = self.request({'op': 'copy', 'block_id': block_id, 'source_path': source_path,
+                               'pipeline': [list(node) for node in pipeline], 'rate': rate})
+        if header['status'] == 'missing':
+            return None
+        return header['acks']
+
+    def delete_block(self, block_id, source_path):
+        return self.request({'op': 'delete', 'block_id': block_id, 'source_path': source_path})['deleted']
+
+    def locate_block(self, block_id, source_path):
+        """(path, offset, length) of the bytes of block_id in a local file, None if missing"""
+        header = self.request({'op': 'locate', 'block_id': block_id, 'source_path': source_path})
+        if header['status'] == 'missing':
+            return None
+        return header['path'], header['offset'], header['length']
+
+    def ping(self, timeout=None):
+        self.request({'op': 'ping'})
+
+    def close(self):
+        self.closed = True
+        self.sock.close()
+
+
+class BlockTransferHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # reused for every write on this connection
+        buffer = bytearray(self.server.buffer_size)
+        while True:
+            try:
+                header = recv_header(self.request)
+            except (EOFError, ConnectionError):
+                return
+            start = time.perf_counter()
+            try:
+                if header['op'] == 'write':
+                    response = self.server.receive_block(self.request, header, buffer)
+                elif header['op'] == 'read':
+                    self.server.send_block(self.request, header)
+                    REGISTRY.observe('block_transfer_seconds', time.perf_counter() - start, op='read')
+                    continue
+                elif header['op'] == 'copy':
+                    response = self.server.copy_block(header)
+                elif header['op'] == 'delete':
+                    response = self.server.delete_block(header)
+                elif header['op'] == 'locate':
+                    response = self.server.locate_block(header)
+                elif header['op'] == 'ping':
+                    response = {'status': 'ok'}
+                else:
+                    response = {'status': 'error', 'error': f"unknown op {header['op']}"}
+            except (EOFError, ConnectionError) as e:
+                logger.warning("Block transfer connection lost: %s", e)
+                return
+            except Exception as e:
+                REGISTRY.inc('block_transfer_errors_total', op=header.get('op'))
+                logger.exception("Block transfer %s failed", header.get('op'))
+                send_header(self.request, {'status': 'error', 'error': str(e)})
+                if header.get('op') == 'write':
+                    # the rest of the payload may still be in flight, the stream can not be reused
+                    return
+                continue
+            if header['op'] == 'write':
+                REGISTRY.observe('block_transfer_seconds', time.perf_counter() - start, op='write')
+            send_header(self.request, response)
+
+
+class BlockTransferServer(socketserver.ThreadingTCPServer):
+    """data node side of the channel
+       1) writes are received with recv_into into a reused buffer, handed to a writer of the
+          block store and forwarded chunk by chunk to the next data node of the pipeline while
+          still receiving
+       2) reads are answered with socket.sendfile from the file (or segment) holding the
+          block, the block never enters Python memory
+       3) copies to other data nodes are sent with sendfile too, one buffer_size chunk at a
+          time so the stream can be throttled
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, store, pool, port_offset, buffer_size=1048576):
+        self.store = store  # FileBlockStore or LogBlockStore, see block_store.py
+        self.pool = pool  # of BlockTransferConnection, for forwarding
+        self.port_offset = port_offset  # transfer port = rpyc port + port_offset
+        self.buffer_size = buffer_size
+        super().__init__(address, BlockTransferHandler)
+
+    def open_downstream(self, header):
+        pipeline = header.get('pipeline') or []
+        if not pipeline:
+            return None
+        next_host, next_port = pipeline[0][0], int(pipeline[0][1]) + self.port_offset
+        try:
+            downstream = self.pool.acquire(next_host, next_port)
+        except Exception as e:
+            logger.warning("Failed to forward block %s to %s: %s", header['block_id'], pipeline[0], e)
+            return None
+        try:
+            downstream.start_write(header['block_id'], header['destination'], pipeline[1:], header['length'])
+        except Exception as e:
+            logger.warning("Failed to forward block %s to %s: %s", header['block_id'], pipeline[0], e)
+            self.pool.discard_and_release(next_host, next_port, downstream)
+            return None
+        return next_host, next_port, downstream
+
+    def receive_block(self, sock, header, buffer):
+        writer = self.store.writer(header['block_id'], header['destination'], header['length'])
+        downstream = self.open_downstream(header)
+        view = memoryview(buffer)
+        remaining = header['length']
+        try:
+            while remaining:
+                received = sock.recv_into(view[:min(remaining, len(view))])
+                if received == 0:
+                    raise EOFError("sender closed the connection mid block")
+                chunk = view[:received]
+                writer.write(chunk)
+                if downstream is not None:
+                    try:
+                        downstream[2].sock.sendall(chunk)
+                    except OSError as e:
+                        logger.warning("Failed to forward block %s: %s", header['block_id'], e)
+                        self.pool.discard_and_release(*downstream)
+                        downstream = None
+                remaining -= received
+        except BaseException:
+            if downstream is not None:
+                self.pool.discard_and_release(*downstream)
+            writer.abort()
+            raise
+        try:
+            writer.commit()
+        except BaseException:
+            if downstream is not None:
+                self.pool.discard_and_release(*downstream)
+            raise
+        REGISTRY.inc('blocks_stored_total')
+        REGISTRY.inc('block_bytes_written_total', header['length'])
+        acks = 1
+        if downstream is not None:
+            try:
+                acks += downstream[2].finish_write()
+                self.pool.release(*downstream)
+            except Exception as e:
+                logger.warning("Downstream %s failed block %s: %s", downstream[:2], header['block_id'], e)
+                self.pool.discard_and_release(*downstream)
+        return {'status': 'ok', 'acks': acks}
+
+    def send_block(self, sock, header):
+        block = self.store.open_block(header['block_id'], header['source_path'])
+        if block is None:
+            REGISTRY.inc('blocks_missing_total')
+            send_header(sock, {'status': 'missing'})
+            return
+        f, start, size = block
+        with f:
+            offset = min(header.get('offset') or 0, size)
+            length = size - offset
+            if header.get('length') is not None:
+                length = min(length, header['length'])
+            send_header(sock, {'status': 'ok', 'length': length})
+            if length:
+                sock.sendfile(f, start + offset, length)
+            REGISTRY.inc('blocks_read_total')
+            REGISTRY.inc('block_bytes_read_total', length)
+
+    def copy_block(self, header):
+        block = self.store.open_block(header['block_id'], header['source_path'])
+        if block is None:
+            REGISTRY.inc('blocks_missing_total')
+            return {'status': 'missing'}
+        f, start, size = block
+        pipeline = header['pipeline']
+        host, port = pipeline[0][0], int(pipeline[0][1]) + self.port_offset
+        throttle = Throttle(header.get('rate'))
+        with f, self.pool.connection(host, port) as downstream:
+            downstream.start_write(header['block_id'], header['source_path'], pipeline[1:], size)
+            offset = 0
+            while offset < size:
+                count = min(self.buffer_size, size - offset)
+                throttle.wait(count)
+                downstream.sock.sendfile(f, start + offset, count)
+                offset += count
+            acks = downstream.finish_write()
+        REGISTRY.inc('blocks_copied_total')
+        REGISTRY.inc('block_bytes_copied_total', size)
+        return {'status': 'ok', 'acks': acks, 'length': size}
+
+    def delete_block(self, header):
+        if not self.store.delete(header['block_id'], header['source_path']):
+            return {'status': 'ok', 'deleted': False}
+        REGISTRY.inc('blocks_deleted_total')
+        return {'status': 'ok', 'deleted': True}
+
+    def locate_block(self, header):
+        block = self.store.block_file(header['block_id'], header['source_path'])
+        if block is None:
+            return {'status': 'missing'}
+        path, offset, length = block
+        return {'status': 'ok', 'path': os.path.abspath(path), 'offset': offset, 'length': length}
@@ -1,130 +1,793 @@
-import json
+import functools
+import logging
 import os
-import rpyc
+import queue
+import shutil
+import socket
 import sys
 import threading
+import time
 import mmap
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from block_cache import block_cache_from_config
+from block_transfer import BlockTransferConnection
+from compression import BlockCompressor, compressor_from_config, decompress_block
+from connection_pool import ConnectionPool, pool_from_config
+from dedup import hash_blocks
+from erasure import ReedSolomon, is_erasure_coded, parse_block_id, parse_policy, split_stripes
+from packing import Container
+from replica_selection import NodeLatency, ReadAttempt
+from streaming import StreamWriter
+from metrics import REGISTRY, setup_logging
+
+logger = logging.getLogger('client')
+
+
+@functools.lru_cache(maxsize=None)
+def is_local_host(host):
+    """True if host resolves to an address of this machine, only a local address can be bound"""
+    try:
+        address = socket.gethostbyname(host)
+    except OSError:
+        return False
+    if address.startswith('127.'):
+        return True
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.bind((address, 0))
+        return True
+    except OSError:
+        return False
+
+
+class BlockUploadError(Exception):
+    """raised when at least one block could not be stored on its primary and all replicas"""
+
+    def __init__(self, message, report):
+        super().__init__(message)
+        self.report = report
 
 
 class FilesystemClient:
-    def __init__(self, block_size):
+    def __init__(self, block_size, max_in_flight=4, max_retries=2, read_ahead=4, transfer_port_offset=10000,
+                 pool=None, transfer_pool=None, name_node=('localhost', 1800), compressor=None, dedup=False,
+                 storage_policy='replication', small_file_bytes=None, block_cache=None, short_circuit=False,
+                 hedge_percentile=95, hedge_min_delay=0.01):
         self.block_size = block_size
+        # blocks are compressed in a process pool before they are sent, off by default
+        self.compressor = compressor or BlockCompressor('none')
+        # name blocks by their content hash and only send the ones no data node holds yet
+        self.dedup = dedup
+        # 'replication' or 'rs-<k>-<m>' erasure coding, the default of create_file
+        parse_policy(storage_policy)
+        self.storage_policy = storage_policy
+        # put_many packs files up to this size into container blocks
+        self.small_file_bytes = small_file_bytes or block_size // 4
+        self.name_node = name_node[0], int(name_node[1])
+        # name node connections are reused across calls
+        self.pool = pool or ConnectionPool()
+        # block payloads go over the data nodes' binary channel at rpyc port + transfer_port_offset
+        self.transfer_port_offset = transfer_port_offset
+        self.transfer_pool = transfer_pool or ConnectionPool(connect=BlockTransferConnection)
+        # upper bound on blocks queued or being sent, memory stays ~ max_in_flight * block_size
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        # blocks fetched ahead of the reader, memory stays ~ read_ahead * block_size
+        self.read_ahead = read_ahead
+        # TieredBlockCache of whole decompressed blocks, block ids never change their bytes
+        self.block_cache = block_cache
+        # blocks of data nodes on this host are read from their files, not over the network
+        self.short_circuit = short_circuit
+        # copies of a block are read from the data node with the lowest expected latency first
+        self.latency = NodeLatency()
+        # a read slower than this percentile of recent reads (never less than hedge_min_delay
+        # seconds) gets a second request to the next copy, 0 turns hedging off
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_executor = ThreadPoolExecutor(max_workers=4 * read_ahead, thread_name_prefix='hedged-read')
+
+    def close(self):
+        """stops the hedged read threads and compression workers, closes the idle pooled connections"""
+        self.hedge_executor.shutdown(wait=False, cancel_futures=True)
+        self.compressor.close()
+        self.pool.close_all()
+        self.transfer_pool.close_all()
+
+    def __enter__(self):
+        return self
 
-    def create_replicate_data_to_data_node(self, block_id, replica_nodes, data, destination):
-        for replica_data_node in replica_nodes:
-            # Use threading for asynchronous replication
-            threading.Thread(target=self.send_to_data_node, args=(
-                block_id, replica_data_node[1], data, destination, [])).start()
+    def __exit__(self, *exc_info):
+        self.close()
 
-    def send_to_data_node(self, block_id, data_node, data, destination, replica_nodes=[]):
+    def data_node_transfer(self, data_node):
+        return self.transfer_pool.connection(data_node[0], int(data_node[1]) + self.transfer_port_offset)
+
+    def send_to_data_node(self, block_id, data_node, block_view, destination, replica_nodes=()):
+        """stream one block to data_node, which forwards it along replica_nodes
+           the memoryview goes straight from the mmap to the socket without a copy
+           returns the number of data nodes that acknowledged the block, 0 on failure
+        """
         try:
-            with rpyc.connect(data_node[0], port=data_node[1]) as data_node_con:
-                dn = data_node_con.root.DataNodeService()
-                dn.store_block(block_id, data, destination)
-                if len(replica_nodes) > 0:
-                    self.create_replicate_data_to_data_node(
-                        block_id, replica_nodes, data, destination)
-                return True
+            with self.data_node_transfer(data_node) as transfer:
+                return transfer.write_block(block_id, destination, replica_nodes, block_view)
         except Exception as e:
-            print(f"Failed to send block to {data_node}: {e}")
-            return False
+            logger.warning("Failed to send block to %s: %s", data_node, e)
+            return 0
+
+    def send_with_retries(self, block_id, data_node, block_view, destination, replica_nodes=()):
+        """returns (acks, attempts), the pipeline is rebuilt until every node acknowledged
+           or max_retries + 1 attempts were made
+        """
+        required_acks = 1 + len(replica_nodes)
+        acks = attempts = 0
+        while attempts <= self.max_retries and acks < required_acks:
+            attempts += 1
+            acks = max(acks, self.send_to_data_node(
+                block_id, data_node, block_view, destination, replica_nodes))
+        return acks, attempts
+
+    def block_views(self, view, primary_blocks, indices=None):
+        """yields (index, block_view) of the blocks to send, slices of the file view
+           an erasure coded file is cut stripe by stripe, the parity blocks of a stripe are
+           computed before its data blocks are handed out and follow them
+        """
+        if not primary_blocks or not is_erasure_coded(primary_blocks[0][0]):
+            for index in range(len(primary_blocks)) if indices is None else indices:
+                yield index, view[index * self.block_size:(index + 1) * self.block_size]
+            return
+        data_index = 0
+        stripe = []
+        for index, (block_id, _) in enumerate(primary_blocks):
+            k, m, _, j = parse_block_id(block_id)
+            if j < k:
+                stripe.append((index, view[data_index * self.block_size:(data_index + 1) * self.block_size]))
+                data_index += 1
+                continue
+            if j == k:
+                parity = ReedSolomon(k, m).encode([block_view for _, block_view in stripe])
+                yield from stripe
+                stripe = []
+            yield index, memoryview(parity[j - k])
+
+    def upload_blocks(self, mm, primary_blocks, replica_blocks, destination, indices=None):
+        """upload blocks in parallel with one worker per primary data node
+           1) each block is a memoryview slice of the mmap, nothing is copied while queueing
+           2) the client sends a block once, the data nodes chain it to the replicas
+              (primary -> replica 1 -> replica 2 ...) and the acks flow back up the chain
+           3) the window semaphore blocks the producer once max_in_flight blocks are pending,
+              a slot is freed when the block is acknowledged or has given up
+           4) blocks are handed to the compressor as they are queued, so compression of the
+              next blocks overlaps with sending the current ones
+           5) indices restricts the upload to those blocks, a deduplicated put skips the blocks
+              the data nodes already hold
+           6) returns a per block report in block order, with the codec each block was sent with
+              and the data_nodes that stored it
+        """
+        window = threading.BoundedSemaphore(self.max_in_flight)
+        replicas_by_block = {}
+        for block_id, replica_node in replica_blocks:
+            replicas_by_block.setdefault(block_id, []).append(tuple(replica_node))
+        report = [None] * len(primary_blocks)
+        queues = {}
+        workers = []
+
+        def worker(block_queue):
+            while True:
+                task = block_queue.get()
+                if task is None:
+                    return
+                index, block_id, data_node, block_view, encoded = task
+                result = report[index]
+                try:
+                    result['codec'], payload = encoded.result()
+                    acks, result['attempts'] = self.send_with_retries(
+                        block_id, data_node, payload, destination,
+                        replicas_by_block.get(block_id, []))
+                    result['stored'] = acks > 0
+                    result['replicas'] = max(acks - 1, 0)
+                    # the pipeline stops at the first node that fails, the ones before it acked
+                    result['data_nodes'] = (data_node, *replicas_by_block.get(block_id, [])[:acks - 1]) if acks else ()
+                except Exception as e:
+                    result['error'] = str(e)
+                finally:
+                    block_view.release()
+                    result['under_replicated'] = result['stored'] and \
+                        result['replicas'] < result['expected_replicas']
+                    result['success'] = result['stored'] and not result['under_replicated']
+                    window.release()
 
-    def read_from_data_node(self, block_id, data_node, replica_blocks, source_path):
-        """1) first trying to get data from primary block otherwise from multiple replica"""
+        with memoryview(mm) as view:
+            try:
+                for index, block_view in self.block_views(view, primary_blocks, indices):
+                    block_id, data_node = primary_blocks[index]
+                    data_node = tuple(data_node)
+                    window.acquire()
+                    report[index] = {'block_id': block_id, 'data_node': data_node, 'attempts': 0,
+                                     'stored': False, 'replicas': 0, 'codec': 'none', 'data_nodes': (),
+                                     'expected_replicas': len(replicas_by_block.get(block_id, [])),
+                                     'under_replicated': False, 'success': False}
+                    if data_node not in queues:
+                        queues[data_node] = queue.Queue()
+                        thread = threading.Thread(
+                            target=worker, args=(queues[data_node],), daemon=True)
+                        thread.start()
+                        workers.append(thread)
+                    queues[data_node].put(
+                        (index, block_id, data_node, block_view, self.compressor.submit(block_view)))
+            finally:
+                for block_queue in queues.values():
+                    block_queue.put(None)
+                for thread in workers:
+                    thread.join()
+        return [result for result in report if result is not None]
+
+    def read_local(self, block_id, data_node, source_path, offset=0, length=None):
+        """reads a block of a data node on this host from the file holding it, None if it can
+           not, only the location comes over the transfer channel
+        """
         try:
-            with rpyc.connect(data_node[0], port=data_node[1]) as data_node_con:
-                dn = data_node_con.root.DataNodeService()
-                data = dn.get_block(block_id, source_path)
-                if data:
-                    return data
-                raise Exception("Block is corrupted")
+            with self.data_node_transfer(data_node) as transfer:
+                block = transfer.locate_block(block_id, source_path)
+            if block is None:
+                return None
+            path, start, size = block
+            offset = min(offset, size)
+            end = size if length is None else min(size, offset + length)
+            if end <= offset:
+                return b''
+            with open(path, 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    data = mm[start + offset:start + end]
         except Exception as e:
-            print(
-                f"Failed to read block from primary data node {data_node}: {e}")
-            for replica_block in replica_blocks:
-                print(f"trying to read from replica {replica_block}")
-                if replica_block[0] == block_id:
+            logger.debug("Short-circuit read of block %s from %s failed: %s", block_id, data_node, e)
+            return None
+        REGISTRY.inc('short_circuit_reads_total')
+        REGISTRY.inc('short_circuit_bytes_total', len(data))
+        return data
+
+    def read_from(self, block_id, data_node, source_path, offset=0, length=None, attempt=None):
+        """reads a block from one data node, attempt (a ReadAttempt) lets another thread abort it"""
+        if self.short_circuit and is_local_host(data_node[0]):
+            data = self.read_local(block_id, data_node, source_path, offset, length)
+            if data is not None:
+                return data
+        with self.data_node_transfer(data_node) as transfer:
+            if attempt is None:
+                return transfer.read_block(block_id, source_path, offset, length)
+            attempt.started(transfer)
+            try:
+                data = transfer.read_block(block_id, source_path, offset, length)
+            finally:
+                attempt.finished()
+            return data
+
+    def timed_read(self, block_id, data_node, source_path, offset=0, length=None, attempt=None):
+        """read_from that feeds the latency and errors of data_node into self.latency"""
+        started = time.perf_counter()
+        try:
+            data = self.read_from(block_id, data_node, source_path, offset, length, attempt)
+            if data is None:
+                raise Exception("Block is corrupted")
+        except Exception:
+            if attempt is not None and attempt.cancelled:
+                # lost to a hedge, without this a slow node would stay first
+                self.latency.record_slow(data_node, time.perf_counter() - started)
+            else:
+                self.latency.record_error(data_node)
+            raise
+        # latencies are grouped by the size asked for, a whole block counts as block_size
+        self.latency.record(data_node, time.perf_counter() - started, self.block_size if length is None else length)
+        return data
+
+    def hedge_delay(self, length):
+        """seconds to wait for a read of length bytes (None: a whole block) before hedging it, None for never"""
+        if not self.hedge_percentile:
+            return None
+        delay = self.latency.percentile(self.hedge_percentile, self.block_size if length is None else length)
+        return None if delay is None else max(delay, self.hedge_min_delay)
+
+    def read_from_data_node(self, block_id, data_node, replica_blocks, source_path, offset=0, length=None):
+        """1) the primary and replica_blocks (the replicas of block_id, as in replicas_by_block)
+              are tried from the data node with the lowest expected latency, a failure moves on
+              to the next one at once
+           2) a read slower than hedge_delay gets a second request to the next copy, the first
+              answer wins and the other request is cancelled
+           3) offset/length restrict the read to a byte range of the block
+           4) a data node on this host is read from its files with short_circuit
+        """
+        data_nodes = [(data_node[0], int(data_node[1]))]
+        for replica_block in replica_blocks:
+            replica_node = (replica_block[1][0], int(replica_block[1][1]))
+            if replica_node not in data_nodes:
+                data_nodes.append(replica_node)
+        candidates = deque(self.latency.order(data_nodes))
+        if len(candidates) == 1 or not self.hedge_percentile:
+            while candidates:
+                candidate = candidates.popleft()
+                try:
+                    return self.timed_read(block_id, candidate, source_path, offset, length)
+                except Exception as e:
+                    logger.warning("Failed to read block %s from data node %s: %s", block_id, candidate, e)
+            raise Exception("unable to retrieve block(s)")
+
+        attempts = {}  # future: (ReadAttempt, hedged), at most two in flight
+
+        def launch(hedged):
+            attempt = ReadAttempt()
+            future = self.hedge_executor.submit(
+                self.timed_read, block_id, candidates.popleft(), source_path, offset, length, attempt)
+            attempts[future] = attempt, hedged
+
+        launch(False)
+        try:
+            while attempts:
+                delay = self.hedge_delay(length) if len(attempts) == 1 and candidates else None
+                done, _ = wait(attempts, timeout=delay, return_when=FIRST_COMPLETED)
+                if not done:
+                    REGISTRY.inc('hedged_reads_total')
+                    launch(True)
+                    continue
+                for future in done:
+                    _, hedged = attempts.pop(future)
                     try:
-                        with rpyc.connect(replica_block[1][0], port=replica_block[1][1]) as data_node_replica_con:
-                            dnr = data_node_replica_con.root.DataNodeService()
-                            return dnr.get_block(block_id, source_path)
+                        data = future.result()
                     except Exception as e:
-                        print(f"error occurred at {e}")
-            raise Exception("unable to retrieve block(s)")
+                        logger.warning("Failed to read block %s: %s", block_id, e)
+                        continue
+                    if hedged:
+                        REGISTRY.inc('hedged_read_wins_total')
+                    return data
+                if len(attempts) < 2 and candidates:
+                    launch(False)
+        finally:
+            for future, (attempt, _) in attempts.items():
+                future.cancel()
+                attempt.cancel()
+        raise Exception("unable to retrieve block(s)")
 
-    def create_file(self, filename, destination):
-        with rpyc.connect(host, port) as name_node_conn:
+    def create_file(self, filename, destination, policy=None):
+        """stores filename at destination, policy overrides the client's storage_policy
+           the NameNode places the blocks, they are uploaded, then commit_blocks makes the file
+           visible with the codec of every block; a put that fails before leaves the previous
+           version of destination as it was
+        """
+        policy = policy or self.storage_policy
+        if self.dedup and parse_policy(policy) is not None:
+            raise ValueError("deduplicated puts are replicated, they can not be erasure coded")
+        with self.pool.connection(*self.name_node) as name_node_conn:
             try:
                 file_size = os.path.getsize(filename)
-                primary_blocks, replica_nodes = name_node_conn.root.NameNodeService(
-                ).create_blocks(destination, file_size)
-                print("Primary Block Detail: ", primary_blocks)
-                print("Replica Block Detail: ", replica_nodes)
+                service = name_node_conn.root.NameNodeService()
+                if not file_size:
+                    service.commit_blocks(destination, (), (), (), False, None, False, 0)
+                    return []
+                reused_codecs = ()
+                if not self.dedup:
+                    primary_blocks, replica_nodes = service.create_blocks(destination, file_size, policy)
+                    logger.debug("Primary Block Detail: %s", primary_blocks)
+                    logger.debug("Replica Block Detail: %s", replica_nodes)
                 with open(filename, "rb") as f:
                     # Create a memory map for the entire file
                     """Using mmap for reading blocks can improve efficiency by avoiding the need to read the entire file into memory at once. It allows you to read specific portions of the file directly from the operating system's file cache, which can be beneficial for large files."""
                     with mmap.mmap(f.fileno(), length=0, access=mmap.ACCESS_READ) as mm:
-                        for block_id, data_node in primary_blocks:
-                            # Calculate the starting position of the block
-                            start_pos = self.block_size
-                            if self.block_size > file_size:
-                                # Read the block directly from the memory-mapped file
-                                data = mm[:]
-                            else:
-                                data = mm[start_pos:start_pos +
-                                          self.block_size]
-                            self.send_to_data_node(
-                                block_id, data_node, data, destination, replica_nodes)
+                        to_upload = None
+                        if self.dedup:
+                            with memoryview(mm) as view:
+                                block_ids = hash_blocks(view, self.block_size, self.max_in_flight)
+                            primary_blocks, replica_nodes, to_upload, reused_codecs = service.create_dedup_blocks(
+                                destination, block_ids)
+                            logger.debug("%s of %s block(s) of %s are new", len(to_upload), len(block_ids),
+                                         destination)
+                        report = self.upload_blocks(
+                            mm, primary_blocks, replica_nodes, destination, to_upload)
+                lost = [result for result in report if not result['stored']]
+                if lost:
+                    raise BlockUploadError(
+                        f"Failed to upload {len(lost)} of {len(report)} block(s): {lost}", report)
+                sent = {result['block_id']: result for result in report}
+                # copies of sent blocks are recorded where they were acked, reused ones as placed
+                replica_blocks = tuple((block_id, tuple(data_node)) for block_id, data_node in replica_nodes
+                                       if block_id not in sent or tuple(data_node) in sent[block_id]['data_nodes'])
+                codecs = tuple(reused_codecs) + tuple(
+                    (result['block_id'], result['codec']) for result in report if result['codec'] != 'none')
+                service.commit_blocks(destination, tuple(primary_blocks), replica_blocks, codecs,
+                                      False, None, False, file_size)
+                failed_blocks = [result for result in report if not result['success']]
+                if failed_blocks:
+                    # committed, the NameNode re-replicates the blocks short of copies
+                    raise BlockUploadError(
+                        f"{len(failed_blocks)} of {len(report)} block(s) are under replicated: {failed_blocks}", report)
+                return report
             except EOFError as e:
-                print(f"Server was closed")
+                logger.error("Server was closed")
+                raise
+            except BlockUploadError:
+                raise
             except Exception as e:
-                print(f"Error occurred: {e}")
+                logger.error("Error occurred: %s", e)
                 raise Exception(e)
-            finally:
-                print("Name node server connection closed.")
 
     def find_replica_block(self, replica_blocks, block_id):
         for replica_block in replica_blocks:
             if replica_block[0] == block_id:
                 return replica_block
 
-    def read_file(self, source_path):
-        """1) get the data from primary block otherwise fetch it from replica
-           2) if blocks_details is None it means there is no entry in metadata service
-           3) data will be copied on multiple data nodes based on replication factor in config
+    def get_block_locations(self, source_path):
+        """returns (primary_blocks, replicas_by_block, codecs, stripes, windows) for source_path
+           if blocks_details is None it means there is no entry in metadata service
         """
-        with rpyc.connect(host, port) as name_node_conn:
+        with self.pool.connection(*self.name_node) as name_node_conn:
             try:
                 blocks_details = name_node_conn.root.NameNodeService().get_file_table_entry(source_path)
-                # 2 times json dumps first time metadata then namenode
-                blocks_details = json.loads(json.loads(blocks_details))
-                if not blocks_details:
-                    print("File not found")
-                    raise Exception("File not found")
-                content = ''
-                # this json.loads because in metadata service we are saving as json.dumps
-                primary_blocks = json.loads(blocks_details['primary_block'])
-                replica_blocks = json.loads(blocks_details['replica_block'])
-                for primary_block in primary_blocks:
-                    block_id, data_node = primary_block
-                    data = self.read_from_data_node(
-                        block_id, data_node, replica_blocks, source_path)
-                    if data:
-                        content += data.decode('utf-8')
-                    else:
-                        print("No data found for block")
-                return content
             except EOFError as e:
-                print(f"Server was closed")
+                logger.error("Server was closed")
+                raise
+        if blocks_details is None:
+            raise FileNotFoundError(f"File not found: {source_path}")
+        return self.block_locations(blocks_details)
+
+    def block_locations(self, blocks_details):
+        """turns a NameNode file table entry into (primary_blocks, replicas_by_block, codecs, stripes, windows)
+           1) codecs maps the block ids of compressed blocks to their codec
+           2) for an erasure coded file primary_blocks are its data blocks and stripes maps each
+              of them to the ((block_id, data_node, codec), ...) of its stripe, else it is empty
+           3) windows maps the container block of a packed file to (offset, length) of the file in it
+        """
+        primary_blocks, replica_blocks, codecs, windows = blocks_details
+        codecs = dict(codecs)
+        windows = {block_id: (offset, length) for block_id, offset, length in windows}
+        replicas_by_block = {}
+        for replica_block in replica_blocks:
+            replicas_by_block.setdefault(replica_block[0], []).append(replica_block)
+        stripes = {}
+        if primary_blocks and is_erasure_coded(primary_blocks[0][0]):
+            # parity blocks are only read to rebuild a lost data block
+            primary_blocks, stripes = split_stripes(primary_blocks, codecs)
+        return primary_blocks, replicas_by_block, codecs, stripes, windows
+
+    def iter_blocks(self, source_path):
+        """returns an iterator over the blocks of source_path as bytes
+           the block locations are looked up right away, so a missing file raises here
+        """
+        return self.stream_blocks(source_path, *self.get_block_locations(source_path))
+
+    def read_block(self, block_id, data_node, replica_blocks, source_path, codec='none', offset=0, length=None,
+                   stripe=None, window=None):
+        """reads a block (or the byte range offset:offset+length of it) and decompresses it
+           1) a compressed block is always fetched whole, offsets only apply to its stored bytes
+           2) a block of an erasure coded file that can not be read is rebuilt from its stripe
+           3) window is the (offset, length) of a packed file in its container block, offset
+              and length are then relative to the file
+           4) with a block cache every block read whole (compressed or rebuilt ones always
+              are) is cached decompressed, and any later read of it is served from there
+        """
+        if window is not None:
+            base, size = window
+            offset = min(offset, size)
+            length = size - offset if length is None else min(length, size - offset)
+            offset += base
+        end = None if length is None else offset + length
+        if self.block_cache is not None:
+            data = self.block_cache.get(block_id)
+            if data is not None:
+                return data[offset:end]
+        try:
+            if codec == 'none':
+                if self.block_cache is None or offset or length is not None:
+                    return self.read_from_data_node(block_id, data_node, replica_blocks, source_path, offset, length)
+                data = self.read_from_data_node(block_id, data_node, replica_blocks, source_path)
+            else:
+                data = decompress_block(
+                    bytes(self.read_from_data_node(block_id, data_node, replica_blocks, source_path)), codec)
+        except Exception as e:
+            if not stripe:
+                raise
+            logger.warning("Rebuilding block %s from its stripe: %s", block_id, e)
+            data = self.reconstruct_block(block_id, stripe, source_path)
+        if self.block_cache is not None:
+            self.block_cache.put(block_id, data)
+        return data[offset:end]
+
+    def reconstruct_block(self, block_id, stripe, source_path):
+        """decodes a data block from the other blocks of its stripe, fetched in parallel"""
+        k, m, _, lost = parse_block_id(block_id)
+
+        def fetch(member):
+            member_id, data_node, codec = member
+            try:
+                data = self.read_from_data_node(member_id, data_node, [], source_path)
+                return parse_block_id(member_id)[3], decompress_block(bytes(data), codec)
             except Exception as e:
-                print(f"error occurred at read_file: {e}")
-                raise Exception(e)
-            finally:
-                print("Name node server connection closed.")
+                logger.warning("Block %s of the stripe of %s is unavailable: %s", member_id, block_id, e)
+                return None
+
+        others = [member for member in stripe if member[0] != block_id]
+        with ThreadPoolExecutor(max_workers=len(others)) as executor:
+            blocks = dict(result for result in executor.map(fetch, others) if result is not None)
+        data_count = sum(1 for member in stripe if parse_block_id(member[0])[3] < k)
+        return ReedSolomon(k, m).reconstruct(blocks, data_count)[lost]
+
+    def stream_blocks(self, source_path, primary_blocks, replicas_by_block, codecs=None, stripes=None, windows=None):
+        """yields the given blocks in order as bytes
+           1) the next read_ahead blocks are fetched in parallel across data nodes
+           2) get the data from primary block otherwise fetch it from replica
+           3) at most read_ahead blocks are held at once, whatever the file size
+           4) a lost block of an erasure coded file is rebuilt from the rest of its stripe
+        """
+        executor = ThreadPoolExecutor(max_workers=self.read_ahead)
+        pending = deque()
+        blocks = iter(primary_blocks)
+        try:
+            while True:
+                while len(pending) < self.read_ahead:
+                    block_id, data_node = next(blocks, (None, None))
+                    if block_id is None:
+                        break
+                    pending.append(executor.submit(
+                        self.read_block, block_id, data_node,
+                        replicas_by_block.get(block_id, []), source_path, (codecs or {}).get(block_id, 'none'),
+                        stripe=(stripes or {}).get(block_id), window=(windows or {}).get(block_id)))
+                if not pending:
+                    return
+                data = pending.popleft().result()
+                if data is None:
+                    raise Exception("No data found for block")
+                yield data
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def read_file(self, source_path):
+        """whole file as bytes, use iter_blocks or read_file_to for large files"""
+        return b''.join(self.iter_blocks(source_path))
+
+    def read_range(self, source_path, offset, length):
+        """returns up to length bytes of source_path starting at offset, like pread
+           only the blocks covering the range are read, and only the covered slice of each,
+           the slices are fetched in parallel across data nodes
+        """
+        if offset < 0 or length < 0:
+            raise ValueError("offset and length must not be negative")
+        primary_blocks, replicas_by_block, codecs, stripes, windows = self.get_block_locations(source_path)
+        if length == 0:
+            return b''
+        first_block = offset // self.block_size
+        last_block = min((offset + length - 1) // self.block_size, len(primary_blocks) - 1)
+        with ThreadPoolExecutor(max_workers=self.read_ahead) as executor:
+            slices = []
+            for index in range(first_block, last_block + 1):
+                block_id, data_node = primary_blocks[index]
+                block_start = index * self.block_size
+                slice_start = max(offset, block_start) - block_start
+                slice_end = min(offset + length, block_start + self.block_size) - block_start
+                slices.append(executor.submit(
+                    self.read_block, block_id, data_node, replicas_by_block.get(block_id, []),
+                    source_path, codecs.get(block_id, 'none'), slice_start, slice_end - slice_start,
+                    stripes.get(block_id), windows.get(block_id)))
+            return b''.join(data.result() for data in slices)
+
+    def upload_container(self, container, window):
+        """sends one filled container and commits the files in it, returns its report"""
+        try:
+            with self.pool.connection(*self.name_node) as name_node_conn:
+                container_id, data_nodes = name_node_conn.root.NameNodeService().allocate_container()
+            data_nodes = [tuple(data_node) for data_node in data_nodes]
+            report = {'block_id': container_id, 'data_node': data_nodes[0], 'files': len(container.files),
+                      'bytes': container.size, 'attempts': 0, 'stored': False, 'replicas': 0,
+                      'expected_replicas': len(data_nodes) - 1, 'success': False}
+            with container.view() as view:
+                report['codec'], payload = self.compressor.submit(view).result()
+                acks, report['attempts'] = self.send_with_retries(
+                    container_id, data_nodes[0], payload, '', data_nodes[1:])
+            report['stored'] = acks > 0
+            report['replicas'] = max(acks - 1, 0)
+            report['under_replicated'] = report['stored'] and report['replicas'] < report['expected_replicas']
+            if report['stored']:
+                # the copies that acknowledged, the pipeline stops at its first failed node
+                with self.pool.connection(*self.name_node) as name_node_conn:
+                    name_node_conn.root.NameNodeService().commit_container(
+                        container_id, tuple(data_nodes[:acks]), report['codec'], tuple(container.files))
+            report['success'] = report['stored'] and not report['under_replicated']
+            return report
+        finally:
+            window.release()
+
+    def upload_block(self, block_view, destination):
+        """places and sends one block of a streamed file, returns its report
+           a block no data node stored is placed once more under a new id, the bytes of a stream
+           can not be read again
+        """
+        for placement in range(2):
+            with self.pool.connection(*self.name_node) as name_node_conn:
+                block_id, data_nodes = name_node_conn.root.NameNodeService().allocate_block()
+            data_nodes = [tuple(data_node) for data_node in data_nodes]
+            report = {'block_id': block_id, 'data_node': data_nodes[0], 'bytes': len(block_view), 'attempts': 0,
+                      'stored': False, 'replicas': 0, 'expected_replicas': len(data_nodes) - 1, 'success': False}
+            report['codec'], payload = self.compressor.submit(block_view).result()
+            acks, report['attempts'] = self.send_with_retries(block_id, data_nodes[0], payload, destination,
+                                                              data_nodes[1:])
+            report['stored'] = acks > 0
+            report['replicas'] = max(acks - 1, 0)
+            # the copies that acknowledged, the pipeline stops at its first failed node
+            report['data_nodes'] = tuple(data_nodes[:acks])
+            report['under_replicated'] = report['stored'] and report['replicas'] < report['expected_replicas']
+            report['success'] = report['stored'] and not report['under_replicated']
+            if report['stored']:
+                break
+        return report
+
+    def commit_stream(self, destination, report, append=False, base_block=None, rewrite_last=False, size=None):
+        """records the blocks of a StreamWriter, see NameNode commit_blocks, size is the length of the
+           whole file once committed
+           raises BlockUploadError if a block could not be stored, nothing is committed then, or
+           if one is short of replicas, it is committed and the NameNode re-replicates it
+        """
+        lost = [result for result in report if not result['stored']]
+        if lost:
+            raise BlockUploadError(
+                f"Failed to store {len(lost)} of {len(report)} block(s) of {destination}: {lost}", report)
+        with self.pool.connection(*self.name_node) as name_node_conn:
+            name_node_conn.root.NameNodeService().commit_blocks(
+                destination,
+                tuple((result['block_id'], result['data_nodes'][0]) for result in report),
+                tuple((result['block_id'], data_node) for result in report for data_node in result['data_nodes'][1:]),
+                tuple((result['block_id'], result['codec']) for result in report if result['codec'] != 'none'),
+                append, base_block, rewrite_last, size)
+        failed = [result for result in report if not result['success']]
+        if failed:
+            raise BlockUploadError(
+                f"{len(failed)} of {len(report)} block(s) of {destination} are under replicated: {failed}", report)
+
+    def open_write(self, destination, append=False):
+        """returns a StreamWriter of destination, the file (or what append adds to it) becomes
+           visible when it is closed, use it as a context manager
+        """
+        return StreamWriter(self, destination, append)
+
+    def append(self, destination):
+        """StreamWriter adding to the end of the existing file destination"""
+        return self.open_write(destination, append=True)
+
+    def put_many(self, files):
+        """stores many (local_path, destination) pairs
+           1) files up to small_file_bytes are packed into containers of block_size, a container
+              costs one upload and two NameNode calls however many files it holds
+           2) containers are filled in this thread while up to max_in_flight of them upload
+           3) files of a container become visible once it is stored, larger files go through
+              create_file
+           returns the per container reports, raises BlockUploadError after every container was
+           tried if one of them could not be stored
+        """
+        window = threading.BoundedSemaphore(self.max_in_flight)
+        futures = []
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            container = None
+            for local_path, destination in files:
+                if os.path.getsize(local_path) > min(self.small_file_bytes, self.block_size):
+                    self.create_file(local_path, destination)
+                    continue
+                if container is not None and container.add_file(local_path, destination):
+                    continue
+                if container is not None:
+                    futures.append(executor.submit(self.upload_container, container, window))
+                window.acquire()
+                container = Container(self.block_size)
+                container.add_file(local_path, destination)
+            if container is not None:
+                futures.append(executor.submit(self.upload_container, container, window))
+        report = [future.result() for future in futures]
+        failed = [result for result in report if not result['success']]
+        if failed:
+            raise BlockUploadError(f"Failed to upload {len(failed)} of {len(report)} container(s): {failed}", report)
+        return report
+
+    def get_many(self, paths):
+        """returns {path: bytes} of many files, located with one NameNode call
+           1) packed files sharing a container are cut out of one read of the whole container,
+              a lone packed file is a range read of its container
+           2) other files are read like read_file, everything in parallel up to read_ahead
+           raises FileNotFoundError if any of the paths does not exist
+        """
+        paths = list(dict.fromkeys(paths))
+        with self.pool.connection(*self.name_node) as name_node_conn:
+            entries = dict(name_node_conn.root.NameNodeService().get_file_table_entries(tuple(paths)))
+        missing = [path for path in paths if path not in entries]
+        if missing:
+            raise FileNotFoundError(f"File(s) not found: {missing}")
+        containers = {}  # container_id: (data_node, replica_blocks, codec, [(path, window)])
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.read_ahead) as executor:
+            for path in paths:
+                primary_blocks, replicas_by_block, codecs, stripes, windows = self.block_locations(entries[path])
+                if windows:
+                    block_id, data_node = primary_blocks[0]
+                    containers.setdefault(block_id, (data_node, replicas_by_block.get(block_id, []),
+                                                     codecs.get(block_id, 'none'), []))[3].append(
+                        (path, windows[block_id]))
+                else:
+                    results[path] = executor.submit(
+                        lambda *locations: b''.join(self.stream_blocks(*locations)),
+                        path, primary_blocks, replicas_by_block, codecs, stripes)
+            whole = {}
+            for container_id, (data_node, replica_blocks, codec, members) in containers.items():
+                if len(members) == 1:
+                    path, window = members[0]
+                    results[path] = executor.submit(self.read_block, container_id, data_node, replica_blocks,
+                                                    path, codec, window=window)
+                else:
+                    whole[container_id] = executor.submit(self.read_block, container_id, data_node, replica_blocks,
+                                                          members[0][0], codec)
+            files = {path: bytes(future.result()) for path, future in results.items()}
+            for container_id, future in whole.items():
+                data = future.result()
+                for path, (offset, length) in containers[container_id][3]:
+                    files[path] = bytes(data[offset:offset + length])
+        return {path: files[path] for path in paths}
+
+    def list(self, path, after='', limit=1000):
+        """one page of the directory path, up to limit (name, size, created_at) in name order past
+           the name after, a subdirectory is ('name/', None, None)
+        """
+        with self.pool.connection(*self.name_node) as name_node_conn:
+            entries = name_node_conn.root.NameNodeService().list(path, after, limit)
+        if entries is None:
+            raise FileNotFoundError(f"Directory not found: {path}")
+        return [tuple(entry) for entry in entries]
+
+    def iter_list(self, path, page_size=1000):
+        """every entry of the directory path, fetched page_size at a time"""
+        after = ''
+        while True:
+            entries = self.list(path, after, page_size)
+            yield from entries
+            if len(entries) < page_size:
+                return
+            after = entries[-1][0]
+
+    def stat(self, path):
+        """{'type': 'file' or 'directory', 'size', 'created_at', 'blocks'} of path"""
+        with self.pool.connection(*self.name_node) as name_node_conn:
+            row = name_node_conn.root.NameNodeService().stat(path)
+        if row is None:
+            raise FileNotFoundError(f"File not found: {path}")
+        return dict(zip(('type', 'size', 'created_at', 'blocks'), row))
+
+    def delete(self, path):
+        """removes the file path, False if there is none, data nodes reclaim its blocks later"""
+        with self.pool.connection(*self.name_node) as name_node_conn:
+            return name_node_conn.root.NameNodeService().delete(path)
+
+    def delete_recursive(self, path, batch_size=1000):
+        """removes path and every file below it batch_size files per call, returns how many"""
+        with self.pool.connection(*self.name_node) as name_node_conn:
+            service = name_node_conn.root.NameNodeService()
+            deleted = int(service.delete(path))
+            while True:
+                count = service.delete_recursive(path, batch_size)
+                if not count:
+                    return deleted
+                deleted += count
+
+    def cache_stats(self):
+        return self.block_cache.stats() if self.block_cache is not None else {}
+
+    def replica_stats(self):
+        """moving averages of the read latency and error rate per data node"""
+        return self.latency.stats()
+
+    def read_file_to(self, source_path, local_path):
+        """streams source_path into local_path and returns the number of bytes written"""
+        written = 0
+        blocks = self.iter_blocks(source_path)
+        with open(local_path, 'wb') as f:
+            for data in blocks:
+                f.write(data)
+                written += len(data)
+        return written
 
 
 if __name__ == "__main__":
-    print("sys.argv", sys.argv)
     # if len(sys.argv) != 4:
     #     print("Usage: python client.py get <filename> <destination>")
     #     sys.exit(1)
@@ -133,24 +796,99 @@ if __name__ == "__main__":
     # Parse the configuration file
     config = configparser.ConfigParser()
     current_dir = os.path.dirname(os.path.abspath(__file__))
-    config.read(f'{current_dir}/config.ini')
+    config.read(os.environ.get('PYHDFS_CONFIG', f'{current_dir}/config.ini'))
+    setup_logging(config, 'client')
     name_node_server = config['name_node']['name_name_hosts'].split(':')
     block_size = int(config['name_node']['block_size'])
-    print("name_node_server: ", name_node_server)
-    host = name_node_server[0]
-    port = int(name_node_server[1])
-
-    name_node_client = FilesystemClient(block_size)
-
-    if sys.argv[1] == "get":
-        destination = sys.argv[2]
-        print(name_node_client.read_file(destination))
-    elif sys.argv[1] == "put":
-        file = sys.argv[2]
-        destination = sys.argv[3]
-        name_node_client.create_file(file, destination)
-    else:
-        print("Error")
+    max_in_flight = config.getint('client', 'max_in_flight_blocks', fallback=4)
+    max_retries = config.getint('client', 'max_block_retries', fallback=2)
+    read_ahead = config.getint('client', 'read_ahead_blocks', fallback=4)
+    transfer_port_offset = config.getint('data_node', 'transfer_port_offset', fallback=10000)
+
+    name_node_client = FilesystemClient(block_size, max_in_flight, max_retries, read_ahead, transfer_port_offset,
+                                        pool_from_config(config),
+                                        pool_from_config(config, connect=BlockTransferConnection),
+                                        name_node_server, compressor_from_config(config),
+                                        config.getboolean('client', 'dedup', fallback=False),
+                                        config.get('client', 'storage_policy', fallback='replication'),
+                                        config.getint('client', 'small_file_bytes', fallback=0) or None,
+                                        block_cache_from_config(config),
+                                        config.getboolean('client', 'short_circuit_reads', fallback=True),
+                                        config.getfloat('client', 'hedge_percentile', fallback=95),
+                                        config.getfloat('client', 'hedge_min_delay', fallback=0.01))
+
+    try:
+        if sys.argv[1] == "get":
+            destination = sys.argv[2]
+            if len(sys.argv) > 3:
+                written = name_node_client.read_file_to(destination, sys.argv[3])
+                print(f"Wrote {written} bytes to {sys.argv[3]}")
+            else:
+                for data in name_node_client.iter_blocks(destination):
+                    sys.stdout.buffer.write(data)
+                sys.stdout.buffer.flush()
+        elif sys.argv[1] == "range":
+            data = name_node_client.read_range(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+            sys.stdout.buffer.write(data)
+            sys.stdout.buffer.flush()
+        elif sys.argv[1] in ("put", "append") and (sys.argv[1] == "append" or sys.argv[2] == "-"):
+            # put - <destination> and append <destination> [<file>] stream stdin (or file) in
+            destination = sys.argv[3] if sys.argv[1] == "put" else sys.argv[2]
+            source = open(sys.argv[3], 'rb') if sys.argv[1] == "append" and len(sys.argv) > 3 else sys.stdin.buffer
+            try:
+                with source, name_node_client.open_write(destination, sys.argv[1] == "append") as writer:
+                    shutil.copyfileobj(source, writer, 1024 * 1024)
+            except BlockUploadError as e:
+                print(e)
+                sys.exit(1)
+            print(f"Stored {writer.written} bytes in {len(writer.report or ())} block(s)")
+        elif sys.argv[1] == "put":
+            file = sys.argv[2]
+            destination = sys.argv[3]
+            try:
+                # an optional 'replication' or 'rs-<k>-<m>' overrides storage_policy for this file
+                report = name_node_client.create_file(file, destination, sys.argv[4] if len(sys.argv) > 4 else None)
+            except BlockUploadError as e:
+                print(e)
+                sys.exit(1)
+            print(f"Stored {len(report)} block(s) with {sum(result['replicas'] for result in report)} replica copies")
+        elif sys.argv[1] == "putmany":
+            # putmany <destination directory> <file> [<file> ...]
+            directory = sys.argv[2].rstrip('/')
+            files = [(file, f"{directory}/{os.path.basename(file)}") for file in sys.argv[3:]]
+            try:
+                report = name_node_client.put_many(files)
+            except BlockUploadError as e:
+                print(e)
+                sys.exit(1)
+            print(f"Packed {sum(result['files'] for result in report)} file(s) into {len(report)} container(s)")
+        elif sys.argv[1] == "getmany":
+            # getmany <local directory> <path> [<path> ...]
+            for path, data in name_node_client.get_many(sys.argv[3:]).items():
+                with open(os.path.join(sys.argv[2], os.path.basename(path)), 'wb') as f:
+                    f.write(data)
+            print(f"Wrote {len(sys.argv) - 3} file(s) to {sys.argv[2]}")
+        elif sys.argv[1] == "ls":
+            for name, size, created_at in name_node_client.iter_list(sys.argv[2] if len(sys.argv) > 2 else '/'):
+                if size is None and name.endswith('/'):
+                    print(f"{'-':>14}  {'-':19}  {name}")
+                else:
+                    created = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(created_at))
+                    print(f"{'?' if size is None else size:>14}  {created}  {name}")
+        elif sys.argv[1] == "stat":
+            for key, value in name_node_client.stat(sys.argv[2]).items():
+                print(f"{key}: {value}")
+        elif sys.argv[1] == "rm":
+            # rm [-r] <path>
+            if sys.argv[2] == "-r":
+                print(f"Deleted {name_node_client.delete_recursive(sys.argv[3])} file(s)")
+            elif not name_node_client.delete(sys.argv[2]):
+                print(f"No such file: {sys.argv[2]}")
+                sys.exit(1)
+        else:
+            print("Error")
+    finally:
+        name_node_client.close()
 # python3 data_service/client.py put /Users/theflash/Desktop/s3/data_service/10mb-examplefile-com.txt /Users/theflash/Desktop/s3/data/tmp/dfs_data
 # python3 data_service/client.py get /Users/theflash/Desktop/s3/data/tmp/dfs_data
 # python3 data_service/name_node.py
@@ -0,0 +1,95 @@
+import logging
+import pickle
+import threading
+
+import rpyc
+
+logger = logging.getLogger('cluster_state')
+
+
+class ClusterState:
+    """live data nodes pushed by a single ZooKeeper watch
+       1) subscribes once on prefix and keeps path -> (data, version) in memory
+       2) events older than the version already applied are ignored, so a late event can
+          never bring back a node that expired
+       3) on_change(live_nodes) is called whenever the set of live (host, port) changes
+       4) the connection is served by this object's thread, a lost connection is reopened and
+          the snapshot taken on re-subscribe replaces the whole state
+    """
+
+    def __init__(self, zk_host, zk_port, prefix="/data_nodes", on_change=None, connect=rpyc.connect,
+                 reconnect_delay=1):
+        self.zk_host = zk_host
+        self.zk_port = int(zk_port)
+        self.prefix = prefix
+        self.on_change = on_change
+        self.connect = connect
+        self.reconnect_delay = reconnect_delay
+        self.lock = threading.Lock()
+        self.nodes = {}  # path: (data, version)
+        self.removed = {}  # path: version it was removed at
+        self.live = ()
+        self.connected = threading.Event()
+        self.stopped = threading.Event()
+        self.conn = None
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                conn = self.conn = self.connect(self.zk_host, port=self.zk_port)
+                _, snapshot = conn.root.watch(self.prefix, self.on_event)
+                self.reset(snapshot)
+                self.connected.set()
+                # incoming watch events are handled on this thread until the connection drops
+                conn.serve_all()
+            except Exception as e:
+                if not self.stopped.is_set():
+                    logger.warning("error occurred at cluster state watch: %s", e)
+            self.connected.clear()
+            self.stopped.wait(self.reconnect_delay)
+
+    def stop(self):
+        self.stopped.set()
+        if self.conn is not None:
+            self.conn.close()
+
+    def reset(self, snapshot):
+        with self.lock:
+            self.nodes = {path: (pickle.loads(data), version) for path, data, version in snapshot}
+            self.removed = {}
+        self.changed()
+
+    def on_event(self, event, path, data, version):
+        with self.lock:
+            known = self.nodes.get(path, (None, self.removed.get(path, 0)))[1]
+            if version <= known:
+                return
+            if event in ('expired', 'deleted'):
+                self.nodes.pop(path, None)
+                self.removed[path] = version
+            else:
+                self.nodes[path] = (pickle.loads(data), version)
+                self.removed.pop(path, None)
+        self.changed()
+
+    def changed(self):
+        with self.lock:
+            live = tuple(sorted((data['host'], data['port']) for data, _ in self.nodes.values()))
+            if live == self.live:
+                return
+            self.live = live
+        logger.info("Updated data node connections: %s", live)
+        if self.on_change is not None:
+            self.on_change(live)
+
+    def live_nodes(self):
+        return self.live
+
+    def node_data(self):
+        """path -> decoded znode data of every live node"""
+        with self.lock:
+            return {path: data for path, (data, _) in self.nodes.items()}
@@ -0,0 +1,89 @@
+"""Per block compression for the client write and read paths.
+
+Codecs are named in metadata per block, 'none' means the block is stored verbatim:
+
+    zlib   level 6, good ratio on text and logs at moderate CPU cost
+    lzma   preset 1, best ratio, slowest
+    lz4    fastest, only when the optional lz4 package is installed
+"""
+
+import lzma
+import os
+import zlib
+from concurrent.futures import Future, ProcessPoolExecutor
+
+try:
+    import lz4.frame
+except ImportError:  # optional fast codec
+    lz4 = None
+
+CODECS = {
+    'zlib': (lambda data: zlib.compress(data, 6), zlib.decompress),
+    'lzma': (lambda data: lzma.compress(data, preset=1), lzma.decompress),
+}
+if lz4 is not None:
+    CODECS['lz4'] = (lz4.frame.compress, lz4.frame.decompress)
+
+
+def compress_block(data, codec, sample_size, max_ratio):
+    """returns (codec, payload), ('none', data) when a sample of the block or the whole block
+       does not shrink below max_ratio of its size
+       runs in the worker processes, so it must stay a module level function
+    """
+    compress = CODECS[codec][0]
+    sample = data[:sample_size]
+    if not sample or len(compress(sample)) > max_ratio * len(sample):
+        return 'none', data
+    payload = compress(data)
+    if len(payload) > max_ratio * len(data):
+        return 'none', data
+    return codec, payload
+
+
+def decompress_block(data, codec):
+    if codec == 'none':
+        return data
+    if codec not in CODECS:
+        raise ValueError(f"Block codec {codec} is not available, is its package installed?")
+    return CODECS[codec][1](data)
+
+
+class BlockCompressor:
+    """compresses blocks in a process pool so the write path scales across cores
+       1) submit returns a future of (codec, payload) right away, the client queues it and
+          the pool works ahead while earlier blocks are on the wire
+       2) with codec 'none' the block view is passed through without a copy
+    """
+
+    def __init__(self, codec='zlib', sample_size=64 * 1024, max_ratio=0.9, workers=None):
+        if codec != 'none' and codec not in CODECS:
+            raise ValueError(f"Unknown or unavailable codec {codec}, choose one of {['none', *CODECS]}")
+        self.codec = codec
+        self.sample_size = sample_size
+        self.max_ratio = max_ratio
+        self.workers = workers or os.cpu_count()
+        self.executor = None
+
+    def submit(self, block_view):
+        if self.codec == 'none':
+            future = Future()
+            future.set_result(('none', block_view))
+            return future
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self.executor.submit(compress_block, block_view.tobytes(), self.codec, self.sample_size,
+                                    self.max_ratio)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+def compressor_from_config(config):
+    """builds a BlockCompressor from the compression options of the [client] section"""
+    return BlockCompressor(
+        codec=config.get('client', 'compression', fallback='none'),
+        sample_size=config.getint('client', 'compression_sample_bytes', fallback=64 * 1024),
+        max_ratio=config.getfloat('client', 'compression_max_ratio', fallback=0.9),
+        workers=config.getint('client', 'compression_workers', fallback=0) or None)
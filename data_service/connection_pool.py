@@ -0,0 +1,165 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import rpyc
+
+
+class PoolExhaustedError(Exception):
+    pass
+
+
+class ConnectionPool:
+    """long lived rpyc connections keyed by (host, port)
+       1) at most max_per_host connections per key are open or borrowed at the same time
+       2) a connection idle for longer than health_check_after is pinged before it is handed out
+       3) connections idle for longer than idle_timeout are closed on the next acquire/release
+       4) a connection that failed at the transport level is thrown away, the next borrower reconnects
+    """
+
+    def __init__(self, max_per_host=8, idle_timeout=60, health_check_after=5, acquire_timeout=30,
+                 connect=rpyc.connect):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.health_check_after = health_check_after
+        self.acquire_timeout = acquire_timeout
+        self.connect = connect
+        self.lock = threading.Lock()
+        self.idle = {}  # (host, port): deque of (connection, last_used)
+        self.slots = {}  # (host, port): semaphore of max_per_host
+        self.in_use = 0
+        self.counters = {'created': 0, 'reused': 0,
+                         'discarded': 0, 'evicted': 0, 'failed_health_checks': 0}
+
+    def host_slots(self, key):
+        with self.lock:
+            if key not in self.slots:
+                self.slots[key] = threading.BoundedSemaphore(self.max_per_host)
+                self.idle[key] = deque()
+            return self.slots[key]
+
+    def evict_idle(self):
+        now = time.time()
+        expired = []
+        with self.lock:
+            for connections in self.idle.values():
+                # oldest connections sit on the left
+                while connections and now - connections[0][1] > self.idle_timeout:
+                    expired.append(connections.popleft()[0])
+            self.counters['evicted'] += len(expired)
+        for conn in expired:
+            self.close_quietly(conn)
+
+    def is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.time() - last_used < self.health_check_after:
+            return True
+        try:
+            conn.ping(timeout=self.health_check_after)
+            return True
+        except Exception:
+            with self.lock:
+                self.counters['failed_health_checks'] += 1
+            return False
+
+    def acquire(self, host, port):
+        key = (host, int(port))
+        slots = self.host_slots(key)
+        if not slots.acquire(timeout=self.acquire_timeout):
+            raise PoolExhaustedError(
+                f"No connection to {host}:{port} became free within {self.acquire_timeout}s")
+        try:
+            self.evict_idle()
+            while True:
+                with self.lock:
+                    if not self.idle[key]:
+                        break
+                    conn, last_used = self.idle[key].pop()
+                if self.is_healthy(conn, last_used):
+                    with self.lock:
+                        self.counters['reused'] += 1
+                        self.in_use += 1
+                    return conn
+                self.discard(conn)
+            conn = self.connect(host, port=int(port))
+            with self.lock:
+                self.counters['created'] += 1
+                self.in_use += 1
+            return conn
+        except Exception:
+            slots.release()
+            raise
+
+    def release(self, host, port, conn):
+        key = (host, int(port))
+        if conn.closed:
+            self.discard(conn)
+        else:
+            with self.lock:
+                self.idle[key].append((conn, time.time()))
+        with self.lock:
+            self.in_use -= 1
+        self.slots[key].release()
+        self.evict_idle()
+
+    def discard(self, conn):
+        with self.lock:
+            self.counters['discarded'] += 1
+        self.close_quietly(conn)
+
+    def discard_and_release(self, host, port, conn):
+        self.discard(conn)
+        with self.lock:
+            self.in_use -= 1
+        self.slots[(host, int(port))].release()
+
+    @contextmanager
+    def connection(self, host, port):
+        conn = self.acquire(host, port)
+        try:
+            yield conn
+        except (EOFError, OSError, TimeoutError):
+            # the connection may be half way through a request, never hand it out again
+            self.discard_and_release(host, port, conn)
+            raise
+        except Exception:
+            # a remote exception leaves the connection usable
+            self.release(host, port, conn)
+            raise
+        except BaseException:
+            self.discard_and_release(host, port, conn)
+            raise
+        else:
+            self.release(host, port, conn)
+
+    def close_quietly(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def close_all(self):
+        with self.lock:
+            connections = [conn for idle in self.idle.values() for conn, _ in idle]
+            for idle in self.idle.values():
+                idle.clear()
+        for conn in connections:
+            self.close_quietly(conn)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['idle'] = sum(len(idle) for idle in self.idle.values())
+            stats['in_use'] = self.in_use
+            return stats
+
+
+def pool_from_config(config, connect=rpyc.connect):
+    """builds a pool from the optional [connection_pool] section of config.ini"""
+    return ConnectionPool(
+        max_per_host=config.getint('connection_pool', 'max_per_host', fallback=8),
+        idle_timeout=config.getfloat('connection_pool', 'idle_timeout', fallback=60),
+        health_check_after=config.getfloat('connection_pool', 'health_check_after', fallback=5),
+        connect=connect)
@@ -1,6 +1,7 @@
-import mmap
+import logging
 import os
 import pickle
+import shutil
 import time
 import threading
 import uuid
@@ -8,65 +9,112 @@ import uuid
 import rpyc
 import sys
 
+from block_cache import BlockCache
+from block_store import FileBlockStore, LogBlockStore
+from block_transfer import BlockTransferConnection, BlockTransferServer
+from connection_pool import ConnectionPool, pool_from_config
+from metrics import REGISTRY, MetricsService, instrument, setup_logging
+
+logger = logging.getLogger('data_node')
+
 # DATA_DIR = '/Users/theflash/Desktop/s3/data/tmp/dfs_data'
 
 
 class DataNodeService(rpyc.Service):
-    class exposed_DataNodeService():
+    @instrument('data_node')
+    class exposed_DataNodeService(MetricsService):
         data_dir = ''
+        # shared by every instance, rpyc creates one instance per client call
+        pool = ConnectionPool()
+        session_id = None
+        registration_lock = threading.Lock()
+        # FileBlockStore or LogBlockStore, set in __main__ from storage_engine
+        store = None
 
         def __init__(self):
-            self.blocks = {}  # Dictionary to store blocks (block_id: data)
-            self.session_id = str(uuid.uuid4())   # if machine is working
-            self.zk = rpyc.connect(zk_servers[0], int(
-                zk_servers[1]))  # Connect to ZooKeeper
-            self.register_with_zookeeper()  # Register DataNode with ZooKeeper
-            self.start_heartbeat()  # Start sending heartbeats to the NameNode
+            with self.__class__.registration_lock:
+                if self.__class__.session_id is None:
+                    self.__class__.session_id = str(uuid.uuid4())   # if machine is working
+                    self.register_with_zookeeper()  # Register DataNode with ZooKeeper
+                    self.start_heartbeat()  # Start sending heartbeats to the NameNode
+                    self.start_block_reports()
 
         def exposed_stop(self):
             data_node_service.close()
 
+        def disk_usage(self):
+            """capacity and used bytes of the disk holding the blocks, placement weighs nodes by them"""
+            usage = shutil.disk_usage(self.store.root)
+            capacity = capacity_override or usage.total
+            return {'capacity': capacity, 'used': max(0, capacity - usage.free), 'rack': rack}
+
+        def data_node_info(self):
+            return {'host': host, 'port': port, 'timestamp': time.time(), 'session_id': self.session_id,
+                    **self.disk_usage()}
+
         def register_with_zookeeper(self):
-            data_node_info = {'host': host, 'port': port,
-                              'timestamp': time.time(), 'session_id': self.session_id}
-            self.zk.root.create_node(
-                f"/data_nodes/{host}:{port}", pickle.dumps(data_node_info), ephemeral=True)
+            with self.pool.connection(zk_servers[0], zk_servers[1]) as zk:
+                zk.root.create_node(
+                    f"/data_nodes/{host}:{port}", pickle.dumps(self.data_node_info()), ephemeral=True)
 
         def start_heartbeat(self):
             def heartbeat():
+                last_report = time.time()
                 while True:
-                    data_node_info = {'host': host, 'port': port, 'timestamp': time.time(
-                    ), 'session_id': self.session_id}
-                    self.zk.root.set_data(
-                        f"/data_nodes/{host}:{port}", pickle.dumps(data_node_info))
-                    time.sleep(5)  # Send heartbeat every 5 seconds
+                    try:
+                        with self.pool.connection(zk_servers[0], zk_servers[1]) as zk:
+                            alive = zk.root.touch(f"/data_nodes/{host}:{port}")
+                            if alive and time.time() - last_report >= usage_report_interval:
+                                # touch carries no data, disk usage is refreshed less often
+                                zk.root.set_data(f"/data_nodes/{host}:{port}", pickle.dumps(self.data_node_info()))
+                                last_report = time.time()
+                        if not alive:
+                            # the node expired or zookeeper restarted, register again
+                            self.register_with_zookeeper()
+                            last_report = time.time()
+                    except Exception as e:
+                        logger.warning("error occurred at heartbeat: %s", e)
+                    time.sleep(heartbeat_interval)
             threading.Thread(target=heartbeat, daemon=True).start()
 
+        def start_block_reports(self):
+            """reports the blocks removed since the last report to the NameNode and removes the
+               batch it answers with, blocks of deleted files; a full batch is followed by the next
+               report right away, an empty one waits block_report_interval
+            """
+            def report():
+                deleted = ()
+                while True:
+                    batch = ()
+                    try:
+                        with self.pool.connection(*name_node_server) as name_node:
+                            batch = name_node.root.NameNodeService().block_report(host, port, deleted)
+                        # acknowledged, the NameNode dropped their garbage rows
+                        deleted = ()
+                        if batch:
+                            batch = tuple((block_id, file_path) for block_id, file_path in batch)
+                            found = self.store.delete_many(batch)
+                            deleted = tuple(block_id for block_id, _ in batch)
+                            REGISTRY.inc('blocks_deleted_total', found)
+                            logger.info("deleted %s of %s block(s) of deleted files", found, len(batch))
+                    except Exception as e:
+                        logger.warning("error occurred at block report: %s", e)
+                        batch = ()
+                    if not batch:
+                        time.sleep(block_report_interval)
+            threading.Thread(target=report, daemon=True).start()
+
         def exposed_store_block(self, block_id, data, destination):
             try:
-                print(f"block_id {block_id} DATA_DIR {destination}")
-                path = f"{os.getcwd()}/{destination}/{port}/"
-                if not os.path.isdir(path):
-                    os.makedirs(path, exist_ok=True)
-                # Write data to a file named after the block ID
-                with open(f"{os.path.join(path, block_id)}.txt", 'wb') as f:
-                    # Create a memory map for writing
-                    f.write(data)
-                self.blocks[block_id] = data
+                logger.debug("storing block %s under %s", block_id, destination)
+                self.store.put(block_id, destination, data)
                 return "Block stored successfully"
             except Exception as e:
                 return f"Failed to store block: {e}"
 
         def exposed_get_block(self, block_id, source_path):
-            print("block_id: ", block_id)
-            try:
-                path = f"{os.getcwd()}/{source_path}/{port}/"
-                with open(f"{os.path.join(path, block_id)}.txt", 'rb') as f:
-                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
-                        # Return the contents of the memory-mapped file
-                        return mm[:]
-            except FileNotFoundError:
-                return None
+            logger.debug("reading block %s", block_id)
+            return self.store.read(block_id, source_path)
 
 
 # Start the server
@@ -80,16 +128,52 @@ if __name__ == "__main__":
     import configparser
     config = configparser.ConfigParser()
     current_dir = os.path.dirname(os.path.abspath(__file__))
-    config.read(f'{current_dir}/config.ini')
+    config.read(os.environ.get('PYHDFS_CONFIG', f'{current_dir}/config.ini'))
+    setup_logging(config, 'data_node')
     # data_node_dir = config['data_node'][f'data_node_dir_{sys.argv[2]}']
     data_node_servers = config['data_node']['data_node_hosts'].split(',')
     data_node_server = data_node_servers[data_node_index].split(":")
     zk_servers = config['zookeeper']['zookeeper_hosts'].split(':')
+    heartbeat_interval = config.getfloat('data_node', 'heartbeat_interval', fallback=2)
+    usage_report_interval = config.getfloat('data_node', 'usage_report_interval', fallback=30)
+    block_report_interval = config.getfloat('data_node', 'block_report_interval', fallback=10)
+    name_node_host, name_node_port = config['name_node']['name_name_hosts'].split(':')
+    name_node_server = (name_node_host, int(name_node_port))
     host = data_node_server[0]
     port = int(data_node_server[1])
-    print(f"DataNode server started at {host}:{port}")
-    DataNodeService.exposed_DataNodeService()
+    rack = config.get('data_node', f'rack_{port}', fallback=None)
+    capacity_override = config.getint('data_node', f'capacity_{port}', fallback=None)
+    logger.info("DataNode server started at %s:%s", host, port)
+    DataNodeService.exposed_DataNodeService.pool = pool_from_config(config)
+    block_cache = BlockCache(config.getint('data_node', 'block_cache_bytes', fallback=64 * 1024 * 1024))
+    storage_engine = config.get('data_node', 'storage_engine', fallback='file')
+    if storage_engine == 'log':
+        store = LogBlockStore(
+            f"{os.getcwd()}/blocks/{port}", block_cache,
+            segment_bytes=config.getint('data_node', 'segment_bytes', fallback=256 * 1024 * 1024),
+            sync=config.getboolean('data_node', 'sync_writes', fallback=True),
+            compact_ratio=config.getfloat('data_node', 'compact_ratio', fallback=0.5),
+            compact_interval=config.getfloat('data_node', 'compact_interval', fallback=60))
+    elif storage_engine == 'file':
+        store = FileBlockStore(os.getcwd(), port, block_cache)
+    else:
+        raise ValueError(f"unknown storage_engine {storage_engine}")
+    DataNodeService.exposed_DataNodeService.store = store
+    data_node = DataNodeService.exposed_DataNodeService()
+    # block payloads travel over the binary channel, rpyc only carries control calls
+    transfer_port_offset = config.getint('data_node', 'transfer_port_offset', fallback=10000)
+    transfer_server = BlockTransferServer(
+        ('', port + transfer_port_offset), store,
+        pool_from_config(config, connect=BlockTransferConnection), transfer_port_offset,
+        config.getint('data_node', 'transfer_buffer_size', fallback=1048576))
+    threading.Thread(target=transfer_server.serve_forever, daemon=True).start()
+    REGISTRY.register_gauges('data_node_pool', DataNodeService.exposed_DataNodeService.pool.stats)
+    REGISTRY.register_gauges('transfer_pool', transfer_server.pool.stats)
+    REGISTRY.register_gauges('data_node_disk', data_node.disk_usage)
+    REGISTRY.register_gauges('block_store', store.stats)
+    REGISTRY.register_gauges('block_cache', block_cache.stats)
+    logger.info("DataNode block transfer started at %s:%s", host, port + transfer_port_offset)
     from rpyc.utils.server import ThreadedServer
-    data_node_service = ThreadedServer(DataNodeService, port=port)
+    data_node_service = ThreadedServer(DataNodeService, port=port, logger=logging.getLogger('rpyc.data_node'))
     data_node_service.start()
-    print("DataNode server closed")
+    logger.info("DataNode server closed")
@@ -0,0 +1,118 @@
+"""Content addressed block ids for deduplicated puts.
+
+A deduplicated block is named after the SHA-256 of its uncompressed bytes, so the same
+content always gets the same block id whichever file or client wrote it:
+
+    sha256-<64 hex digits>
+
+DataNodes keep such blocks in one directory per node instead of one per destination, and
+the metadata service counts the files referencing each block, so a block is only garbage
+once its last file is gone.
+"""
+
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+CONTENT_PREFIX = 'sha256-'
+
+
+def content_block_id(data):
+    return CONTENT_PREFIX + hashlib.sha256(data).hexdigest()
+
+
+def is_content_addressed(block_id):
+    return block_id.startswith(CONTENT_PREFIX)
+
+
+def hash_blocks(view, block_size, workers=4):
+    """content block ids of the block_size slices of view, in block order
+       hashlib releases the GIL on large buffers, so blocks are hashed on a thread pool
+    """
+    slices = [view[start:start + block_size] for start in range(0, len(view), block_size)]
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            return tuple(executor.map(content_block_id, slices))
+    finally:
+        for block_view in slices:
+            block_view.release()
+
+
+class DedupGuard:
+    """keeps the NameNode from deleting a content addressed block a put is about to use
+       1) create_dedup_blocks reserves the block ids of a put until commit_blocks releases
+          them or timeout seconds pass, block_report hands out no reserved id
+       2) an id handed out to a data node for deletion is deleting there until the node
+          acknowledges it or timeout seconds pass, no new copy of it is placed on that node
+       3) both live in memory, with held no content addressed block is handed out for
+          timeout seconds after start, puts that began before a restart may still commit
+    """
+
+    def __init__(self, timeout=3600, held=True):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.reserved = {}  # block_id: [puts, expiry]
+        self.deleting = {}  # block_id: {data node: expiry}
+        self.held_until = time.monotonic() + timeout if held else 0
+
+    def expire(self, now):
+        for block_id in [block_id for block_id, (_, expiry) in self.reserved.items() if expiry <= now]:
+            del self.reserved[block_id]
+        for block_id, nodes in list(self.deleting.items()):
+            for node in [node for node, expiry in nodes.items() if expiry <= now]:
+                del nodes[node]
+            if not nodes:
+                del self.deleting[block_id]
+
+    def reserve(self, block_ids):
+        """reserves block_ids, returns {block_id: data nodes deleting it} to place no copy on"""
+        with self.lock:
+            now = time.monotonic()
+            self.expire(now)
+            for block_id in set(block_ids):
+                reservation = self.reserved.setdefault(block_id, [0, 0])
+                reservation[0] += 1
+                reservation[1] = now + self.timeout
+            return {block_id: set(self.deleting[block_id]) for block_id in set(block_ids) if block_id in self.deleting}
+
+    def release(self, block_ids):
+        with self.lock:
+            for block_id in set(block_ids):
+                reservation = self.reserved.get(block_id)
+                if reservation is not None:
+                    reservation[0] -= 1
+                    if reservation[0] <= 0:
+                        del self.reserved[block_id]
+
+    def hand_out(self, node, block_ids, referenced):
+        """splits the garbage block_ids of node into (ids to delete now, ids still referenced),
+           referenced(ids) returns the referenced ones and runs under the lock, so no put
+           reserves an id between the check and the hand out; held ids are in neither
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.expire(now)
+            held = {block_id for block_id in block_ids if is_content_addressed(block_id)
+                    and (now < self.held_until or block_id in self.reserved)}
+            candidates = tuple(block_id for block_id in block_ids if block_id not in held)
+            in_use = set(referenced(candidates)) if candidates else set()
+            free = tuple(block_id for block_id in candidates if block_id not in in_use)
+            for block_id in free:
+                if is_content_addressed(block_id):
+                    self.deleting.setdefault(block_id, {})[node] = now + self.timeout
+            return free, tuple(in_use)
+
+    def acknowledge(self, node, block_ids):
+        """node deleted block_ids, new copies may go there again"""
+        with self.lock:
+            for block_id in block_ids:
+                nodes = self.deleting.get(block_id)
+                if nodes is not None:
+                    nodes.pop(node, None)
+                    if not nodes:
+                        del self.deleting[block_id]
+
+    def stats(self):
+        with self.lock:
+            return {'reserved_blocks': len(self.reserved), 'deleting_blocks': len(self.deleting)}
@@ -0,0 +1,204 @@
+"""Reed-Solomon erasure coding of file blocks, the alternative to replication_factor.
+
+A file written with policy 'rs-<k>-<m>' is cut into stripes of k data blocks, each stripe
+gets m parity blocks and every block of a stripe goes to a different data node. Any k
+blocks of a stripe rebuild the others, so the file survives the loss of m nodes at
+(k + m) / k times its size instead of replication_factor times.
+
+The policy is part of every block id, the metadata service stores erasure coded blocks
+like any primary block:
+
+    rs<k>+<m>-<stripe id>-<j>    j < k data block, k <= j < k + m parity block
+
+A parity block encodes every data block of its stripe prefixed with its 4 byte length and
+zero padded to the longest one, so a lost data block comes back with its exact length. The
+last stripe of a file may have fewer than k data blocks, the missing ones count as empty.
+
+GF(256) arithmetic runs on NumPy arrays when NumPy is installed, otherwise multiplying a
+block by a constant is a bytes.translate through a 256 byte table and additions are XORs
+of the blocks as big integers, both at C speed.
+"""
+
+import itertools
+import re
+import struct
+import uuid
+
+try:
+    import numpy
+except ImportError:  # optional, the bytes based fallback is used without it
+    numpy = None
+
+LENGTH_HEADER = struct.Struct('!I')
+BLOCK_ID = re.compile(r'^rs(\d+)\+(\d+)-(.+)-(\d+)$')
+POLICY = re.compile(r'^rs-(\d+)-(\d+)$')
+
+# GF(256) with the polynomial x^8 + x^4 + x^3 + x^2 + 1
+EXP = [0] * 512
+LOG = [0] * 256
+value = 1
+for power in range(255):
+    EXP[power] = value
+    LOG[value] = power
+    value <<= 1
+    if value & 0x100:
+        value ^= 0x11d
+for power in range(255, 512):
+    EXP[power] = EXP[power - 255]
+del value, power
+
+
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return EXP[LOG[a] + LOG[b]]
+
+
+def gf_inv(a):
+    if a == 0:
+        raise ZeroDivisionError("0 has no inverse in GF(256)")
+    return EXP[255 - LOG[a]]
+
+
+# MUL_TABLES[c] maps every byte x to c * x, a bytes.translate table
+MUL_TABLES = [bytes(gf_mul(c, x) for x in range(256)) for c in range(256)]
+MUL_ARRAY = numpy.frombuffer(b''.join(MUL_TABLES), dtype=numpy.uint8).reshape(256, 256) \
+    if numpy is not None else None
+
+
+def parse_policy(policy):
+    """(k, m) of an 'rs-<k>-<m>' policy, None for plain replication"""
+    if policy in (None, '', 'replication'):
+        return None
+    match = POLICY.match(policy)
+    if match is None:
+        raise ValueError(f"Unknown storage policy {policy}, use 'replication' or 'rs-<k>-<m>'")
+    k, m = int(match.group(1)), int(match.group(2))
+    if k < 1 or m < 1 or k + m > 255:
+        raise ValueError(f"Storage policy {policy} needs k >= 1, m >= 1 and k + m <= 255")
+    return k, m
+
+
+def erasure_block_id(k, m, stripe, j):
+    return f"rs{k}+{m}-{stripe}-{j}"
+
+
+def new_stripe_ids(k, m, data_blocks):
+    """block ids of one stripe holding data_blocks (<= k) data blocks, data before parity"""
+    stripe = uuid.uuid4().hex
+    return [erasure_block_id(k, m, stripe, j) for j in itertools.chain(range(data_blocks), range(k, k + m))]
+
+
+def parse_block_id(block_id):
+    """(k, m, stripe, j) of an erasure coded block id, None for any other block"""
+    match = BLOCK_ID.match(block_id)
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2)), match.group(3), int(match.group(4))
+
+
+def is_erasure_coded(block_id):
+    return BLOCK_ID.match(block_id) is not None
+
+
+def split_stripes(primary_blocks, codecs):
+    """for a file's blocks in stripe order returns (data_blocks, stripes), the data blocks in
+       file order and {data block id: ((block_id, data_node, codec), ...) of its whole stripe}
+    """
+    data_blocks = []
+    stripes = {}
+    for _, members in itertools.groupby(primary_blocks, key=lambda block: parse_block_id(block[0])[2]):
+        members = tuple((block_id, data_node, codecs.get(block_id, 'none')) for block_id, data_node in members)
+        for block_id, data_node, _ in members:
+            k, _, _, j = parse_block_id(block_id)
+            if j < k:
+                data_blocks.append((block_id, data_node))
+                stripes[block_id] = members
+    return tuple(data_blocks), stripes
+
+
+def combine(coefficients, shards, length):
+    """sum of coefficient * shard over GF(256), shards are bytes of the same length"""
+    if numpy is not None:
+        acc = numpy.zeros(length, dtype=numpy.uint8)
+        for c, shard in zip(coefficients, shards):
+            if c:
+                acc ^= MUL_ARRAY[c][numpy.frombuffer(shard, dtype=numpy.uint8)]
+        return acc.tobytes()
+    acc = 0
+    for c, shard in zip(coefficients, shards):
+        if c:
+            acc ^= int.from_bytes(shard if c == 1 else shard.translate(MUL_TABLES[c]), 'big')
+    return acc.to_bytes(length, 'big')
+
+
+def invert(matrix):
+    """inverse of a square matrix over GF(256) by Gauss-Jordan elimination"""
+    size = len(matrix)
+    rows = [list(row) + [int(i == j) for j in range(size)] for i, row in enumerate(matrix)]
+    for col in range(size):
+        pivot = next((r for r in range(col, size) if rows[r][col]), None)
+        if pivot is None:
+            raise ValueError("matrix is singular")
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        scale = gf_inv(rows[col][col])
+        rows[col] = [gf_mul(scale, x) for x in rows[col]]
+        for r in range(size):
+            if r != col and rows[r][col]:
+                factor = rows[r][col]
+                rows[r] = [x ^ gf_mul(factor, y) for x, y in zip(rows[r], rows[col])]
+    return [row[size:] for row in rows]
+
+
+class ReedSolomon:
+    """systematic Reed-Solomon code with k data and m parity shards
+       parity row i has the Cauchy coefficients 1 / ((k + i) ^ j), every k x k submatrix of
+       the identity stacked on them is invertible, so any k shards rebuild the stripe
+    """
+
+    def __init__(self, k, m):
+        self.k = k
+        self.m = m
+        self.parity_rows = [[gf_inv((k + i) ^ j) for j in range(k)] for i in range(m)]
+
+    def shard(self, block, length):
+        """a data block as encoded: its 4 byte length, its content and zeros up to length"""
+        return LENGTH_HEADER.pack(len(block)) + bytes(block) + bytes(length - len(block))
+
+    def encode(self, data_blocks):
+        """the m parity blocks of up to k data blocks (bytes or memoryviews)"""
+        length = max(len(block) for block in data_blocks)
+        shards = [self.shard(block, length)
+                  for block in itertools.chain(data_blocks, [b''] * (self.k - len(data_blocks)))]
+        return [combine(row, shards, LENGTH_HEADER.size + length) for row in self.parity_rows]
+
+    def reconstruct(self, blocks, data_count):
+        """blocks is {j: block} of the blocks read from a stripe with data_count data blocks,
+           any data_count of them rebuild it, returns its data blocks in order
+        """
+        parity = [block for j, block in blocks.items() if j >= self.k]
+        if all(j in blocks for j in range(data_count)):
+            return [bytes(blocks[j]) for j in range(data_count)]
+        if not parity:
+            raise ValueError("a lost data block needs at least one parity block")
+        length = len(parity[0]) - LENGTH_HEADER.size
+        shards = {}
+        for j, block in blocks.items():
+            shards[j] = bytes(block) if j >= self.k else self.shard(block, length)
+        for j in range(data_count, self.k):
+            # the last stripe's missing data blocks are empty
+            shards[j] = bytes(LENGTH_HEADER.size + length)
+        if len(shards) < self.k:
+            raise ValueError(f"{len(shards)} of the {self.k} blocks needed to rebuild the stripe")
+        chosen = sorted(shards)[:self.k]
+        matrix = [[int(j == col) for col in range(self.k)] if j < self.k else self.parity_rows[j - self.k]
+                  for j in chosen]
+        inverse = invert(matrix)
+        data = []
+        for j in range(data_count):
+            if j in blocks:
+                data.append(bytes(blocks[j]))
+                continue
+            shard = combine(inverse[j], [shards[c] for c in chosen], LENGTH_HEADER.size + length)
+            data.append(shard[LENGTH_HEADER.size:LENGTH_HEADER.size + LENGTH_HEADER.unpack_from(shard)[0]])
+        return data
@@ -0,0 +1,220 @@
+"""Metrics shared by the NameNode, DataNode, metadata and ZooKeeper services.
+
+Every process has one REGISTRY of counters, latency histograms and gauges read from
+callbacks (pool and cache stats). Services inherit MetricsService, which exposes:
+
+    metrics()         ((name, ((label, value), ...), value), ...) samples, shipped by value
+    metrics_text()    the same samples in the Prometheus text format
+    start_profiler()  starts sampling the stacks of every thread
+    stop_profiler()   stops it and returns the hottest stacks
+"""
+
+import bisect
+import collections
+import functools
+import logging
+import sys
+import threading
+import time
+import traceback
+
+# seconds, from sub millisecond calls to long block transfers
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            yield f"{name}_bucket", labels + (('le', '+Inf' if bound == float('inf') else repr(bound)),), cumulative
+        yield f"{name}_sum", labels, self.sum
+        yield f"{name}_count", labels, self.count
+
+
+class MetricsRegistry:
+    """counters and histograms keyed by name and a sorted tuple of label pairs"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(int)  # (name, labels): value
+        self.histograms = {}  # (name, labels): Histogram
+        self.gauges = {}  # prefix: callback returning {name: number}
+        self.types = {}
+
+    def inc(self, name, value=1, **labels):
+        key = name, tuple(sorted(labels.items()))
+        with self.lock:
+            self.types[name] = 'counter'
+            self.counters[key] += value
+
+    def observe(self, name, value, **labels):
+        key = name, tuple(sorted(labels.items()))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                self.types[name] = 'histogram'
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def register_gauges(self, prefix, callback):
+        """callback() returns {name: number}, read at every collection as prefix_name gauges"""
+        self.gauges[prefix] = callback
+
+    def collect(self):
+        with self.lock:
+            samples = [(name, labels, value) for (name, labels), value in sorted(self.counters.items())]
+            for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                samples.extend(histogram.samples(name, labels))
+            types = dict(self.types)
+        for prefix, callback in sorted(self.gauges.items()):
+            try:
+                values = callback()
+            except Exception as e:
+                logging.getLogger('metrics').warning("gauge %s failed: %s", prefix, e)
+                continue
+            for name, value in sorted(values.items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    samples.append((f"{prefix}_{name}", (), value))
+                    types[f"{prefix}_{name}"] = 'gauge'
+        return tuple(samples), types
+
+    def samples(self):
+        return self.collect()[0]
+
+    def prometheus_text(self):
+        samples, types = self.collect()
+        lines = []
+        typed = set()
+        for name, labels, value in samples:
+            base = name
+            if base not in types:
+                # a histogram's _bucket, _sum and _count samples share its TYPE line
+                for suffix in ('_bucket', '_sum', '_count'):
+                    if name.endswith(suffix) and name[:-len(suffix)] in types:
+                        base = name[:-len(suffix)]
+            if base not in typed:
+                typed.add(base)
+                lines.append(f"# TYPE {base} {types.get(base, 'untyped')}")
+            label_text = ','.join(f'{key}="{value}"' for key, value in labels)
+            lines.append(f"{name}{{{label_text}}} {value}" if labels else f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.types.clear()
+
+
+REGISTRY = MetricsRegistry()
+
+
+def timed(service, method, registry=REGISTRY):
+    """decorator recording rpc_seconds and rpc_errors_total for one exposed method"""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                registry.inc('rpc_errors_total', service=service, method=method)
+                raise
+            finally:
+                registry.observe('rpc_seconds', time.perf_counter() - start, service=service, method=method)
+        return wrapper
+    return decorate
+
+
+def instrument(service, registry=REGISTRY):
+    """class decorator timing every exposed_ method except the metrics ones"""
+    def decorate(cls):
+        for attr, value in list(vars(cls).items()):
+            if attr.startswith('exposed_') and callable(value) and not isinstance(value, type) \
+                    and attr not in MetricsService.__dict__:
+                setattr(cls, attr, timed(service, attr[len('exposed_'):], registry)(value))
+        return cls
+    return decorate
+
+
+class SamplingProfiler:
+    """samples the stack of every other thread every interval seconds and counts them"""
+
+    def __init__(self, interval=0.005, depth=8):
+        self.interval = interval
+        self.depth = depth
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = traceback.extract_stack(frame, limit=self.depth)
+                self.stacks[tuple(f"{entry.name} ({entry.filename.rsplit('/', 1)[-1]}:{entry.lineno})"
+                                  for entry in stack)] += 1
+            self.samples += 1
+
+    def stop(self, limit=20):
+        """stops sampling, returns ((count, stack text), ...) of the limit most sampled stacks"""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        return tuple((count, ' <- '.join(reversed(stack))) for stack, count in self.stacks.most_common(limit))
+
+
+class MetricsService:
+    """exposed metrics and profiler calls, mixed into every rpyc service"""
+    registry = REGISTRY
+    profiler = None
+    profiler_lock = threading.Lock()
+
+    def exposed_metrics(self):
+        return self.registry.samples()
+
+    def exposed_metrics_text(self):
+        return self.registry.prometheus_text()
+
+    def exposed_start_profiler(self, interval=0.005):
+        with MetricsService.profiler_lock:
+            if MetricsService.profiler is None:
+                MetricsService.profiler = SamplingProfiler(interval).start()
+                return True
+            return False
+
+    def exposed_stop_profiler(self, limit=20):
+        with MetricsService.profiler_lock:
+            profiler, MetricsService.profiler = MetricsService.profiler, None
+        return profiler.stop(limit) if profiler is not None else ()
+
+
+def setup_logging(config=None, section=None):
+    """leveled logging to stderr, the level comes from log_level of section (default INFO)"""
+    level = 'INFO'
+    if config is not None and section is not None:
+        level = config.get(section, 'log_level', fallback=level)
+    logging.basicConfig(level=getattr(logging, level.upper(), logging.INFO),
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    # rpyc logs every accepted connection at INFO
+    logging.getLogger('rpyc').setLevel(logging.WARNING)
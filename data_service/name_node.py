@@ -1,5 +1,5 @@
-import hashlib
-import json
+import functools
+import logging
 import math
 import os
 import uuid
@@ -8,43 +8,65 @@ import time
 import threading
 import random
 
+from block_transfer import BlockTransferConnection
+from cluster_state import ClusterState
+from connection_pool import ConnectionPool, pool_from_config
+from dedup import DedupGuard, is_content_addressed
+from erasure import new_stripe_ids, parse_policy
+from packing import new_container_id
+from namespace_cache import NamespaceCache
+from metrics import REGISTRY, MetricsService, instrument, setup_logging
+from placement import PlacementRing
+from replication import ReplicationManager
+from sharding import MetadataRouter, SLOTS, parse_hosts
+
+logger = logging.getLogger('name_node')
+
 
 class DirectoryExistsError(Exception):
     pass
 
 
 class NameNodeService(rpyc.Service):
-    class exposed_NameNodeService():
+    @instrument('name_node')
+    class exposed_NameNodeService(MetricsService):
         data_node_connections = []
         block_size = 0
-        metadata_servers = []
-
-        def __init__(self):
-            self.zk = rpyc.connect(zk_servers[0], int(
-                zk_servers[1]))  # Connect to ZooKeeper
-            self.data_node_watcher()  # Start the watcher for data nodes
+        # MetadataRouter over the metadata shards, see sharding.py
+        metadata = None
+        # shared by every instance, rpyc creates one instance per client call
+        pool = ConnectionPool()
+        namespace_cache = NamespaceCache()
+        # single ZooKeeper watch on /data_nodes, started once in __main__
+        cluster_state = None
+        # re-replicates the blocks of data nodes that left, see replication.py
+        replication = None
+        placement = PlacementRing()
+        replication_factor = 2
+        # commit_blocks checks and extends the blocks of a file under it, see there
+        append_lock = threading.Lock()
+        # blocks of deleted files stay on their data nodes this long, readers that fetched their
+        # locations just before the delete can still finish
+        gc_delay = 60
+        # most blocks a data node is told to delete per block report
+        gc_batch_size = 1000
+        # keeps deduplicated puts and block reports from racing on one block id, see dedup.py
+        dedup_guard = DedupGuard()
 
         def exposed_stop(self):
-            print("name_node_service", name_node_service)
+            logger.info("stop requested for %s", name_node_service)
             # name_node_service.close()
 
-        def data_node_watcher(self):
-            def watch():
-                last_data = None
-                while True:
-                    data = self.zk.root.exposed_get_all_data_nodes(
-                        "/data_nodes")
-                    print("exposed_get_all_data_nodes", data)
-                    if data != last_data:
-                        self.update_data_node_connections(data)
-                        last_data = data
-                    time.sleep(5)  # Simulate watching by sleeping
-
-            threading.Thread(target=watch, daemon=True).start()
+        @classmethod
+        def update_data_node_connections(cls, data_nodes):
+            cls.data_node_connections = data_nodes
+            if cls.replication is not None:
+                cls.replication.nodes_changed(data_nodes)
 
-        def update_data_node_connections(self, data_nodes):
-            self.__class__.data_node_connections = data_nodes
-            print("Updated data node connections:", data_nodes)
+        @classmethod
+        def invalidate_files(cls, paths):
+            for path in paths:
+                cls.namespace_cache.invalidate(path)
 
         def calc_num_blocks(self, file_size):
             return int(math.ceil(float(file_size) / self.__class__.block_size))
@@ -53,93 +75,447 @@ class NameNodeService(rpyc.Service):
             # Get all data nodes from the DataNodeService
             return self.__class__.data_node_connections
 
-        def select_primary_data_node(self, block_id, all_data_nodes):
-            # Implement your logic to select the primary data node using consistent hashing or any other method
-            # Convert block_id UUID to a unique integer using hash function
-            print("remaining data nodes: ", all_data_nodes)
-            block_id_int = int(hashlib.md5(block_id.encode()).hexdigest(), 16)
-            index = block_id_int % len(all_data_nodes)
-            return all_data_nodes[index]
+        def data_node_info(self):
+            """{(host, port): heartbeat data} of the live data nodes"""
+            if self.cluster_state is None:
+                return {node: None for node in self.get_all_data_nodes()}
+            return {(data['host'], data['port']): data for data in self.cluster_state.node_data().values()}
 
         def allocation_blocks(self, destination, num_blocks):
-            with rpyc.connect(self.__class__.metadata_servers[0], int(self.__class__.metadata_servers[1])) as metadata_server:
-                try:
-                    primary_blocks = []
-                    replica_blocks = []
-                    all_data_nodes = remaining_data_nodes = self.get_all_data_nodes()
-                    """if remaining_data_nodes does not take then all_data_nodes 
-                    will not get primary_data_node as replica data node in next iteration
-                    all_data_nodes [('localhost', 1801), ('localhost', 1802)]
-                    Data node index:  0
-                    all_data_nodes [('localhost', 1802)]
-                    Data node index:  0
-                    all_data_nodes [('localhost', 1802)]
-                    Data node index:  0
-                    all_data_nodes []
-                    """
-                    print(f"{'*'*25}Starting allocation blocks{'*'*25}")
-                    for i in range(0, num_blocks):
-                        block_id = str(uuid.uuid4())
-                        primary_data_node = self.select_primary_data_node(
-                            block_id, remaining_data_nodes)
-                        primary_blocks.append((block_id, primary_data_node))
-                        if replication_factor != 0 and len(self.__class__.data_node_connections) >= 2:
-                            # Replicate block to other data nodes
-                            replica_nodes = [
-                                node for node in all_data_nodes if node != primary_data_node]
-                            for rf in range(replication_factor-1):
-                                replica_data_node = self.select_primary_data_node(
-                                    block_id, replica_nodes)
-                                replica_blocks.append(
-                                    (block_id, replica_data_node))
-                                # excluding primary data node so next block should not go to same machine
-                                remaining_data_nodes = replica_nodes
+            """places num_blocks new blocks, nothing is recorded until commit_blocks"""
+            try:
+                primary_blocks = []
+                replica_blocks = []
+                self.placement.update(self.data_node_info())
+                copies = max(1, self.replication_factor)
+                if len(self.placement.weights) < copies:
+                    logger.warning(
+                        "Replicating data is not possible either replication_factor(%s) or availability of data node is %s.",
+                        self.replication_factor, len(self.placement.weights))
+                for i in range(0, num_blocks):
+                    block_id = str(uuid.uuid4())
+                    # primary first, replicas spread over other racks and hosts
+                    data_nodes = self.placement.select(block_id, copies)
+                    if not data_nodes:
+                        raise Exception("No data node available")
+                    primary_blocks.append((block_id, data_nodes[0]))
+                    replica_blocks.extend((block_id, data_node) for data_node in data_nodes[1:])
+                # tuples are shipped by value, lists would be netrefs costing a round trip per access
+                blocks = tuple(primary_blocks), tuple(replica_blocks), (), ()
+                REGISTRY.inc('blocks_allocated_total', num_blocks)
+                logger.debug("allocated %s block(s) for %s", num_blocks, destination)
+                return blocks
+            except Exception as e:
+                logger.error("error occurred at allocation_blocks: %s", e)
+                raise Exception(e)
+
+        def allocation_stripes(self, destination, num_blocks, k, m):
+            """erasure coded layout, every stripe of k data blocks plus m parity blocks goes to
+               k + m distinct data nodes, without replicas, nothing is recorded until commit_blocks
+            """
+            try:
+                primary_blocks = []
+                self.placement.update(self.data_node_info())
+                if len(self.placement.weights) < k + m:
+                    logger.warning(
+                        "Stripes of %s data and %s parity blocks need %s data nodes, only %s available, "
+                        "some nodes hold several blocks of a stripe.", k, m, k + m, len(self.placement.weights))
+                for first in range(0, num_blocks, k):
+                    block_ids = new_stripe_ids(k, m, min(k, num_blocks - first))
+                    data_nodes = self.placement.select(block_ids[0], len(block_ids))
+                    if not data_nodes:
+                        raise Exception("No data node available")
+                    primary_blocks.extend((block_id, data_nodes[j % len(data_nodes)])
+                                          for j, block_id in enumerate(block_ids))
+                blocks = tuple(primary_blocks), (), (), ()
+                REGISTRY.inc('blocks_allocated_total', len(primary_blocks))
+                logger.debug("allocated %s block(s) in stripes of %s+%s for %s",
+                             len(primary_blocks), k, m, destination)
+                return blocks
+            except Exception as e:
+                logger.error("error occurred at allocation_stripes: %s", e)
+                raise Exception(e)
+
+        def save_blocks(self, destination, blocks, size=None):
+            # an overwrite must never serve the old blocks, even if saving fails
+            self.namespace_cache.invalidate(destination)
+            self.metadata.save_file_blocks(destination, *blocks[:3], size)
+            self.namespace_cache.put(destination, blocks)
+            if self.replication is not None:
+                self.replication.add(destination, *blocks[:2])
+
+        def allocation_dedup_blocks(self, destination, block_ids, excluded=None):
+            """places a deduplicated file, nothing is recorded until commit_blocks
+               1) a block id with a copy on a live data node reuses its live copies, the primary
+                  copy first, and keeps the codec it was stored with
+               2) the other ids are placed like any block and returned in to_upload, a block
+                  repeated within the file is uploaded once
+               3) excluded maps block ids to the data nodes deleting them, no copy is reused
+                  or placed there
+               returns (primary_blocks, replica_blocks, codecs, windows, to_upload)
+            """
+            excluded = excluded or {}
+            try:
+                live = self.data_node_info()
+                self.placement.update(live)
+                copies = max(1, self.replication_factor)
+                stored = {}  # block_id: (live data nodes, codec)
+                for block_id, host, port, _, codec in self.metadata.find_blocks(tuple(set(block_ids))):
+                    if (host, port) in live and (host, port) not in excluded.get(block_id, ()):
+                        nodes, _ = stored.setdefault(block_id, ([], codec))
+                        if (host, port) not in nodes:
+                            nodes.append((host, port))
+                primary_blocks, replica_blocks, codecs, to_upload = [], [], {}, []
+                placed = {}
+                for index, block_id in enumerate(block_ids):
+                    if block_id not in placed:
+                        if block_id in stored:
+                            data_nodes, codec = stored[block_id]
+                            if codec != 'none':
+                                codecs[block_id] = codec
                         else:
-                            print(
-                                f"Replicating data is not possible either replication_factor({replication_factor}) or availability of data node is {len(self.__class__.data_node_connections)}.")
-                        print(
-                            f"primary_blocks: {primary_blocks} \nreplica_blocks: {replica_blocks}")
-                    metadata_server.root.save_file_blocks(
-                        destination, primary_blocks, replica_blocks)
-                    print(f"{'*'*25}Finished allocation blocks{'*'*25}")
-                    return primary_blocks, replica_blocks
-                except Exception as e:
-                    print(f"error occurred at allocation_blocks: {e}")
-                    raise Exception(e)
-                finally:
-                    print("closed metadata service....")
-                    # metadata_server.close()
+                            skip = excluded.get(block_id, ())
+                            data_nodes = [data_node for data_node in self.placement.select(block_id, copies + len(skip))
+                                          if data_node not in skip][:copies]
+                            if not data_nodes:
+                                raise Exception("No data node available")
+                            to_upload.append(index)
+                        placed[block_id] = data_nodes
+                        replica_blocks.extend((block_id, data_node) for data_node in data_nodes[1:])
+                    primary_blocks.append((block_id, placed[block_id][0]))
+                blocks = tuple(primary_blocks), tuple(replica_blocks), tuple(codecs.items()), ()
+                REGISTRY.inc('blocks_allocated_total', len(to_upload))
+                REGISTRY.inc('blocks_deduplicated_total', len(block_ids) - len(to_upload))
+                logger.debug("allocated %s of %s block(s) for %s", len(to_upload), len(block_ids), destination)
+                return blocks + (tuple(to_upload),)
+            except Exception as e:
+                logger.error("error occurred at allocation_dedup_blocks: %s", e)
+                raise Exception(e)
+
+        def entry_from_rows(self, rows):
+            """(primary_blocks, replica_blocks, codecs, windows) from metadata rows
+               (block_index, block_id, host, port, role, codec, block_offset, block_length)
+               ordered by block index, codecs holds (block_id, codec) of the compressed blocks
+               and windows (block_id, offset, length) of the files packed into containers
+            """
+            primary_blocks = tuple((row[1], (row[2], row[3])) for row in rows if row[4] == 'primary')
+            replica_blocks = tuple((row[1], (row[2], row[3])) for row in rows if row[4] == 'replica')
+            codecs = tuple((row[1], row[5]) for row in rows if row[4] == 'primary' and row[5] != 'none')
+            windows = tuple((row[1], row[6], row[7]) for row in rows if row[4] == 'primary' and row[7] is not None)
+            return primary_blocks, replica_blocks, codecs, windows
 
         def exposed_get_file_table_entry(self, fname):
-            with rpyc.connect(self.__class__.metadata_servers[0], int(self.__class__.metadata_servers[1])) as metadata_server:
-                try:
-                    blocks_detail = metadata_server.root.get_file_blocks(fname)
-                    print("blocks_detail", blocks_detail)
-                    if len(blocks_detail) > 0:
-                        return json.dumps(blocks_detail)
+            """(primary_blocks, replica_blocks, codecs, windows) of fname from the namespace cache
+               or the metadata service, see entry_from_rows
+            """
+            blocks = self.namespace_cache.get(fname)
+            if blocks is not None:
+                return self.prefer_live(blocks)
+            try:
+                rows = self.metadata.get_file_blocks(fname)
+                if rows is None:
                     return None
-                except Exception as e:
-                    print(
-                        f"error occurred at exposed_get_file_table_entry: {e}")
-                    raise Exception(e)
-                finally:
-                    print("closed metadata service....")
-                    # metadata_server.close()
+                blocks = self.entry_from_rows(rows)
+                self.namespace_cache.put(fname, blocks)
+                return self.prefer_live(blocks)
+            except Exception as e:
+                logger.error("error occurred at exposed_get_file_table_entry: %s", e)
+                raise Exception(e)
+
+        def prefer_live(self, blocks):
+            """serves a live replica as primary of the blocks whose primary data node left, until
+               the replication manager moved that copy elsewhere readers would first time out on it
+            """
+            live = set(self.get_all_data_nodes())
+            primary_blocks, replica_blocks = blocks[:2]
+            if all(tuple(data_node) in live for _, data_node in primary_blocks):
+                return blocks
+            replicas = {}
+            for block_id, data_node in replica_blocks:
+                if tuple(data_node) in live:
+                    replicas.setdefault(block_id, data_node)
+            primary_blocks = tuple((block_id, data_node if tuple(data_node) in live else replicas.get(block_id, data_node))
+                                   for block_id, data_node in primary_blocks)
+            return (primary_blocks,) + tuple(blocks[1:])
+
+        def exposed_get_file_table_entries(self, fnames):
+            """((fname, entry), ...) of the existing fnames, the ones missing from the namespace
+               cache are looked up with one metadata call
+            """
+            entries = []
+            missing = []
+            for fname in fnames:
+                blocks = self.namespace_cache.get(fname)
+                if blocks is None:
+                    missing.append(fname)
+                else:
+                    entries.append((fname, self.prefer_live(blocks)))
+            if not missing:
+                return tuple(entries)
+            try:
+                for fname, rows in self.metadata.get_files_blocks(tuple(missing)):
+                    blocks = self.entry_from_rows(rows)
+                    self.namespace_cache.put(fname, blocks)
+                    entries.append((fname, self.prefer_live(blocks)))
+                return tuple(entries)
+            except Exception as e:
+                logger.error("error occurred at exposed_get_file_table_entries: %s", e)
+                raise Exception(e)
+
+        def exposed_allocate_container(self):
+            """(container_id, data_nodes) for a container block of packed small files, nothing is
+               recorded until commit_container, the primary data node comes first
+            """
+            self.placement.update(self.data_node_info())
+            container_id = new_container_id()
+            data_nodes = tuple(self.placement.select(container_id, max(1, self.replication_factor)))
+            if not data_nodes:
+                raise Exception("No data node available")
+            return container_id, data_nodes
+
+        def exposed_commit_container(self, container_id, data_nodes, codec, files):
+            """makes the ((file_path, offset, length), ...) packed into an uploaded container visible"""
+            files = tuple((file_path, offset, length) for file_path, offset, length in files)
+            try:
+                for file_path, _, _ in files:
+                    self.namespace_cache.invalidate(file_path)
+                self.metadata.save_packed_files(
+                    container_id, tuple((host, int(port)) for host, port in data_nodes), codec, files)
+                REGISTRY.inc('packed_files_total', len(files))
+                REGISTRY.inc('containers_total')
+                if self.replication is not None and files:
+                    self.replication.add(files[0][0], ((container_id, data_nodes[0]),),
+                                         tuple((container_id, data_node) for data_node in data_nodes[1:]))
+            except Exception as e:
+                logger.error("error occurred at exposed_commit_container: %s", e)
+                raise Exception(e)
+
+        def exposed_allocate_block(self):
+            """(block_id, data_nodes) for the next block of a streamed file, nothing is recorded
+               until commit_blocks, the primary data node comes first
+            """
+            self.placement.update(self.data_node_info())
+            block_id = str(uuid.uuid4())
+            data_nodes = tuple(self.placement.select(block_id, max(1, self.replication_factor)))
+            if not data_nodes:
+                raise Exception("No data node available")
+            REGISTRY.inc('blocks_allocated_total')
+            return block_id, data_nodes
+
+        def exposed_commit_blocks(self, destination, primary_blocks, replica_blocks, codecs, append=False,
+                                  base_block=None, rewrite_last=False, size=None):
+            """makes the blocks of a file visible once they are stored, size is the length of the
+               whole file, codecs are ((block_id, codec), ...) of the compressed blocks
+               1) without append destination becomes exactly these blocks
+               2) with append they follow the blocks destination has, base_block is the last of
+                  them when the client opened it; rewrite_last drops it, the client wrote its
+                  bytes again at the start of the appended ones
+               3) an append fails if the last block of destination is no longer base_block,
+                  another writer appended meanwhile
+            """
+            primary_blocks = tuple((block_id, (host, int(port))) for block_id, (host, port) in primary_blocks)
+            replica_blocks = tuple((block_id, (host, int(port))) for block_id, (host, port) in replica_blocks)
+            codecs = tuple((block_id, codec) for block_id, codec in codecs)
+            try:
+                if not append:
+                    if self.check_directory(destination):
+                        raise DirectoryExistsError(f"The directory '{destination}' already exists.")
+                    self.save_blocks(destination, (primary_blocks, replica_blocks, codecs, ()), size)
+                    # referenced now, block reports may check their refcounts again
+                    self.dedup_guard.release(block_id for block_id, _ in primary_blocks)
+                    REGISTRY.inc('compressed_blocks_total', len(codecs))
+                    return
+                # appends to one file are serialized, the check of base_block and the save are atomic
+                with self.append_lock:
+                    rows = self.metadata.get_file_blocks(destination)
+                    if rows is None:
+                        raise FileNotFoundError(f"File not found: {destination}")
+                    kept, kept_replicas, kept_codecs, windows = self.entry_from_rows(rows)
+                    if (kept[-1][0] if kept else None) != base_block:
+                        raise Exception(f"{destination} was appended to concurrently, retry the append")
+                    if rewrite_last and kept:
+                        kept = kept[:-1]
+                        kept_replicas = tuple(replica for replica in kept_replicas if replica[0] != base_block)
+                    elif windows:
+                        raise ValueError("the container block of a packed file must be rewritten to append to it")
+                    self.save_blocks(destination, (kept + primary_blocks, kept_replicas + replica_blocks,
+                                                   kept_codecs + codecs, ()), size)
+                REGISTRY.inc('appends_total')
+            except Exception as e:
+                logger.error("error occurred at exposed_commit_blocks: %s", e)
+                raise Exception(e)
+
+        @staticmethod
+        def directory_prefix(path):
+            return path if not path or path.endswith('/') else path + '/'
+
+        def exposed_list(self, path, after='', limit=1000):
+            """up to limit (name, size, created_at) entries of the directory path in name order,
+               starting after the name after, a subdirectory is ('name/', None, None)
+               None if path is not a directory, '' or '/' list the root
+            """
+            prefix = self.directory_prefix(path)
+            entries = self.metadata.list_directory(prefix, after, max(1, limit))
+            if not entries and not after and prefix not in ('', '/') and not self.metadata.has_prefix(prefix):
+                return None
+            return entries
+
+        def exposed_stat(self, path):
+            """('file', size, created_at, blocks), ('directory', None, None, None) or None
+               size is None for files stored before sizes were recorded
+            """
+            row = self.metadata.stat_file(path)
+            if row is not None:
+                return ('file',) + tuple(row)
+            prefix = self.directory_prefix(path)
+            if prefix in ('', '/') or self.metadata.has_prefix(prefix):
+                return 'directory', None, None, None
+            return None
+
+        def exposed_delete(self, path):
+            """removes the file path, its blocks are reclaimed by block_report, False if there is none"""
+            deleted = self.metadata.delete_file(path)
+            self.namespace_cache.invalidate(path)
+            if deleted:
+                REGISTRY.inc('files_deleted_total')
+            return bool(deleted)
+
+        def exposed_delete_recursive(self, path, limit=1000):
+            """removes up to limit files below the directory path (per metadata shard), returns how
+               many, clients call it until it returns 0 so no single call holds a shard for long
+            """
+            paths = self.metadata.delete_prefix(self.directory_prefix(path), max(1, limit))
+            self.invalidate_files(paths)
+            REGISTRY.inc('files_deleted_total', len(paths))
+            return len(paths)
+
+        def exposed_block_report(self, host, port, deleted=()):
+            """called by each data node every block_report_interval
+               1) deleted are the block ids the node removed since its last report, their
+                  garbage rows go
+               2) returns the next ((block_id, file_path), ...) to delete, at most gc_batch_size
+                  blocks whose files were deleted more than gc_delay ago
+               3) a block a file on another metadata shard still references (a deduplicated
+                  block written again) is kept, its garbage row is dropped
+               4) a deduplicated block a put has reserved waits, see DedupGuard
+            """
+            node = (host, int(port))
+            deleted = tuple(deleted)
+            if deleted:
+                self.dedup_guard.acknowledge(node, deleted)
+                self.metadata.clear_garbage(node, deleted)
+                if self.replication is not None:
+                    self.replication.remove_copies(node, deleted)
+                REGISTRY.inc('blocks_reclaimed_total', len(deleted))
+            garbage = self.metadata.pending_garbage(node, time.time() - self.gc_delay, self.gc_batch_size)
+            if not garbage:
+                return ()
+            free, referenced = self.dedup_guard.hand_out(
+                node, tuple(block_id for block_id, _ in garbage),
+                lambda block_ids: [block_id for block_id, refcount in self.metadata.block_refcounts(block_ids)
+                                   if refcount > 0])
+            if referenced:
+                self.metadata.clear_garbage(node, referenced)
+            free = set(free)
+            return tuple((block_id, file_path) for block_id, file_path in garbage if block_id in free)
+
+        def exposed_live_data_nodes(self):
+            return tuple(self.get_all_data_nodes())
+
+        def exposed_rebalance(self, threshold=None):
+            """queues block moves evening out disk usage across data nodes, returns their number"""
+            if self.replication is None:
+                raise Exception("Replication manager is not running")
+            return self.replication.rebalance(threshold)
+
+        def exposed_replication_stats(self):
+            if self.replication is None:
+                return ()
+            return tuple(self.replication.stats().items())
+
+        def exposed_shard_map(self):
+            """((host, port, slots owned), ...) of the metadata shards"""
+            return self.metadata.shard_map()
+
+        def exposed_metadata_stats(self):
+            return tuple(self.metadata.stats().items())
+
+        def exposed_reshard(self, first_slot, last_slot, shard_index):
+            """moves slots first_slot..last_slot to metadata shard shard_index in the background,
+               returns the number of slots to move
+            """
+            if not 0 <= shard_index < len(self.metadata.shards):
+                raise ValueError(f"no metadata shard {shard_index}")
+            moves = tuple((slot, shard_index) for slot in range(max(0, first_slot), min(SLOTS, last_slot + 1))
+                          if self.metadata.owners[slot] != shard_index)
+            self.move_slots(moves)
+            return len(moves)
+
+        def exposed_balance_shards(self):
+            """moves slots in the background until every metadata shard owns as many, returns the
+               number of slots to move
+            """
+            moves = tuple(self.metadata.balance_plan())
+            self.move_slots(moves)
+            return len(moves)
+
+        def move_slots(self, moves):
+            if moves:
+                threading.Thread(target=self.metadata.move_slots, args=(moves,), daemon=True).start()
+
+        def exposed_cache_stats(self):
+            return tuple(self.namespace_cache.stats().items())
 
         def check_directory(self, directory):
             return os.path.exists(directory)
 
-        def exposed_create_blocks(self, destination, file_size):
+        def exposed_create_blocks(self, destination, file_size, policy='replication'):
+            """places the blocks of a file of file_size bytes, policy is 'replication'
+               (replication_factor copies) or 'rs-<k>-<m>' erasure coding
+               the file becomes visible when the client calls commit_blocks after the upload, with
+               the codec of every block, readers never see blocks that are not stored yet
+            """
             try:
                 if self.check_directory(destination):
                     raise DirectoryExistsError(
                         f"The directory '{destination}' already exists.")
                 num_blocks = self.calc_num_blocks(file_size)
-                primary_blocks, replica_nodes = self.allocation_blocks(
+                layout = parse_policy(policy)
+                if layout is not None:
+                    primary_blocks, replica_nodes, *_ = self.allocation_stripes(
+                        destination, num_blocks, *layout)
+                    return primary_blocks, replica_nodes
+                primary_blocks, replica_nodes, *_ = self.allocation_blocks(
                     destination, num_blocks)
                 return primary_blocks, replica_nodes
             except Exception as e:
-                print(f"error occurred at exposed_create_file: {e}")
+                logger.error("error occurred at exposed_create_file: %s", e)
+                raise Exception(e)
+
+        def exposed_create_dedup_blocks(self, destination, block_ids):
+            """like create_blocks for blocks named by their content (see dedup.py), only the
+               blocks no live data node holds yet have to be sent
+               returns (primary_blocks, replica_blocks, to_upload, codecs) with the block indices
+               to send and the codecs of the reused blocks, which go to commit_blocks as well
+            """
+            block_ids = tuple(block_ids)
+            try:
+                if self.check_directory(destination):
+                    raise DirectoryExistsError(
+                        f"The directory '{destination}' already exists.")
+                if not all(is_content_addressed(block_id) for block_id in block_ids):
+                    raise ValueError("deduplicated blocks must be named by their content hash")
+                # reserved until commit_blocks, block reports no longer hand these ids out
+                excluded = self.dedup_guard.reserve(block_ids)
+                try:
+                    primary_blocks, replica_nodes, codecs, _, to_upload = self.allocation_dedup_blocks(
+                        destination, block_ids, excluded)
+                except Exception:
+                    self.dedup_guard.release(block_ids)
+                    raise
+                return primary_blocks, replica_nodes, to_upload, codecs
+            except Exception as e:
+                logger.error("error occurred at exposed_create_dedup_blocks: %s", e)
                 raise Exception(e)
 
 
@@ -150,29 +526,66 @@ if __name__ == "__main__":
         import configparser
         config = configparser.ConfigParser()
         current_dir = os.path.dirname(os.path.abspath(__file__))
-        config.read(f'{current_dir}/config.ini')
+        config.read(os.environ.get('PYHDFS_CONFIG', f'{current_dir}/config.ini'))
+        setup_logging(config, 'name_node')
         data_node_servers = config['data_node']['data_node_hosts'].split(',')
         block_size = int(config['name_node']['block_size'])
-        metadata_servers = config['metadata']['metadata_hosts'].split(':')
+        metadata_servers = parse_hosts(config['metadata']['metadata_hosts'])
         zk_servers = config['zookeeper']['zookeeper_hosts'].split(':')
-        replication_factor = int(config['name_node']['replication_factor'])
         # Extract host-port pairs
         data_node_servers_detail = [(host, int(
             port)) for data_node_server in data_node_servers for host, port in [data_node_server.split(":")]]
-        print(f"{'*' * 25}Started Setting up configs{'*' * 25}")
-        print(
-            f"""Data node server details: {data_node_servers_detail}\nblock_size: {block_size} bytes\nmetadata_servers: {metadata_servers}""")
+        logger.info("Data node server details: %s, block_size: %s bytes, metadata_servers: %s",
+                    data_node_servers_detail, block_size, metadata_servers)
         NameNodeService.exposed_NameNodeService.data_node_connections = data_node_servers_detail
         NameNodeService.exposed_NameNodeService.block_size = block_size
-        NameNodeService.exposed_NameNodeService.metadata_servers = metadata_servers
-        NameNodeService.exposed_NameNodeService()
-        print(f"{'*'*25}Finished Setting up configs{'*'*25}")
+        NameNodeService.exposed_NameNodeService.replication_factor = int(config['name_node']['replication_factor'])
+        NameNodeService.exposed_NameNodeService.gc_delay = config.getfloat('name_node', 'gc_delay', fallback=60)
+        NameNodeService.exposed_NameNodeService.gc_batch_size = config.getint('name_node', 'gc_batch_size',
+                                                                              fallback=1000)
+        NameNodeService.exposed_NameNodeService.dedup_guard = DedupGuard(
+            config.getfloat('name_node', 'dedup_reservation_timeout', fallback=3600))
+        NameNodeService.exposed_NameNodeService.placement = PlacementRing(
+            vnodes=config.getint('name_node', 'placement_vnodes', fallback=100))
+        NameNodeService.exposed_NameNodeService.pool = pool_from_config(config)
+        NameNodeService.exposed_NameNodeService.metadata = MetadataRouter(
+            metadata_servers, NameNodeService.exposed_NameNodeService.pool).load()
+        NameNodeService.exposed_NameNodeService.namespace_cache = NamespaceCache(
+            max_entries=config.getint('name_node', 'cache_max_entries', fallback=100000),
+            max_bytes=config.getint('name_node', 'cache_max_bytes', fallback=64 * 1024 * 1024))
+        service = NameNodeService.exposed_NameNodeService
+        # copies may be throttled on purpose, a copy request waits replication_timeout for its answer
+        transfer_pool = pool_from_config(config, connect=functools.partial(
+            BlockTransferConnection, timeout=config.getfloat('name_node', 'replication_timeout', fallback=600)))
+        service.replication = ReplicationManager(
+            service.metadata, transfer_pool,
+            service.placement, service().data_node_info, service.replication_factor, block_size,
+            transfer_port_offset=config.getint('data_node', 'transfer_port_offset', fallback=10000),
+            workers=config.getint('name_node', 'replication_workers', fallback=8),
+            streams_per_node=config.getint('name_node', 'replication_streams_per_node', fallback=2),
+            bandwidth=config.getint('name_node', 'replication_bandwidth', fallback=0),
+            rebalance_threshold=config.getfloat('name_node', 'rebalance_threshold', fallback=0.1),
+            rebalance_on_join=config.getboolean('name_node', 'rebalance_on_join', fallback=False),
+            on_relocate=service.invalidate_files)
+        # the manager must exist before the first membership report
+        service.cluster_state = ClusterState(
+            zk_servers[0], zk_servers[1], on_change=service.update_data_node_connections).start()
+        service.replication.start()
+        REGISTRY.register_gauges('namespace_cache', service.namespace_cache.stats)
+        REGISTRY.register_gauges('name_node_pool', service.pool.stats)
+        REGISTRY.register_gauges('cluster', lambda: {'live_data_nodes': len(service.data_node_connections)})
+        REGISTRY.register_gauges('replication', service.replication.stats)
+        REGISTRY.register_gauges('metadata_router', service.metadata.stats)
+        REGISTRY.register_gauges('garbage', lambda: {'pending_blocks': service.metadata.garbage_count()})
+        REGISTRY.register_gauges('dedup_guard', service.dedup_guard.stats)
         from rpyc.utils.server import ThreadedServer
-        print("Name node server started")
+        name_node_port = int(config['name_node']['name_name_hosts'].split(':')[1])
+        logger.info("Name node server started on port %s", name_node_port)
         name_node_service = ThreadedServer(
-            NameNodeService, port=1800, auto_register=False)
+            NameNodeService, port=name_node_port, auto_register=False,
+            logger=logging.getLogger('rpyc.name_node'))
         name_node_service.start()
-        print("Name node server closed")
+        logger.info("Name node server closed")
     except Exception as e:
-        print(f"Exception occurred at Name Node Service: {e}")
+        logger.error("Exception occurred at Name Node Service: %s", e)
         raise Exception(e)
@@ -0,0 +1,75 @@
+import sys
+import threading
+from collections import OrderedDict
+
+
+class NamespaceCache:
+    """LRU cache of file path -> (primary_blocks, replica_blocks, codecs, windows)
+       1) files are write once and block ids never change, so an entry stays valid until the
+          path is overwritten or deleted
+       2) evicts the least recently used paths once max_entries or max_bytes is exceeded
+       3) the byte size of an entry is an estimate of the strings and tuples it holds
+    """
+
+    def __init__(self, max_entries=100000, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # path: (blocks, size)
+        self.total_bytes = 0
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def entry_size(self, path, blocks):
+        size = sys.getsizeof(path)
+        for block_list in blocks[:2]:
+            for block_id, data_node in block_list:
+                # the (block_id, (host, port)) tuples plus their strings
+                size += 120 + sys.getsizeof(block_id) + sys.getsizeof(data_node[0])
+        for block_id, codec in (blocks[2] if len(blocks) > 2 else ()):
+            size += 64 + sys.getsizeof(block_id) + sys.getsizeof(codec)
+        for window in (blocks[3] if len(blocks) > 3 else ()):
+            size += 120 + sys.getsizeof(window[0])
+        return size
+
+    def get(self, path):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+            self.entries.move_to_end(path)
+            self.counters['hits'] += 1
+            return entry[0]
+
+    def put(self, path, blocks):
+        size = self.entry_size(path, blocks)
+        with self.lock:
+            self.remove(path)
+            if size > self.max_bytes:
+                return
+            self.entries[path] = (blocks, size)
+            self.total_bytes += size
+            while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.counters['evictions'] += 1
+
+    def remove(self, path):
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.total_bytes -= entry[1]
+        return entry is not None
+
+    def invalidate(self, path):
+        with self.lock:
+            if self.remove(path):
+                self.counters['invalidations'] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            lookups = stats['hits'] + stats['misses']
+            stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+            stats['entries'] = len(self.entries)
+            stats['bytes'] = self.total_bytes
+            return stats
@@ -0,0 +1,47 @@
+"""Packing of small files into shared container blocks.
+
+A container is an ordinary replicated block named container-<uuid> that holds many small
+files back to back. Every packed file is a file in metadata with a single block, the
+container, whose rows carry the file's offset and length inside it, so a packed file is
+read as a byte range of its container. DataNodes keep containers under containers/<port>/
+whatever the destinations of the files in them.
+"""
+
+import os
+import uuid
+
+CONTAINER_PREFIX = 'container-'
+
+
+def new_container_id():
+    return CONTAINER_PREFIX + uuid.uuid4().hex
+
+
+def is_container(block_id):
+    return block_id.startswith(CONTAINER_PREFIX)
+
+
+class Container:
+    """a container block being filled, files are read straight into one preallocated buffer"""
+
+    def __init__(self, capacity):
+        self.buffer = bytearray(capacity)
+        self.size = 0
+        self.files = []  # (destination, offset, length)
+
+    def fits(self, length):
+        return self.size + length <= len(self.buffer)
+
+    def add_file(self, local_path, destination):
+        """appends local_path as destination, returns False if it does not fit"""
+        length = os.path.getsize(local_path)
+        if not self.fits(length):
+            return False
+        with open(local_path, 'rb') as f, memoryview(self.buffer) as view:
+            read = f.readinto(view[self.size:self.size + length])
+        self.files.append((destination, self.size, read))
+        self.size += read
+        return True
+
+    def view(self):
+        return memoryview(self.buffer)[:self.size]
@@ -0,0 +1,108 @@
+import bisect
+import hashlib
+import threading
+
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class PlacementRing:
+    """consistent hashing ring of data nodes with virtual nodes
+       1) a node gets vnodes points per reference_bytes of free space (capacity - used from
+          its heartbeat), so emptier and bigger nodes receive more blocks; nodes that do not
+          report their disk count as reference_bytes free
+       2) reference_bytes is taken from the first nodes seen and only rebased when the mean
+          free space drifts more than rebase_factor away, a node joining or leaving only adds
+          or removes its own points and moves about 1/N of the placements
+       3) select walks clockwise from the block id and spreads copies over distinct racks
+          first, then distinct hosts, then distinct nodes
+    """
+
+    def __init__(self, vnodes=100, reference_bytes=None, rebase_factor=4):
+        self.vnodes = vnodes
+        self.reference_bytes = reference_bytes
+        self.rebase_factor = rebase_factor
+        self.lock = threading.Lock()
+        self.weights = {}  # (host, port): number of points
+        self.racks = {}  # (host, port): rack
+        self.hashes = []
+        self.points = []  # node of each hash, same order
+        self.rack_count = 0
+        self.host_count = 0
+
+    def free_bytes(self, data):
+        if not data or data.get('capacity') is None:
+            return None
+        return max(0, data['capacity'] - data.get('used', 0))
+
+    def point_count(self, data):
+        free = self.free_bytes(data)
+        if free is None:
+            return self.vnodes
+        # a full node keeps no point at all, an almost full one keeps one
+        return max(1, round(self.vnodes * free / self.reference_bytes)) if free else 0
+
+    def update(self, nodes):
+        """nodes is {(host, port): heartbeat data}, the ring is only rebuilt if a node joined,
+           left, or its number of points changed
+        """
+        free = [f for f in map(self.free_bytes, nodes.values()) if f is not None]
+        mean_free = sum(free) / len(free) if free else 0
+        with self.lock:
+            if mean_free and (self.reference_bytes is None or
+                              not self.reference_bytes / self.rebase_factor <= mean_free
+                              <= self.reference_bytes * self.rebase_factor):
+                self.reference_bytes = mean_free
+            weights = {node: self.point_count(data) for node, data in nodes.items()}
+            racks = {node: (data or {}).get('rack') or node[0] for node, data in nodes.items()}
+            if weights == self.weights and racks == self.racks:
+                return False
+            points = sorted((ring_hash(f"{host}:{port}#{i}"), (host, port))
+                            for (host, port), count in weights.items() for i in range(count))
+            self.weights, self.racks = weights, racks
+            self.hashes = [h for h, _ in points]
+            self.points = [node for _, node in points]
+            live = [node for node, count in weights.items() if count]
+            self.rack_count = len({racks[node] for node in live})
+            self.host_count = len({node[0] for node in live})
+            return True
+
+    def candidates(self, key, count):
+        """distinct nodes in ring order from key, stops once count copies can be spread"""
+        seen = []
+        racks, hosts = set(), set()
+        total = len(self.points)
+        start = bisect.bisect(self.hashes, ring_hash(key))
+        for i in range(total):
+            node = self.points[(start + i) % total]
+            if node in seen:
+                continue
+            seen.append(node)
+            racks.add(self.racks[node])
+            hosts.add(node[0])
+            if (len(seen) >= count and len(racks) >= min(count, self.rack_count)
+                    and len(hosts) >= min(count, self.host_count)):
+                break
+        return seen
+
+    def select(self, key, count):
+        """up to count distinct nodes for key, the first one is the primary"""
+        with self.lock:
+            if not self.points:
+                return []
+            candidates = self.candidates(key, count)
+            chosen = []
+            racks, hosts = set(), set()
+            rules = (lambda node: self.racks[node] not in racks,
+                     lambda node: node[0] not in hosts,
+                     lambda node: True)
+            for rule in rules:
+                for node in candidates:
+                    if len(chosen) == count:
+                        return chosen
+                    if node not in chosen and rule(node):
+                        chosen.append(node)
+                        racks.add(self.racks[node])
+                        hosts.add(node[0])
+            return chosen
@@ -0,0 +1,117 @@
+"""Latency-aware choice of the copy of a block to read, and hedging of slow reads.
+
+NodeLatency keeps per data node a moving average of the read latency and of the error rate,
+errors fading with error_half_life so a node that recovered is tried again. Reads go to the
+copy with the lowest expected latency first, a node never read from counts as fast so it
+gets measured. When a read takes longer than the hedge_percentile latency of recent reads of
+about its size the client sends a second request to the next copy; the first answer wins
+and the other request is cancelled by shutting its connection down.
+"""
+
+import math
+import socket
+import threading
+import time
+from collections import deque
+
+
+class NodeLatency:
+    def __init__(self, alpha=0.2, error_penalty=10, error_half_life=30, window=1000):
+        self.alpha = alpha  # weight of the newest sample in the moving averages
+        self.error_penalty = error_penalty  # an error rate of 1 counts as error_penalty times slower
+        self.error_half_life = error_half_life  # seconds
+        self.lock = threading.Lock()
+        self.latency = {}  # node: moving average of successful reads, seconds
+        self.errors = {}  # node: (moving average of failures, time of the last update)
+        self.window = window
+        self.recent = {}  # size class: deque of the latencies of the latest reads on any node
+
+    def size_class(self, nbytes):
+        """reads within a factor of 4 in size share their percentiles"""
+        return nbytes.bit_length() // 2
+
+    def record(self, node, seconds, nbytes=0):
+        with self.lock:
+            previous = self.latency.get(node)
+            self.latency[node] = seconds if previous is None else previous + self.alpha * (seconds - previous)
+            self.recent.setdefault(self.size_class(nbytes), deque(maxlen=self.window)).append(seconds)
+            self.update_errors(node, 0)
+
+    def record_slow(self, node, seconds):
+        """a read cancelled after seconds took at least that long, it only moves the node's average"""
+        with self.lock:
+            previous = self.latency.get(node, 0.0)
+            if seconds > previous:
+                self.latency[node] = previous + self.alpha * (seconds - previous)
+
+    def record_error(self, node):
+        with self.lock:
+            self.update_errors(node, 1)
+
+    def error_rate(self, node, now=None):
+        """the caller holds lock"""
+        rate, updated = self.errors.get(node, (0.0, 0))
+        if not rate:
+            return 0.0
+        return rate * 0.5 ** (((now or time.monotonic()) - updated) / self.error_half_life)
+
+    def update_errors(self, node, failed):
+        now = time.monotonic()
+        rate = self.error_rate(node, now)
+        if failed or rate:
+            self.errors[node] = (rate + self.alpha * (failed - rate), now)
+
+    def score(self, node):
+        """expected latency of a read from node, a node without samples scores its error rate alone"""
+        with self.lock:
+            error_rate = self.error_rate(node)
+            return self.latency.get(node, 0.0) * (1 + self.error_penalty * error_rate) + error_rate
+
+    def order(self, nodes):
+        """nodes from the lowest score, ties keep their order (the primary first)"""
+        return sorted(nodes, key=self.score)
+
+    def percentile(self, percentile, nbytes=0):
+        """latency percentile of recent reads of about nbytes, None before the first one"""
+        with self.lock:
+            samples = sorted(self.recent.get(self.size_class(nbytes), ()))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, max(0, math.ceil(len(samples) * percentile / 100) - 1))]
+
+    def stats(self):
+        with self.lock:
+            stats = {f"latency_{host}:{port}": value for (host, port), value in self.latency.items()}
+            stats.update((f"error_rate_{host}:{port}", self.error_rate((host, port))) for host, port in self.errors)
+            return stats
+
+
+class ReadAttempt:
+    """one request of a hedged read, cancel() aborts it wherever it is"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.connection = None
+
+    def started(self, connection):
+        with self.lock:
+            if self.cancelled:
+                raise ConnectionAbortedError("read cancelled")
+            self.connection = connection
+
+    def finished(self):
+        """raises if cancel() shut the connection down, so the pool throws it away"""
+        with self.lock:
+            self.connection = None
+            if self.cancelled:
+                raise ConnectionAbortedError("read cancelled")
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            if self.connection is not None:
+                try:
+                    self.connection.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
@@ -0,0 +1,406 @@
+"""Re-replication of under-replicated blocks and rebalancing of data nodes, run by the NameNode.
+
+ReplicationManager keeps block id -> (a file path, data nodes holding it) for every block,
+loaded from the metadata service at start and updated as the NameNode allocates blocks.
+When a data node leaves, the blocks it held lose a copy and are queued, fewest live copies
+first. Worker threads have a live holder push each of them to new data nodes over the block
+transfer channel, the NameNode never sees the data, and record the new copies in metadata
+in place of the lost ones. A data node takes part in at most streams_per_node copies at a
+time, as source or target, so recovery runs on every node at once and gets faster as the
+cluster grows. Every copy stream is throttled to bandwidth bytes per second.
+
+rebalance moves blocks from data nodes above the mean disk usage to nodes below it once one
+of them is more than threshold away, e.g. after nodes were added. Moves wait for every
+re-replication and leave erasure coded blocks alone, a move could put two blocks of one
+stripe on the same node.
+
+The metadata service stays the source of truth, a task checks the copies of its block there
+before acting, so the map may lag behind deleted files.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+from collections import Counter
+
+from erasure import is_erasure_coded
+from metrics import REGISTRY
+
+logger = logging.getLogger('replication')
+
+REPLICATE = 'replicate'
+MOVE = 'move'
+# moves queue behind every re-replication, whose priority is its number of live copies
+MOVE_PRIORITY = 1 << 30
+# returned by assign when the nodes of a task have no free stream yet
+WAIT = object()
+
+
+class ReplicationManager:
+    def __init__(self, metadata, transfer_pool, placement, node_info, replication_factor, block_size,
+                 transfer_port_offset=10000, workers=8, streams_per_node=2, bandwidth=None, max_attempts=5,
+                 retry_delay=5, rebalance_threshold=0.1, rebalance_on_join=False, on_relocate=None):
+        self.metadata = metadata  # metadata service API, the NameNode's MetadataRouter
+        self.transfer_pool = transfer_pool  # of BlockTransferConnection
+        self.placement = placement
+        self.node_info = node_info  # () -> {(host, port): heartbeat data} of the live data nodes
+        self.replication_factor = max(1, replication_factor)
+        self.block_size = block_size
+        self.transfer_port_offset = transfer_port_offset
+        self.workers = workers
+        self.streams_per_node = streams_per_node
+        self.bandwidth = bandwidth or None
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.rebalance_threshold = rebalance_threshold
+        self.rebalance_on_join = rebalance_on_join
+        self.on_relocate = on_relocate  # (file paths) -> None, e.g. namespace cache invalidation
+        self.condition = threading.Condition()
+        self.blocks = {}  # block_id: [file path, set of (host, port)]
+        self.by_node = {}  # (host, port): set of block ids
+        self.live = None  # set of live (host, port), None until the first membership report
+        self.loaded = False
+        self.queue = []  # heap of (priority, seq, task)
+        self.queued = set()  # block ids with a re-replication queued or running
+        self.moving = set()  # block ids with a move queued or running
+        self.unplaced = set()  # block ids short of copies that no node could take
+        self.busy = Counter()  # (host, port): copy streams it takes part in
+        self.seq = itertools.count()
+        self.stopped = threading.Event()
+        self.counters = {'replicated': 0, 'moved': 0, 'failed': 0, 'lost': 0}
+
+    def start(self):
+        threading.Thread(target=self.load, daemon=True).start()
+        for _ in range(self.workers):
+            threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        with self.condition:
+            self.condition.notify_all()
+
+    def expected_copies(self, block_id):
+        # a block of an erasure coded stripe is stored once, the stripe is its redundancy
+        return 1 if is_erasure_coded(block_id) else self.replication_factor
+
+    def track(self, block_id, file_path, node):
+        self.blocks.setdefault(block_id, [file_path, set()])[1].add(node)
+        self.by_node.setdefault(node, set()).add(block_id)
+
+    def untrack(self, block_id, node):
+        entry = self.blocks.get(block_id)
+        if entry is not None:
+            entry[1].discard(node)
+        self.by_node.get(node, set()).discard(block_id)
+
+    def forget(self, block_id):
+        for node in self.blocks.pop(block_id, (None, ()))[1]:
+            self.by_node.get(node, set()).discard(block_id)
+
+    def remove_copies(self, node, block_ids):
+        """drops the copies node reclaimed after their files were deleted"""
+        with self.condition:
+            for block_id in block_ids:
+                self.untrack(block_id, node)
+                entry = self.blocks.get(block_id)
+                if entry is not None and not entry[1]:
+                    self.forget(block_id)
+
+    def load(self, page_size=10000):
+        """reads every block copy from the metadata service, then checks them against the live nodes"""
+        after = copies = 0
+        while not self.stopped.is_set():
+            try:
+                rows = self.metadata.list_block_copies(after, page_size)
+            except Exception as e:
+                logger.warning("error occurred at loading the block map: %s", e)
+                self.stopped.wait(self.retry_delay)
+                continue
+            if not rows:
+                break
+            with self.condition:
+                for _, block_id, file_path, host, port in rows:
+                    self.track(block_id, file_path, (host, int(port)))
+            after = rows[-1][0]
+            copies += len(rows)
+        with self.condition:
+            self.loaded = True
+            logger.info("Block map loaded, %s copies of %s blocks", copies, len(self.blocks))
+            # blocks written while fewer data nodes than replication_factor were alive
+            for block_id in self.blocks:
+                self.enqueue(block_id)
+        self.reconcile()
+
+    def add(self, file_path, primary_blocks, replica_blocks):
+        """records the copies of blocks the NameNode just allocated"""
+        short = []
+        with self.condition:
+            for block_id, data_node in itertools.chain(primary_blocks, replica_blocks):
+                self.track(block_id, file_path, (data_node[0], int(data_node[1])))
+            if self.loaded:
+                short = [block_id for block_id, _ in primary_blocks
+                         if len(self.blocks[block_id][1]) < self.expected_copies(block_id)]
+        if short:
+            # the client is still uploading them, check again once it had time to finish
+            threading.Timer(self.retry_delay, self.requeue, (short, 0)).start()
+
+    def nodes_changed(self, live):
+        """ClusterState membership callback"""
+        live = {(host, int(port)) for host, port in live}
+        with self.condition:
+            joined = self.live is not None and bool(live - self.live)
+            self.live = live
+        self.reconcile()
+        if joined and self.rebalance_on_join:
+            self.rebalance()
+
+    def reconcile(self):
+        """drops the copies on data nodes that left and queues the blocks they leave short"""
+        self.placement.update(self.node_info())
+        with self.condition:
+            if not self.loaded or self.live is None:
+                return
+            for node in [node for node in self.by_node if node not in self.live]:
+                block_ids = self.by_node.pop(node)
+                if block_ids:
+                    logger.warning("Data node %s left, queueing its %s block(s)", node, len(block_ids))
+                for block_id in block_ids:
+                    self.blocks[block_id][1].discard(node)
+                    self.enqueue(block_id)
+            # a node that joined may take the copies nothing could take before
+            unplaced, self.unplaced = self.unplaced, set()
+            for block_id in unplaced:
+                self.enqueue(block_id)
+
+    def enqueue(self, block_id, attempt=0):
+        """queues block_id if it is short of copies, called with the condition held"""
+        entry = self.blocks.get(block_id)
+        if entry is None or block_id in self.queued:
+            return
+        live = len(entry[1])
+        if live >= self.expected_copies(block_id):
+            return
+        if not live:
+            self.counters['lost'] += 1
+            REGISTRY.inc('blocks_lost_total')
+            logger.error("Block %s of %s has no live copy left%s", block_id, entry[0],
+                         ", readers rebuild it from its stripe" if is_erasure_coded(block_id) else "")
+            return
+        self.queued.add(block_id)
+        heapq.heappush(self.queue, (live, next(self.seq), (REPLICATE, block_id, attempt)))
+        self.condition.notify()
+
+    def requeue(self, block_ids, attempt):
+        with self.condition:
+            for block_id in block_ids:
+                self.enqueue(block_id, attempt)
+
+    def run(self):
+        while not self.stopped.is_set():
+            with self.condition:
+                task = self.next_task()
+                if task is None:
+                    self.condition.wait(1)
+                    continue
+            kind, block_id, attempt = task[:3]
+            try:
+                self.perform(*task)
+            except Exception as e:
+                with self.condition:
+                    self.counters['failed'] += 1
+                REGISTRY.inc('replication_failures_total', kind=kind)
+                logger.warning("error occurred at %s of block %s: %s", kind, block_id, e)
+                if kind == REPLICATE and attempt + 1 < self.max_attempts:
+                    threading.Timer(self.retry_delay, self.requeue, ((block_id,), attempt + 1)).start()
+            finally:
+                with self.condition:
+                    for node in (task[4], *task[5]):
+                        self.busy[node] -= 1
+                    (self.queued if kind == REPLICATE else self.moving).discard(block_id)
+                    self.condition.notify_all()
+
+    def next_task(self, scan_limit=1000):
+        """pops the most urgent task whose data nodes have a free stream and reserves them
+           returns (kind, block_id, attempt, file_path, source, targets) or None
+        """
+        if self.live is None:
+            return None
+        skipped = []
+        task = None
+        while self.queue and task is None and len(skipped) < scan_limit:
+            item = heapq.heappop(self.queue)
+            task = self.assign(*item[2])
+            if task is WAIT:
+                skipped.append(item)
+                task = None
+            elif task is None:
+                # nothing left to do for this block
+                (self.queued if item[2][0] == REPLICATE else self.moving).discard(item[2][1])
+        for item in skipped:
+            heapq.heappush(self.queue, item)
+        if task is not None:
+            for node in (task[4], *task[5]):
+                self.busy[node] += 1
+        return task
+
+    def free(self, node):
+        return self.busy[node] < self.streams_per_node
+
+    def candidates(self, block_id, holders):
+        """live data nodes not holding block_id in placement order, the ones on other racks and
+           hosts than its holders first
+        """
+        nodes = self.placement.select(block_id, len(self.placement.weights))
+        racks = {self.placement.racks.get(node) for node in holders}
+        hosts = {node[0] for node in holders}
+        return sorted((node for node in nodes if node not in holders and node in self.live),
+                      key=lambda node: (self.placement.racks.get(node) in racks, node[0] in hosts))
+
+    def assign(self, kind, block_id, attempt, *move):
+        entry = self.blocks.get(block_id)
+        if entry is None:
+            return None
+        file_path, holders = entry
+        if kind == MOVE:
+            source, target = move
+            if source not in holders or target in holders or target not in self.live:
+                return None
+            if not (self.free(source) and self.free(target)):
+                return WAIT
+            return MOVE, block_id, attempt, file_path, source, (target,)
+        missing = self.expected_copies(block_id) - len(holders)
+        if missing <= 0 or not holders:
+            return None
+        candidates = self.candidates(block_id, holders)
+        if not candidates:
+            self.unplaced.add(block_id)
+            return None
+        sources = [node for node in holders if self.free(node)]
+        targets = [node for node in candidates if self.free(node)][:missing]
+        if not sources or not targets:
+            return WAIT
+        return REPLICATE, block_id, attempt, file_path, min(sources, key=self.busy.__getitem__), tuple(targets)
+
+    def copies(self, block_id):
+        """(host, port) of every copy of block_id the metadata service knows"""
+        return {(host, int(port)) for _, host, port, _, _ in self.metadata.find_blocks((block_id,))}
+
+    def copy(self, source, block_id, file_path, targets):
+        with self.transfer_pool.connection(source[0], source[1] + self.transfer_port_offset) as conn:
+            acks = conn.copy_block(block_id, file_path, targets, self.bandwidth)
+        if acks is None:
+            with self.condition:
+                self.untrack(block_id, source)
+            raise Exception(f"data node {source} lost its copy")
+        return acks
+
+    def relocate(self, block_id, old_node, new_node):
+        paths = self.metadata.relocate_block(block_id, old_node, new_node)
+        if self.on_relocate is not None:
+            self.on_relocate(paths)
+
+    def perform(self, kind, block_id, attempt, file_path, source, targets):
+        copies = self.copies(block_id)
+        if not copies:
+            # every file referencing it is gone
+            with self.condition:
+                self.forget(block_id)
+            return
+        if kind == MOVE:
+            self.move(block_id, file_path, source, targets[0], copies)
+            return
+        with self.condition:
+            holders = copies & self.live
+            # a node that came back still holds its copies
+            for node in holders:
+                self.track(block_id, file_path, node)
+        stale = [node for node in copies if node not in holders]
+        targets = [node for node in targets if node not in copies][:self.expected_copies(block_id) - len(holders)]
+        if not targets:
+            return
+        if source not in holders:
+            raise Exception(f"data node {source} no longer holds the block")
+        acks = self.copy(source, block_id, file_path, targets)
+        for target in targets[:acks]:
+            # the new copy takes the place of a lost one, primary rows stay primary
+            self.relocate(block_id, stale.pop() if stale else None, target)
+            with self.condition:
+                self.track(block_id, file_path, target)
+                self.counters['replicated'] += 1
+        REGISTRY.inc('blocks_replicated_total', acks)
+        if acks < len(targets):
+            raise Exception(f"{acks} of {len(targets)} data node(s) stored the copy")
+
+    def move(self, block_id, file_path, source, target, copies):
+        if source not in copies or target in copies:
+            return
+        if not self.copy(source, block_id, file_path, (target,)):
+            raise Exception(f"data node {target} did not store the copy")
+        self.relocate(block_id, source, target)
+        with self.condition:
+            self.untrack(block_id, source)
+            self.track(block_id, file_path, target)
+            self.counters['moved'] += 1
+        # readers holding the old location fall back to the other copies
+        with self.transfer_pool.connection(source[0], source[1] + self.transfer_port_offset) as conn:
+            conn.delete_block(block_id, file_path)
+        REGISTRY.inc('blocks_moved_total')
+
+    def rebalance(self, threshold=None):
+        """queues moves from data nodes above the mean disk usage to the ones below it, if any
+           node is more than threshold (a fraction of its capacity) away from the mean
+           block sizes are estimated as block_size, returns the number of moves queued
+        """
+        threshold = self.rebalance_threshold if threshold is None else threshold
+        nodes = {node: data for node, data in self.node_info().items() if data and data.get('capacity')}
+        if len(nodes) < 2:
+            return 0
+        mean = sum(data['used'] for data in nodes.values()) / sum(data['capacity'] for data in nodes.values())
+        usage = {node: data['used'] / data['capacity'] for node, data in nodes.items()}
+        if all(abs(value - mean) <= threshold for value in usage.values()):
+            return 0
+        excess = {node: (usage[node] - mean) * nodes[node]['capacity'] for node in nodes if usage[node] > mean}
+        room = {node: (mean - usage[node]) * nodes[node]['capacity'] for node in nodes if usage[node] < mean}
+        moves = 0
+        with self.condition:
+            for source in sorted(excess, key=usage.get, reverse=True):
+                for block_id in list(self.by_node.get(source, ())):
+                    if excess[source] <= 0 or not room:
+                        break
+                    if is_erasure_coded(block_id) or block_id in self.moving or block_id in self.queued:
+                        continue
+                    target = self.move_target(source, self.blocks[block_id][1], room)
+                    if target is None:
+                        continue
+                    self.moving.add(block_id)
+                    heapq.heappush(self.queue, (MOVE_PRIORITY, next(self.seq), (MOVE, block_id, 0, source, target)))
+                    excess[source] -= self.block_size
+                    room[target] -= self.block_size
+                    if room[target] <= 0:
+                        del room[target]
+                    moves += 1
+            self.condition.notify_all()
+        logger.info("Rebalancing %s data node(s) around %.1f%% usage, %s move(s) queued",
+                    len(nodes), mean * 100, moves)
+        return moves
+
+    def move_target(self, source, holders, room):
+        """the node with most room that does not hold the block and keeps its copies on as
+           many racks as before
+        """
+        racks = {self.placement.racks.get(node) for node in holders if node != source}
+        allowed = [node for node in room if node not in holders and
+                   (self.placement.racks.get(node) == self.placement.racks.get(source) or
+                    self.placement.racks.get(node) not in racks)]
+        return max(allowed, key=room.get, default=None)
+
+    def stats(self):
+        with self.condition:
+            stats = dict(self.counters)
+            stats['blocks'] = len(self.blocks)
+            stats['queued'] = len(self.queue)
+            stats['unplaced'] = len(self.unplaced)
+            stats['streams'] = sum(self.busy.values())
+            return stats
@@ -0,0 +1,290 @@
+"""Partitioning of the namespace over several metadata services (shards).
+
+A path hashes to one of SLOTS slots and every slot belongs to one shard, which keeps the
+files of its slots and their block rows in its own SQLite database. MetadataRouter sends a
+call on one path to the shard of its slot, a call on many paths to every shard involved
+with its share of them, in parallel, and a call on block ids to every shard, since a
+deduplicated or packed block may be referenced from files on any of them.
+
+Shards record the slots they own with the epoch they got them at, so the slot map needs no
+other store: at start the router asks every shard, and a slot claimed twice (a move that
+was cut short) belongs to its newest claim. On the very first start the slots are dealt
+round robin over the configured shards, a shard added later owns nothing until slots are
+moved to it.
+
+Slots move online, one at a time: calls on the slot wait while its files are copied to the
+new shard, which claims the slot in the same transaction, then the old shard drops them.
+Calls on every other slot go on, a slot holds 1 / SLOTS of the namespace.
+"""
+
+import hashlib
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+logger = logging.getLogger('sharding')
+
+SLOTS = 4096
+
+
+def path_slot(path):
+    return int.from_bytes(hashlib.md5(path.encode()).digest()[:8], 'big') % SLOTS
+
+
+def parse_hosts(hosts):
+    """[(host, port), ...] of a comma separated metadata_hosts option"""
+    return [(host.strip(), int(port)) for host, port in (entry.split(':') for entry in hosts.split(','))]
+
+
+class MetadataRouter:
+    """the metadata service API of MetadataDBService over every shard"""
+
+    def __init__(self, shards, pool, workers=None):
+        self.shards = [(host, int(port)) for host, port in shards]
+        self.pool = pool
+        self.executor = ThreadPoolExecutor(max_workers=workers or 4 * len(self.shards))
+        self.condition = threading.Condition()
+        self.owners = None  # shard index of every slot, filled by load
+        self.moving = set()  # slots being moved, calls on them wait
+        self.in_flight = Counter()  # slot: calls running on it
+        self.counters = {'slots_moved': 0, 'files_moved': 0, 'slots_pending': 0, 'move_failures': 0}
+
+    def call(self, index, method, *args):
+        with self.pool.connection(*self.shards[index]) as conn:
+            return getattr(conn.root, method)(*args)
+
+    def fan_out(self, method, *args):
+        """calls method on every shard in parallel, returns their results in shard order"""
+        if len(self.shards) == 1:
+            return [self.call(0, method, *args)]
+        return list(self.executor.map(lambda index: self.call(index, method, *args), range(len(self.shards))))
+
+    def load(self):
+        """builds the slot map from the claims of the shards"""
+        owners = [None] * SLOTS
+        epochs = [-1] * SLOTS
+        stale = []
+        for index, claims in enumerate(self.fan_out('owned_slots')):
+            for slot, epoch in claims:
+                if epoch == epochs[slot]:
+                    # moves claim with a new epoch, equal claims are one database served by two shards
+                    raise Exception(f"Metadata shards {self.shards[owners[slot]]} and {self.shards[index]} "
+                                    f"both claim slot {slot} at epoch {epoch}, do they share a db_file?")
+                if epoch > epochs[slot]:
+                    if owners[slot] is not None:
+                        stale.append((owners[slot], slot))
+                    owners[slot], epochs[slot] = index, epoch
+                else:
+                    stale.append((index, slot))
+        if all(owner is None for owner in owners):
+            epoch = time.time_ns()
+            for index in range(len(self.shards)):
+                slots = tuple(range(index, SLOTS, len(self.shards)))
+                self.call(index, 'claim_slots', slots, epoch)
+                for slot in slots:
+                    owners[slot] = index
+            logger.info("Dealt %s slots over %s metadata shard(s)", SLOTS, len(self.shards))
+        missing = [slot for slot, owner in enumerate(owners) if owner is None]
+        if missing:
+            raise Exception(f"{len(missing)} slot(s) are owned by no configured metadata host, e.g. {missing[:5]}")
+        for index, slot in stale:
+            # a move cut short after the new shard claimed the slot, the newer claim has every file
+            logger.warning("Dropping stale slot %s from metadata shard %s", slot, self.shards[index])
+            self.call(index, 'drop_slot', slot)
+        with self.condition:
+            self.owners = owners
+        return self
+
+    @contextmanager
+    def routed(self, paths):
+        """yields the shard index of every path, the slots stay put until the block exits"""
+        slots = [path_slot(path) for path in paths]
+        with self.condition:
+            while self.moving.intersection(slots):
+                self.condition.wait()
+            for slot in slots:
+                self.in_flight[slot] += 1
+            shards = [self.owners[slot] for slot in slots]
+        try:
+            yield shards
+        finally:
+            with self.condition:
+                for slot in slots:
+                    self.in_flight[slot] -= 1
+                    if not self.in_flight[slot]:
+                        del self.in_flight[slot]
+                        if slot in self.moving:
+                            self.condition.notify_all()
+
+    def on_path(self, method, path, *args):
+        with self.routed((path,)) as (index,):
+            return self.call(index, method, path, *args)
+
+    def on_paths(self, method, items, path_of, *args):
+        """calls method(*args, share of items) on each shard involved, in parallel"""
+        items = tuple(items)
+        with self.routed([path_of(item) for item in items]) as shards:
+            groups = {}
+            for item, index in zip(items, shards):
+                groups.setdefault(index, []).append(item)
+            if len(groups) == 1:
+                (index, share), = groups.items()
+                return [self.call(index, method, *args, tuple(share))]
+            return list(self.executor.map(
+                lambda group: self.call(group[0], method, *args, tuple(group[1])), groups.items()))
+
+    def save_file_blocks(self, file_path, primary_blocks, replica_blocks, codecs=(), size=None):
+        return self.on_path('save_file_blocks', file_path, primary_blocks, replica_blocks, codecs, size)
+
+    def delete_file(self, file_path):
+        return self.on_path('delete_file', file_path)
+
+    def delete_prefix(self, prefix, limit=1000):
+        """deletes up to limit files below prefix on every shard, returns their paths"""
+        return tuple(itertools.chain.from_iterable(self.fan_out('delete_prefix', prefix, limit)))
+
+    def list_directory(self, prefix, after='', limit=1000):
+        """the first limit entries of the list_directory pages of every shard, merged in path
+           order, a subdirectory with files on several shards shows once
+        """
+        entries = []
+        for entry in heapq.merge(*self.fan_out('list_directory', prefix, after, limit), key=lambda entry: entry[0]):
+            if not entries or entries[-1][0] != entry[0]:
+                entries.append(tuple(entry))
+                if len(entries) == limit:
+                    break
+        return tuple(entries)
+
+    def stat_file(self, file_path):
+        return self.on_path('stat_file', file_path)
+
+    def has_prefix(self, prefix):
+        return any(self.fan_out('has_prefix', prefix))
+
+    def pending_garbage(self, node, before, limit=1000):
+        rows = itertools.chain.from_iterable(self.fan_out('pending_garbage', node, before, limit))
+        return tuple(itertools.islice(rows, limit))
+
+    def clear_garbage(self, node, block_ids):
+        self.fan_out('clear_garbage', node, tuple(block_ids))
+
+    def garbage_count(self):
+        return sum(self.fan_out('garbage_count'))
+
+    def get_file_blocks(self, file_path):
+        return self.on_path('get_file_blocks', file_path)
+
+    def get_files_blocks(self, file_paths):
+        return tuple(itertools.chain.from_iterable(self.on_paths('get_files_blocks', file_paths, lambda path: path)))
+
+    def save_packed_files(self, container_id, data_nodes, codec, files):
+        # every shard counts the references of its own files to the container
+        self.on_paths('save_packed_files', files, lambda file: file[0], container_id, data_nodes, codec)
+
+    def find_blocks(self, block_ids):
+        block_ids = tuple(block_ids)
+        rows = set(itertools.chain.from_iterable(self.fan_out('find_blocks', block_ids)))
+        # primaries first, like a single shard
+        return tuple(sorted(rows, key=lambda row: (row[0], row[3], row[1], row[2])))
+
+    def block_refcounts(self, block_ids):
+        totals = Counter()
+        for rows in self.fan_out('block_refcounts', tuple(block_ids)):
+            for block_id, refcount in rows:
+                totals[block_id] += refcount
+        return tuple(sorted(totals.items()))
+
+    def relocate_block(self, block_id, old_node, new_node):
+        paths = itertools.chain.from_iterable(self.fan_out('relocate_block', block_id, old_node, new_node))
+        return tuple(sorted(set(paths)))
+
+    def list_block_copies(self, after=0, limit=10000):
+        """list_block_copies of every shard in turn, the rowid of each row is replaced by the
+           cursor (shard index, rowid) to page with
+        """
+        index, rowid = after or (0, 0)
+        while index < len(self.shards):
+            rows = self.call(index, 'list_block_copies', rowid, limit)
+            if rows:
+                return tuple(((index, row[0]),) + tuple(row[1:]) for row in rows)
+            index, rowid = index + 1, 0
+        return ()
+
+    def move_slot(self, slot, target):
+        """moves the files of slot to shard target, returns their number"""
+        with self.condition:
+            source = self.owners[slot]
+            if source == target:
+                return 0
+            self.moving.add(slot)
+            while self.in_flight[slot]:
+                self.condition.wait()
+        try:
+            files = self.call(source, 'export_slot', slot)
+            self.call(target, 'import_slot', slot, files, time.time_ns())
+            with self.condition:
+                self.owners[slot] = target
+            try:
+                self.call(source, 'drop_slot', slot)
+            except Exception as e:
+                # the older claim is dropped at the next load, its files only inflate block_refcounts
+                logger.warning("error occurred at dropping slot %s from %s: %s", slot, self.shards[source], e)
+        finally:
+            with self.condition:
+                self.moving.discard(slot)
+                self.condition.notify_all()
+        return len(files)
+
+    def move_slots(self, moves):
+        """moves ((slot, target shard index), ...) one slot at a time"""
+        with self.condition:
+            self.counters['slots_pending'] += len(moves)
+        for slot, target in moves:
+            try:
+                files = self.move_slot(slot, target)
+                with self.condition:
+                    self.counters['slots_moved'] += 1
+                    self.counters['files_moved'] += files
+            except Exception as e:
+                with self.condition:
+                    self.counters['move_failures'] += 1
+                logger.error("error occurred at moving slot %s to %s: %s", slot, self.shards[target], e)
+            finally:
+                with self.condition:
+                    self.counters['slots_pending'] -= 1
+
+    def balance_plan(self):
+        """(slot, target) moves that leave every shard with SLOTS / shards slots, give or take one"""
+        with self.condition:
+            owners = list(self.owners)
+        quota, extra = divmod(SLOTS, len(self.shards))
+        wanted = [quota + (index < extra) for index in range(len(self.shards))]
+        owned = {index: [] for index in range(len(self.shards))}
+        for slot, index in enumerate(owners):
+            owned[index].append(slot)
+        surplus = [slot for index, slots in owned.items() for slot in slots[wanted[index]:]]
+        moves = []
+        for index, slots in owned.items():
+            need = wanted[index] - len(slots)
+            if need > 0:
+                moves.extend((slot, index) for slot in surplus[:need])
+                surplus = surplus[need:]
+        return moves
+
+    def shard_map(self):
+        """((host, port, slots owned), ...) in shard order"""
+        with self.condition:
+            counts = Counter(self.owners)
+        return tuple((host, port, counts[index]) for index, (host, port) in enumerate(self.shards))
+
+    def stats(self):
+        with self.condition:
+            stats = dict(self.counters)
+            stats['shards'] = len(self.shards)
+            stats['slots_moving'] = len(self.moving)
+            return stats
@@ -0,0 +1,139 @@
+"""Writes of files whose size is not known up front: pipes, sockets, generators.
+
+create_file needs a local file, it mmaps it and the NameNode places all its blocks from its
+size. A StreamWriter instead places a block when the buffer holding it is full and uploads it
+while the next one fills, the file becomes visible when the writer is closed.
+"""
+
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class StreamWriter(io.RawIOBase):
+    """writable file object returned by FilesystemClient.open_write and append
+       1) bytes gather in a buffer of block_size, a full buffer goes to allocate_block and is
+          sent like any block (compressed, down the replica pipeline) while the next one fills
+       2) at most max_in_flight blocks are pending, write blocks beyond that, so memory stays
+          ~ (max_in_flight + 1) * block_size however much is written
+       3) close() commits all blocks with one commit_blocks call, a writer left by an exception
+          (or never closed) commits nothing and the previous version of the file stays
+       4) an append to a file whose last block is partial (or to a packed file) starts with the
+          bytes of that block: stored blocks never change, the rewritten copy replaces it
+       5) streamed files are replicated whatever the client's storage_policy
+    """
+
+    def __init__(self, client, destination, append=False):
+        super().__init__()
+        self.client = client
+        self.destination = destination
+        self.append = append
+        self.block_size = client.block_size
+        self.window = threading.BoundedSemaphore(client.max_in_flight)
+        self.executor = ThreadPoolExecutor(max_workers=client.max_in_flight, thread_name_prefix='stream-write')
+        self.uploads = []  # futures of the block reports, in block order
+        self.spare = []  # buffers of sent blocks, reused for the next ones
+        self.buffer = bytearray(self.block_size)
+        self.size = 0  # bytes in buffer
+        self.written = 0  # bytes passed to write
+        self.base_block = None  # last block of the file being appended to
+        self.rewrite_last = False
+        self.kept = 0  # bytes of the file appended to that stay as they are
+        self.report = None
+        if append:
+            self.load_tail()
+
+    def load_tail(self):
+        """reads a partial last block of the file into the buffer, the appended bytes follow it"""
+        primary_blocks, replicas_by_block, codecs, stripes, windows = \
+            self.client.get_block_locations(self.destination)
+        if stripes:
+            raise ValueError("erasure coded files can not be appended to")
+        if not primary_blocks:
+            return
+        block_id, data_node = primary_blocks[-1]
+        self.base_block = block_id
+        # all blocks but the last are full, the last one is either kept whole or rewritten
+        self.kept = len(primary_blocks) * self.block_size
+        codec = codecs.get(block_id, 'none')
+        replica_blocks = replicas_by_block.get(block_id, [])
+        if block_id not in windows and codec == 'none' and self.client.read_block(
+                block_id, data_node, replica_blocks, self.destination, offset=self.block_size - 1, length=1):
+            # a full block stays, the appended bytes start a new one
+            return
+        data = self.client.read_block(block_id, data_node, replica_blocks, self.destination, codec,
+                                      window=windows.get(block_id))
+        if len(data) == self.block_size and block_id not in windows:
+            return
+        self.buffer[:len(data)] = data
+        self.size = len(data)
+        self.rewrite_last = True
+        self.kept -= self.block_size
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed file")
+        with memoryview(data) as raw, raw.cast('B') as view:
+            length = len(view)
+            start = 0
+            while start < length:
+                count = min(length - start, self.block_size - self.size)
+                self.buffer[self.size:self.size + count] = view[start:start + count]
+                self.size += count
+                start += count
+                if self.size == self.block_size:
+                    self.send_buffer()
+        self.written += length
+        return length
+
+    def send_buffer(self):
+        self.window.acquire()
+        buffer, size = self.buffer, self.size
+        self.buffer = self.spare.pop() if self.spare else bytearray(self.block_size)
+        self.size = 0
+        self.uploads.append(self.executor.submit(self.upload, buffer, size))
+
+    def upload(self, buffer, size):
+        try:
+            with memoryview(buffer)[:size] as view:
+                return self.client.upload_block(view, self.destination)
+        finally:
+            self.spare.append(buffer)
+            self.window.release()
+
+    def close(self):
+        """sends the last block and commits the file, see FilesystemClient.commit_stream"""
+        if self.closed:
+            return
+        try:
+            if self.append and not self.written:
+                return
+            if self.size:
+                self.send_buffer()
+            self.report = [upload.result() for upload in self.uploads]
+            size = self.kept + sum(result['bytes'] for result in self.report)
+            self.client.commit_stream(self.destination, self.report, self.append, self.base_block,
+                                      self.rewrite_last, size)
+        finally:
+            self.executor.shutdown()
+            super().close()
+
+    def abort(self):
+        """drops everything written, the file stays as it was"""
+        if self.closed:
+            return
+        self.executor.shutdown(cancel_futures=True)
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+    def __del__(self):
+        # unlike a local file an unclosed writer is abandoned, not committed
+        self.abort()
@@ -1,22 +1,102 @@
+import logging
+import os
+import sys
+
 import rpyc
 from metadata_db import MetadataDBService
 
-class MetadataService(rpyc.Service):
-    def __init__(self):
-        self.metadata_db = MetadataDBService()
+# metrics is shared with the data services
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_service'))
+from metrics import MetricsService, instrument, setup_logging  # noqa: E402
+
+
+@instrument('metadata')
+class MetadataService(MetricsService, rpyc.Service):
+    def __init__(self, db_file='metadata_table.db', owner=None):
+        self.metadata_db = MetadataDBService(db_file, owner)
+
+    def exposed_save_file_blocks(self, file_path, primary_blocks, replica_blocks, codecs=(), size=None):
+        return self.metadata_db.save_file_blocks(file_path, primary_blocks, replica_blocks, codecs, size)
+
+    def exposed_delete_file(self, destination):
+        return self.metadata_db.delete_file(destination)
+
+    def exposed_delete_prefix(self, prefix, limit=1000):
+        return self.metadata_db.delete_prefix(prefix, limit)
+
+    def exposed_list_directory(self, prefix, after='', limit=1000):
+        return self.metadata_db.list_directory(prefix, after, limit)
+
+    def exposed_stat_file(self, file_path):
+        return self.metadata_db.stat_file(file_path)
+
+    def exposed_has_prefix(self, prefix):
+        return self.metadata_db.has_prefix(prefix)
+
+    def exposed_pending_garbage(self, node, before, limit=1000):
+        return self.metadata_db.pending_garbage(node, before, limit)
+
+    def exposed_clear_garbage(self, node, block_ids):
+        return self.metadata_db.clear_garbage(node, block_ids)
 
-    def exposed_save_file_blocks(self, file_path, primary_blocks, replica_blocks):
-        return self.metadata_db.save_file_blocks(file_path, primary_blocks, replica_blocks)
+    def exposed_garbage_count(self):
+        return self.metadata_db.garbage_count()
 
-    # def exposed_delete_file(self, destination):
-    #     metadata_service = MetadataService()
-    #     return metadata_service.delete_file(destination)
-    #
     def exposed_get_file_blocks(self, file_path):
         return self.metadata_db.get_file_blocks(file_path)
 
+    def exposed_get_files_blocks(self, file_paths):
+        return self.metadata_db.get_files_blocks(file_paths)
+
+    def exposed_save_packed_files(self, container_id, data_nodes, codec, files):
+        return self.metadata_db.save_packed_files(container_id, data_nodes, codec, files)
+
+    def exposed_find_blocks(self, block_ids):
+        return self.metadata_db.find_blocks(block_ids)
+
+    def exposed_block_refcounts(self, block_ids):
+        return self.metadata_db.block_refcounts(block_ids)
+
+    def exposed_list_block_copies(self, after=0, limit=10000):
+        return self.metadata_db.list_block_copies(after, limit)
+
+    def exposed_relocate_block(self, block_id, old_node, new_node):
+        return self.metadata_db.relocate_block(block_id, old_node, new_node)
+
+    def exposed_owned_slots(self):
+        return self.metadata_db.owned_slots()
+
+    def exposed_claim_slots(self, slots, epoch):
+        return self.metadata_db.claim_slots(slots, epoch)
+
+    def exposed_export_slot(self, slot):
+        return self.metadata_db.export_slot(slot)
+
+    def exposed_import_slot(self, slot, files, epoch):
+        return self.metadata_db.import_slot(slot, files, epoch)
+
+    def exposed_drop_slot(self, slot):
+        return self.metadata_db.drop_slot(slot)
+
 # Start the server
 if __name__ == "__main__":
+    import configparser
     from rpyc.utils.server import ThreadedServer
-    metadata_service = ThreadedServer(MetadataService(), port=18005, auto_register=False)
+    config = configparser.ConfigParser()
+    config.read(os.environ.get('PYHDFS_CONFIG', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                             '..', 'data_service', 'config.ini')))
+    setup_logging(config, 'metadata')
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 18005
+    if len(sys.argv) > 2:
+        db_file = sys.argv[2]
+    elif config.has_option('metadata', 'db_file'):
+        db_file = config.get('metadata', 'db_file', raw=True).format(port=port)
+    else:
+        # the first shard keeps the database of the time before sharding, the others get one per port
+        hosts = config.get('metadata', 'metadata_hosts', fallback='').split(',')
+        first_port = int(hosts[0].rsplit(':', 1)[1]) if ':' in hosts[0] else 18005
+        db_file = 'metadata_table.db' if port == first_port else f'metadata_table_{port}.db'
+    logging.getLogger('metadata').info("Metadata shard on port %s stores %s", port, os.path.abspath(db_file))
+    metadata_service = ThreadedServer(MetadataService(db_file, owner=port), port=port,
+                                      auto_register=False, logger=logging.getLogger('rpyc.metadata'))
     metadata_service.start()
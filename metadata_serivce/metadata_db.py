@@ -1,68 +1,446 @@
+import logging
 import sqlite3
 import json
+import sys
 import threading
+import time
 import os
 
+# the slot of a path is computed like the NameNode's router does
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_service'))
+from sharding import path_slot  # noqa: E402
+
+logger = logging.getLogger('metadata_db')
+
+# sorts after every path, prefix <= path < prefix + PATH_END are the paths starting with prefix
+PATH_END = '\U0010ffff'
+
 
 class MetadataDBService:
-    def __init__(self):
-        self.db_file = 'metadata_table.db'  # SQLite database file
-        self.table = 'metadata_table'  # SQLite table
-        self.connection_lock = threading.Lock()
+    """files and their blocks in SQLite
+       1) files holds one row per path, blocks one row per (block, data node) copy
+       2) the database runs in WAL mode, readers keep one connection per thread and never
+          wait for the writer, writes go through a single connection guarded by write_lock
+       3) lookups return typed rows ordered by block index, primaries before replicas
+       4) every block row carries the codec the client compressed it with, 'none' if verbatim
+       5) block_refs counts the files referencing each block id, deduplicated blocks are shared
+          between files and a block without a row there is garbage
+       6) a small file packed into a container block has one block whose rows carry the
+          block_offset and block_length of the file inside the container
+       7) with several metadata hosts each one is a shard holding the files of the slots it
+          owns (see sharding.py), files carry their slot and slots lists the owned ones
+       8) a block losing its last reference to a deleted or overwritten file moves its copies
+          to garbage, data nodes remove them in batches through the NameNode's block_report
+       9) directories are implicit, the prefixes of file paths, list_directory pages through
+          one with an index seek per subdirectory and per batch of files
+       10) a shard opening the database records itself as its owner in info, a second shard
+           pointed at the same file refuses to start instead of sharing the slot claims
+    """
+
+    def __init__(self, db_file='metadata_table.db', owner=None):
+        self.db_file = db_file  # SQLite database file
+        self.legacy_table = 'metadata_table'  # JSON encoded layout before files/blocks
+        self.write_lock = threading.Lock()
+        self.local = threading.local()
+        self.write_connection = self.get_connection(check_same_thread=False)
         self.create_table_if_not_exists()
+        if owner is not None:
+            self.claim_owner(owner)
+        self.migrate_legacy_table()
 
-    def get_connection(self):
-        return sqlite3.connect(self.db_file)
+    def get_connection(self, check_same_thread=True):
+        conn = sqlite3.connect(self.db_file, check_same_thread=check_same_thread)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def read_connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self.get_connection()
+        return conn
 
     def create_table_if_not_exists(self):
-        with self.connection_lock:
-            conn = self.get_connection()
-            try:
-                cursor = conn.cursor()
-                cursor.execute(f'''CREATE TABLE IF NOT EXISTS {self.table} (
-                                    file_path TEXT PRIMARY KEY,
-                                    primary_blocks TEXT,
-                                    replica_blocks TEXT
-                                  )''')
-                conn.commit()
-            finally:
-                conn.close()
-
-    def save_file_blocks(self, file_path, primary_blocks, replica_blocks):
-        with self.connection_lock:
-            conn = self.get_connection()
-            try:
-                cursor = conn.cursor()
-                primary_blocks_serializable = json.dumps(
-                    [list(primary_block) for primary_block in primary_blocks])
-                replica_blocks_serializable = json.dumps(
-                    [list(replica_block) for replica_block in replica_blocks])
-                cursor.execute(f"INSERT OR REPLACE INTO {self.table} (file_path, primary_blocks, replica_blocks) VALUES (?, ?, ?)", (
-                    file_path, primary_blocks_serializable, replica_blocks_serializable))
-                conn.commit()
-            finally:
-                conn.close()
+        with self.write_lock, self.write_connection as conn:
+            has_refs = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name='block_refs'").fetchone()
+            conn.executescript('''CREATE TABLE IF NOT EXISTS files (
+                                    file_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                    file_path TEXT NOT NULL UNIQUE,
+                                    created_at REAL NOT NULL,
+                                    slot INTEGER,
+                                    size INTEGER
+                                  );
+                                  CREATE TABLE IF NOT EXISTS blocks (
+                                    file_id INTEGER NOT NULL REFERENCES files(file_id) ON DELETE CASCADE,
+                                    block_index INTEGER NOT NULL,
+                                    block_id TEXT NOT NULL,
+                                    host TEXT NOT NULL,
+                                    port INTEGER NOT NULL,
+                                    role TEXT NOT NULL CHECK (role IN ('primary', 'replica')),
+                                    codec TEXT NOT NULL DEFAULT 'none',
+                                    block_offset INTEGER NOT NULL DEFAULT 0,
+                                    block_length INTEGER
+                                  );
+                                  CREATE INDEX IF NOT EXISTS blocks_file_index ON blocks (file_id, block_index);
+                                  CREATE INDEX IF NOT EXISTS blocks_block_id ON blocks (block_id);
+                                  CREATE TABLE IF NOT EXISTS block_refs (
+                                    block_id TEXT PRIMARY KEY,
+                                    refcount INTEGER NOT NULL
+                                  );
+                                  CREATE TABLE IF NOT EXISTS slots (
+                                    slot INTEGER PRIMARY KEY,
+                                    epoch INTEGER NOT NULL
+                                  );
+                                  CREATE TABLE IF NOT EXISTS garbage (
+                                    host TEXT NOT NULL,
+                                    port INTEGER NOT NULL,
+                                    block_id TEXT NOT NULL,
+                                    file_path TEXT NOT NULL,
+                                    deleted_at REAL NOT NULL,
+                                    PRIMARY KEY (host, port, block_id)
+                                  );
+                                  CREATE TABLE IF NOT EXISTS info (
+                                    key TEXT PRIMARY KEY,
+                                    value TEXT NOT NULL
+                                  );''')
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(blocks)")]
+            if 'codec' not in columns:
+                # databases created before blocks were compressed
+                conn.execute("ALTER TABLE blocks ADD COLUMN codec TEXT NOT NULL DEFAULT 'none'")
+            if 'block_offset' not in columns:
+                # databases created before small files were packed into containers
+                conn.execute("ALTER TABLE blocks ADD COLUMN block_offset INTEGER NOT NULL DEFAULT 0")
+                conn.execute("ALTER TABLE blocks ADD COLUMN block_length INTEGER")
+            file_columns = [row[1] for row in conn.execute("PRAGMA table_info(files)")]
+            if 'size' not in file_columns:
+                # databases created before files recorded their size, stat reports None for them
+                conn.execute("ALTER TABLE files ADD COLUMN size INTEGER")
+            if 'slot' not in file_columns:
+                # databases created before the namespace was sharded
+                conn.create_function('path_slot', 1, path_slot, deterministic=True)
+                conn.execute("ALTER TABLE files ADD COLUMN slot INTEGER")
+                conn.execute("UPDATE files SET slot = path_slot(file_path)")
+            conn.execute("CREATE INDEX IF NOT EXISTS files_slot ON files (slot)")
+            if not has_refs:
+                # databases created before blocks were deduplicated
+                conn.execute('''INSERT INTO block_refs (block_id, refcount)
+                                SELECT block_id, COUNT(DISTINCT file_id) FROM blocks GROUP BY block_id''')
+
+    def claim_owner(self, owner):
+        """records owner (the port of the shard) in a fresh database, raises if another shard owns it"""
+        with self.write_lock, self.write_connection as conn:
+            conn.execute("INSERT OR IGNORE INTO info (key, value) VALUES ('owner', ?)", (str(owner),))
+            claimed, = conn.execute("SELECT value FROM info WHERE key = 'owner'").fetchone()
+        if claimed != str(owner):
+            raise Exception(f"{self.db_file} is the database of the metadata shard {claimed}, "
+                            f"every shard needs a db_file of its own")
+
+    def migrate_legacy_table(self):
+        """moves rows of the old JSON encoded metadata_table into files/blocks and drops it"""
+        with self.write_lock:
+            exists = self.write_connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (self.legacy_table,)).fetchone()
+            if not exists:
+                return
+            rows = self.write_connection.execute(
+                f"SELECT file_path, primary_blocks, replica_blocks FROM {self.legacy_table}").fetchall()
+        for file_path, primary_blocks, replica_blocks in rows:
+            self.save_file_blocks(file_path, json.loads(primary_blocks or '[]'), json.loads(replica_blocks or '[]'))
+        with self.write_lock, self.write_connection as conn:
+            conn.execute(f"DROP TABLE {self.legacy_table}")
+        logger.info("Migrated %s file(s) from %s", len(rows), self.legacy_table)
+
+    def block_rows(self, file_id, primary_blocks, replica_blocks, codecs):
+        block_index = {}
+        for index, (block_id, data_node) in enumerate(primary_blocks):
+            block_index.setdefault(block_id, index)
+            yield (file_id, index, block_id, data_node[0], int(data_node[1]), 'primary',
+                   codecs.get(block_id, 'none'))
+        for block_id, data_node in replica_blocks:
+            yield (file_id, block_index[block_id], block_id, data_node[0], int(data_node[1]), 'replica',
+                   codecs.get(block_id, 'none'))
+
+    def release_file(self, conn, file_path, collect=True):
+        """drops file_path and one reference to each of its blocks, in the caller's transaction
+           with collect the copies of blocks left without references go to garbage, a slot
+           moving to another shard keeps its blocks
+        """
+        file_blocks = '''SELECT b.block_id FROM files f JOIN blocks b ON b.file_id = f.file_id
+                         WHERE f.file_path=?'''
+        conn.execute(f"UPDATE block_refs SET refcount = refcount - 1 WHERE block_id IN ({file_blocks})",
+                     (file_path,))
+        if collect:
+            conn.execute('''INSERT OR IGNORE INTO garbage (host, port, block_id, file_path, deleted_at)
+                            SELECT b.host, b.port, b.block_id, f.file_path, ?
+                            FROM files f JOIN blocks b ON b.file_id = f.file_id
+                            JOIN block_refs r ON r.block_id = b.block_id
+                            WHERE f.file_path=? AND r.refcount <= 0''', (time.time(), file_path))
+        # only this file's blocks, a scan of every block_refs row would make each save O(blocks)
+        conn.execute(f"DELETE FROM block_refs WHERE refcount <= 0 AND block_id IN ({file_blocks})", (file_path,))
+        return conn.execute("DELETE FROM files WHERE file_path=?", (file_path,)).rowcount > 0
+
+    def add_references(self, conn, file_id):
+        """counts a reference of file_id to each of its blocks, blocks it reuses leave garbage"""
+        # WHERE true keeps SQLite from parsing ON CONFLICT as a join constraint of the SELECT
+        conn.execute('''INSERT INTO block_refs (block_id, refcount)
+                        SELECT DISTINCT block_id, 1 FROM blocks WHERE file_id=? AND true
+                        ON CONFLICT (block_id) DO UPDATE SET refcount = refcount + 1''', (file_id,))
+        conn.execute("DELETE FROM garbage WHERE block_id IN (SELECT block_id FROM blocks WHERE file_id=?)",
+                     (file_id,))
+
+    def save_file_blocks(self, file_path, primary_blocks, replica_blocks, codecs=(), size=None):
+        """replaces any previous entry for file_path, all block rows go in one executemany
+           codecs are ((block_id, codec), ...) of blocks already stored compressed, e.g. reused ones
+           size is the length of the file in bytes
+        """
+        with self.write_lock, self.write_connection as conn:
+            self.release_file(conn, file_path)
+            file_id = conn.execute("INSERT INTO files (file_path, created_at, slot, size) VALUES (?, ?, ?, ?)",
+                                   (file_path, time.time(), path_slot(file_path), size)).lastrowid
+            conn.executemany(
+                '''INSERT INTO blocks (file_id, block_index, block_id, host, port, role, codec)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                self.block_rows(file_id, primary_blocks, replica_blocks, dict(codecs)))
+            self.add_references(conn, file_id)
+
+    def set_block_codecs(self, file_path, codecs):
+        """records the codec of each ((block_id, codec), ...) of file_path on all its copies"""
+        with self.write_lock, self.write_connection as conn:
+            conn.executemany(
+                '''UPDATE blocks SET codec=?
+                   WHERE block_id=? AND file_id=(SELECT file_id FROM files WHERE file_path=?)''',
+                ((codec, block_id, file_path) for block_id, codec in codecs))
 
     def delete_file(self, destination):
-        conn = self.get_connection()
-        try:
-            cursor = conn.cursor()
-            cursor.execute(
-                "DELETE FROM file_table WHERE file_path=?", (destination,))
-            conn.commit()
-        finally:
-            conn.close()
+        """returns True if destination existed, its blocks go with it (ON DELETE CASCADE)
+           and lose one reference each
+        """
+        with self.write_lock, self.write_connection as conn:
+            return self.release_file(conn, destination)
+
+    def delete_prefix(self, prefix, limit=1000):
+        """deletes up to limit files whose path starts with prefix in one transaction, returns
+           their paths, callers repeat until nothing is left so writers get the lock in between
+        """
+        with self.write_lock, self.write_connection as conn:
+            file_paths = [row[0] for row in conn.execute(
+                "SELECT file_path FROM files WHERE file_path >= ? AND file_path < ? ORDER BY file_path LIMIT ?",
+                (prefix, prefix + PATH_END, limit))]
+            for file_path in file_paths:
+                self.release_file(conn, file_path)
+            return tuple(file_paths)
+
+    def list_directory(self, prefix, after='', limit=1000):
+        """returns up to limit ((name, size, created_at), ...) of the entries below prefix past
+           the name after, in path order
+           1) a file directly below prefix is its name, a deeper one shows as the name of its
+              subdirectory with a trailing / (size and created_at None), once
+           2) the unique index on file_path serves every step, a subdirectory costs one seek
+              past its whole subtree whatever it holds
+        """
+        conn = self.read_connection()
+        cursor = prefix + after + (PATH_END if after.endswith('/') else '')
+        entries = []
+        while len(entries) < limit:
+            rows = conn.execute(
+                '''SELECT file_path, size, created_at FROM files WHERE file_path > ? AND file_path < ?
+                   ORDER BY file_path LIMIT ?''', (cursor, prefix + PATH_END, limit - len(entries))).fetchall()
+            if not rows:
+                break
+            for file_path, size, created_at in rows:
+                name = file_path[len(prefix):]
+                if '/' in name:
+                    directory = name[:name.index('/') + 1]
+                    entries.append((directory, None, None))
+                    cursor = prefix + directory + PATH_END
+                    break
+                entries.append((name, size, created_at))
+                cursor = file_path
+        return tuple(entries)
+
+    def stat_file(self, file_path):
+        """returns (size, created_at, number of blocks) of file_path, None if there is no such file"""
+        return self.read_connection().execute(
+            '''SELECT f.size, f.created_at, COUNT(DISTINCT b.block_index)
+               FROM files f LEFT JOIN blocks b ON b.file_id = f.file_id
+               WHERE f.file_path=? GROUP BY f.file_id''', (file_path,)).fetchone()
+
+    def has_prefix(self, prefix):
+        """True if a file path starts with prefix, i.e. prefix ending with / is a directory"""
+        return self.read_connection().execute(
+            "SELECT 1 FROM files WHERE file_path >= ? AND file_path < ? LIMIT 1",
+            (prefix, prefix + PATH_END)).fetchone() is not None
+
+    def pending_garbage(self, node, before, limit=1000):
+        """returns ((block_id, file_path), ...), up to limit unreferenced copies on node (host,
+           port) deleted before the time before
+        """
+        return tuple(self.read_connection().execute(
+            '''SELECT block_id, file_path FROM garbage WHERE host=? AND port=? AND deleted_at < ?
+               ORDER BY block_id LIMIT ?''', (node[0], int(node[1]), before, limit)).fetchall())
+
+    def clear_garbage(self, node, block_ids):
+        """forgets the copies of block_ids on node, removed or referenced again"""
+        with self.write_lock, self.write_connection as conn:
+            conn.executemany("DELETE FROM garbage WHERE host=? AND port=? AND block_id=?",
+                             ((node[0], int(node[1]), block_id) for block_id in block_ids))
+
+    def garbage_count(self):
+        return self.read_connection().execute("SELECT COUNT(*) FROM garbage").fetchone()[0]
+
+    def id_batches(self, block_ids, size=500):
+        # stays below SQLite's limit on bound parameters
+        block_ids = sorted(set(block_ids))
+        for start in range(0, len(block_ids), size):
+            yield block_ids[start:start + size]
+
+    def find_blocks(self, block_ids):
+        """returns ((block_id, host, port, role, codec), ...), every known copy of the given block ids
+           whichever file references them
+        """
+        rows = []
+        for batch in self.id_batches(block_ids):
+            rows.extend(self.read_connection().execute(
+                f'''SELECT DISTINCT block_id, host, port, role, codec FROM blocks
+                    WHERE block_id IN ({','.join('?' * len(batch))})
+                    ORDER BY block_id, role''', batch).fetchall())
+        return tuple(rows)
+
+    def block_refcounts(self, block_ids):
+        """returns ((block_id, refcount), ...) of the given block ids that are still referenced"""
+        rows = []
+        for batch in self.id_batches(block_ids):
+            rows.extend(self.read_connection().execute(
+                f"SELECT block_id, refcount FROM block_refs WHERE block_id IN ({','.join('?' * len(batch))})",
+                batch).fetchall())
+        return tuple(rows)
+
+    def list_block_copies(self, after=0, limit=10000):
+        """returns ((rowid, block_id, file_path, host, port), ...), up to limit block rows past
+           rowid after, paging with the last rowid walks every copy of every block
+        """
+        return tuple(self.read_connection().execute(
+            '''SELECT b.rowid, b.block_id, f.file_path, b.host, b.port
+               FROM blocks b JOIN files f ON f.file_id = b.file_id
+               WHERE b.rowid > ? ORDER BY b.rowid LIMIT ?''', (after, limit)).fetchall())
+
+    def relocate_block(self, block_id, old_node, new_node):
+        """moves the copy of block_id on old_node to new_node for every file referencing it,
+           with old_node None new_node becomes an extra replica
+           returns the paths of those files
+        """
+        with self.write_lock, self.write_connection as conn:
+            if old_node is not None:
+                conn.execute("UPDATE blocks SET host=?, port=? WHERE block_id=? AND host=? AND port=?",
+                             (new_node[0], int(new_node[1]), block_id, old_node[0], int(old_node[1])))
+            else:
+                conn.execute(
+                    '''INSERT INTO blocks (file_id, block_index, block_id, host, port, role, codec,
+                                           block_offset, block_length)
+                       SELECT file_id, block_index, block_id, ?, ?, 'replica', codec, block_offset, block_length
+                       FROM blocks WHERE block_id=? AND role='primary' ''',
+                    (new_node[0], int(new_node[1]), block_id))
+            return tuple(row[0] for row in conn.execute(
+                '''SELECT DISTINCT f.file_path FROM files f JOIN blocks b ON b.file_id = f.file_id
+                   WHERE b.block_id=?''', (block_id,)))
 
     def get_file_blocks(self, file_path):
-        with self.connection_lock:
-            conn = self.get_connection()
-            try:
-                cursor = conn.cursor()
-                cursor.execute(
-                    f"SELECT primary_blocks, replica_blocks FROM {self.table} WHERE file_path=?", (file_path,))
-                result = cursor.fetchone()
-                return json.dumps({'primary_block': result[0],
-                                   'replica_block': result[1]
-                                   }) if result else None
-            finally:
-                conn.close()
+        """returns ((block_index, block_id, host, port, role, codec, block_offset, block_length), ...)
+           or None if there is no such file, block_length is None unless the block is a container
+        """
+        rows = self.read_connection().execute(
+            '''SELECT b.block_index, b.block_id, b.host, b.port, b.role, b.codec, b.block_offset, b.block_length
+               FROM files f LEFT JOIN blocks b ON b.file_id = f.file_id
+               WHERE f.file_path=?
+               ORDER BY b.block_index, b.role''', (file_path,)).fetchall()
+        if not rows:
+            return None
+        # a file without blocks still joins one row of NULLs
+        return tuple(row for row in rows if row[1] is not None)
+
+    def get_files_blocks(self, file_paths):
+        """returns ((file_path, rows), ...) like get_file_blocks for every existing path, in batches"""
+        files = {}
+        for batch in self.id_batches(file_paths):
+            for file_path, *row in self.read_connection().execute(
+                    f'''SELECT f.file_path, b.block_index, b.block_id, b.host, b.port, b.role, b.codec,
+                              b.block_offset, b.block_length
+                       FROM files f LEFT JOIN blocks b ON b.file_id = f.file_id
+                       WHERE f.file_path IN ({','.join('?' * len(batch))})
+                       ORDER BY f.file_path, b.block_index, b.role''', batch):
+                rows = files.setdefault(file_path, [])
+                if row[1] is not None:
+                    rows.append(tuple(row))
+        return tuple((file_path, tuple(rows)) for file_path, rows in files.items())
+
+    def save_packed_files(self, container_id, data_nodes, codec, files):
+        """stores files ((file_path, offset, length), ...) packed into container_id, which is on
+           data_nodes (primary first), replacing previous entries of the paths in one transaction
+        """
+        files = [(file_path, int(offset), int(length)) for file_path, offset, length in files]
+        now = time.time()
+        with self.write_lock, self.write_connection as conn:
+            for file_path, _, _ in files:
+                self.release_file(conn, file_path)
+            conn.executemany("INSERT INTO files (file_path, created_at, slot, size) VALUES (?, ?, ?, ?)",
+                             ((file_path, now, path_slot(file_path), length) for file_path, _, length in files))
+            conn.executemany(
+                '''INSERT INTO blocks (file_id, block_index, block_id, host, port, role, codec, block_offset, block_length)
+                   SELECT file_id, 0, ?, ?, ?, ?, ?, ?, ? FROM files WHERE file_path=?''',
+                ((container_id, data_node[0], int(data_node[1]), 'primary' if i == 0 else 'replica', codec,
+                  offset, length, file_path)
+                 for file_path, offset, length in files for i, data_node in enumerate(data_nodes)))
+            conn.execute('''INSERT INTO block_refs (block_id, refcount) VALUES (?, ?)
+                            ON CONFLICT (block_id) DO UPDATE SET refcount = refcount + excluded.refcount''',
+                         (container_id, len(files)))
+            conn.execute("DELETE FROM garbage WHERE block_id=?", (container_id,))
+
+    def owned_slots(self):
+        """returns ((slot, epoch), ...) of the slots this shard owns"""
+        return tuple(self.read_connection().execute("SELECT slot, epoch FROM slots ORDER BY slot").fetchall())
+
+    def claim_slots(self, slots, epoch):
+        with self.write_lock, self.write_connection as conn:
+            conn.executemany("INSERT OR REPLACE INTO slots (slot, epoch) VALUES (?, ?)",
+                             ((int(slot), epoch) for slot in slots))
+
+    def export_slot(self, slot):
+        """returns ((file_path, created_at, size, rows), ...) of the files of slot, rows like get_file_blocks"""
+        files = {}
+        for file_path, created_at, size, *row in self.read_connection().execute(
+                '''SELECT f.file_path, f.created_at, f.size, b.block_index, b.block_id, b.host, b.port, b.role,
+                          b.codec, b.block_offset, b.block_length
+                   FROM files f LEFT JOIN blocks b ON b.file_id = f.file_id
+                   WHERE f.slot=?
+                   ORDER BY f.file_path, b.block_index, b.role''', (slot,)):
+            _, _, rows = files.setdefault(file_path, (created_at, size, []))
+            if row[1] is not None:
+                rows.append(tuple(row))
+        return tuple((file_path, created_at, size, tuple(rows))
+                     for file_path, (created_at, size, rows) in files.items())
+
+    def import_slot(self, slot, files, epoch):
+        """stores the export_slot files of slot and claims it at epoch, in one transaction"""
+        with self.write_lock, self.write_connection as conn:
+            for file_path, created_at, size, rows in files:
+                self.release_file(conn, file_path, collect=False)
+                file_id = conn.execute("INSERT INTO files (file_path, created_at, slot, size) VALUES (?, ?, ?, ?)",
+                                       (file_path, created_at, int(slot), size)).lastrowid
+                conn.executemany(
+                    '''INSERT INTO blocks (file_id, block_index, block_id, host, port, role, codec,
+                                           block_offset, block_length)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                    ((file_id, *row) for row in rows))
+                self.add_references(conn, file_id)
+            conn.execute("INSERT OR REPLACE INTO slots (slot, epoch) VALUES (?, ?)", (int(slot), epoch))
+
+    def drop_slot(self, slot):
+        """releases every file of slot and gives the slot up, returns the number of files"""
+        with self.write_lock, self.write_connection as conn:
+            file_paths = [row[0] for row in conn.execute("SELECT file_path FROM files WHERE slot=?", (slot,))]
+            for file_path in file_paths:
+                self.release_file(conn, file_path, collect=False)
+            conn.execute("DELETE FROM slots WHERE slot=?", (slot,))
+            return len(file_paths)
@@ -0,0 +1,45 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from benchmarks.cluster import LocalCluster  # noqa: E402
+from benchmarks.run import compare, percentile  # noqa: E402
+
+
+class CompareTest(unittest.TestCase):
+    def result(self, workload, mb_s, p99_ms):
+        return {'workload': workload, 'block_size': 1024, 'replication': 2, 'file_size': 4096,
+                'concurrency': 1, 'mb_s': mb_s, 'p99_ms': p99_ms}
+
+    def test_regressions_beyond_tolerance(self):
+        baseline = [self.result('put', 100, 10), self.result('get', 100, 10)]
+        results = [self.result('put', 85, 11), self.result('get', 70, 13), self.result('range', 1, 100)]
+        regressions = compare(results, baseline, 0.2)
+        self.assertEqual([(r['workload'], r['metric']) for r in regressions], [('get', 'mb_s'), ('get', 'p99_ms')])
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0.5), 51)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile([3], 0.99), 3)
+
+
+class LocalClusterTest(unittest.TestCase):
+    def test_round_trip(self):
+        with LocalCluster(data_nodes=2, block_size=64 * 1024) as cluster, cluster.client() as client:
+            path = os.path.join(cluster.dir, 'input')
+            data = os.urandom(200 * 1024)
+            with open(path, 'wb') as f:
+                f.write(data)
+            report = client.create_file(path, '/dir/file')
+            self.assertEqual(len(report), 4)
+            self.assertTrue(all(result['replicas'] == 1 for result in report))
+            self.assertEqual(client.read_file('/dir/file'), data)
+            self.assertEqual(client.read_range('/dir/file', 60 * 1024, 10 * 1024), data[60 * 1024:70 * 1024])
+        self.assertFalse(os.path.exists(cluster.dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import configparser
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_service'))
+
+from block_cache import BlockCache, DiskBlockCache, TieredBlockCache, block_cache_from_config  # noqa: E402
+
+
+class BlockCacheTest(unittest.TestCase):
+    def test_least_recently_used_blocks_go_past_the_budget(self):
+        cache = BlockCache(max_bytes=300)
+        for block_id in ('a', 'b', 'c'):
+            cache.put(block_id, bytes(100))
+        self.assertIsNotNone(cache.get('a'))
+        cache.put('d', bytes(100))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        cache.put('huge', bytes(1000))
+        self.assertIsNone(cache.get('huge'))
+        stats = cache.stats()
+        self.assertEqual((stats['blocks'], stats['bytes'], stats['evictions']), (3, 300, 1))
+
+
+class DiskBlockCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_files_are_evicted_least_recently_used_first_across_restarts(self):
+        cache = DiskBlockCache(self.dir, max_bytes=300)
+        for block_id in ('a', 'b', 'c'):
+            cache.put(block_id, block_id.encode() * 100)
+            # distinct modification times to order them by after a restart
+            time.sleep(0.01)
+        self.assertEqual(cache.get('a'), b'a' * 100)
+        cache.put('d', b'd' * 100)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(len(os.listdir(self.dir)), 3)
+
+        cache = DiskBlockCache(self.dir, max_bytes=200)
+        self.assertEqual(cache.stats()['bytes'], 200)
+        self.assertIsNone(cache.get('c'))
+        self.assertEqual(cache.get('a'), b'a' * 100)
+        self.assertEqual(cache.get('d'), b'd' * 100)
+
+
+class TieredBlockCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_disk_hits_are_promoted_to_memory(self):
+        cache = TieredBlockCache(memory_bytes=150, disk_dir=self.dir, disk_bytes=1000)
+        cache.put('a', bytearray(b'a' * 100))
+        cache.put('b', b'b' * 100)
+        self.assertEqual(cache.get('a'), b'a' * 100)
+        stats = cache.stats()
+        self.assertEqual((stats['memory_misses'], stats['disk_hits']), (1, 1))
+        self.assertEqual(cache.get('a'), b'a' * 100)
+        self.assertEqual(cache.stats()['memory_hits'], 1)
+        self.assertIsNone(cache.get('missing'))
+
+    def test_config(self):
+        config = configparser.ConfigParser()
+        config['client'] = {'block_cache_bytes': '0'}
+        self.assertIsNone(block_cache_from_config(config))
+        config['client']['block_cache_dir'] = self.dir
+        self.assertIsNotNone(block_cache_from_config(config).disk)
+
+
+if __name__ == '__main__':
+    unittest.main()
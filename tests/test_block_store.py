@@ -0,0 +1,143 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_service'))
+
+from block_cache import BlockCache  # noqa: E402
+from block_store import FileBlockStore, LogBlockStore  # noqa: E402
+
+
+class FileBlockStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_one_file_per_block(self):
+        store = FileBlockStore(self.dir, 1801)
+        store.put('b1', 'dest', b'hello world')
+        self.assertTrue(os.path.exists(os.path.join(self.dir, 'dest', '1801', 'b1.txt')))
+        self.assertEqual(store.read('b1', 'dest'), b'hello world')
+        self.assertEqual(store.read('b1', 'dest', 6, 3), b'wor')
+        self.assertTrue(store.delete('b1', 'dest'))
+        self.assertIsNone(store.read('b1', 'dest'))
+        self.assertFalse(store.delete('b1', 'dest'))
+        store.put('b2', 'dest', b'2')
+        store.put('b3', 'other', b'3')
+        self.assertEqual(store.delete_many((('b1', 'dest'), ('b2', 'dest'), ('b3', 'other'))), 2)
+        self.assertIsNone(store.read('b3', 'other'))
+
+
+class LogBlockStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        shutil.rmtree(self.dir)
+
+    def open_store(self, **kwargs):
+        kwargs.setdefault('compact_interval', 0)
+        store = LogBlockStore(self.dir, **kwargs)
+        self.stores.append(store)
+        return store
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.dir) if name.endswith('.log'))
+
+    def test_blocks_share_segments_and_survive_a_restart(self):
+        store = self.open_store(segment_bytes=10000)
+        blocks = {f"block-{i}": os.urandom(3000) for i in range(10)}
+        for block_id, data in blocks.items():
+            store.put(block_id, 'dest', data)
+        store.put('empty', 'dest', b'')
+        # three blocks and their headers fit a segment
+        self.assertEqual(len(self.segments()), 4)
+        # the DataNode reports the disk under root
+        self.assertEqual(store.root, self.dir)
+        self.assertEqual(store.read('block-3', 'dest', 100, 50), blocks['block-3'][100:150])
+        f, offset, length = store.open_block('block-4', 'dest')
+        with f:
+            f.seek(offset)
+            self.assertEqual(f.read(length), blocks['block-4'])
+        store.close()
+        self.stores.remove(store)
+
+        store = self.open_store(segment_bytes=10000)
+        for block_id, data in blocks.items():
+            self.assertEqual(store.read(block_id, 'any/path'), data)
+        self.assertEqual(store.read('empty', 'dest'), b'')
+        self.assertIsNone(store.read('missing', 'dest'))
+        self.assertIsNone(store.open_block('missing', 'dest'))
+
+    def test_concurrent_writers_share_group_commits(self):
+        store = self.open_store()
+        blocks = {f"block-{i}": os.urandom(5000 + i) for i in range(64)}
+
+        def write(block_id):
+            writer = store.writer(block_id, 'dest', len(blocks[block_id]))
+            for start in range(0, len(blocks[block_id]), 1000):
+                writer.write(blocks[block_id][start:start + 1000])
+            writer.commit()
+
+        threads = [threading.Thread(target=write, args=(block_id,)) for block_id in blocks]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for block_id, data in blocks.items():
+            self.assertEqual(store.read(block_id, 'dest'), data)
+        stats = store.stats()
+        self.assertEqual(stats['committed_writes'], 64)
+        self.assertLess(stats['commits'], 64)
+        self.assertEqual(stats['writers'], 0)
+
+    def test_aborted_and_short_writes_are_never_visible(self):
+        store = self.open_store()
+        writer = store.writer('aborted', 'dest', 100)
+        writer.write(bytes(50))
+        writer.abort()
+        writer = store.writer('short', 'dest', 100)
+        writer.write(bytes(50))
+        with self.assertRaises(ValueError):
+            writer.commit()
+        with self.assertRaises(ValueError):
+            store.writer('long', 'dest', 10).write(bytes(11))
+        self.assertIsNone(store.read('aborted', 'dest'))
+        self.assertIsNone(store.read('short', 'dest'))
+
+    def test_compaction_reclaims_deleted_blocks(self):
+        store = self.open_store(segment_bytes=10000, compact_ratio=0.5)
+        blocks = {f"block-{i}": os.urandom(3000) for i in range(9)}
+        for block_id, data in blocks.items():
+            store.put(block_id, 'dest', data)
+        store.put('block-0', 'dest', blocks['block-0'])
+        for block_id in ('block-1', 'block-2'):
+            self.assertTrue(store.delete(block_id, 'dest'))
+        self.assertFalse(store.delete('block-1', 'dest'))
+        self.assertEqual(store.delete_many((('block-1', 'dest'), ('block-4', 'dest'), ('block-5', 'dest'))), 2)
+        for block_id in ('block-1', 'block-2', 'block-4', 'block-5'):
+            del blocks[block_id]
+        self.assertEqual(store.read('block-3', 'dest'), blocks['block-3'])  # cached
+        before = self.segments()
+        self.assertGreater(store.compact(), 0)
+        after = self.segments()
+        self.assertNotIn(before[0], after)
+        self.assertNotIn(before[1], after)
+        self.assertIn(before[2], after)
+        self.assertEqual(store.stats()['compactions'], 2)
+        store.cache = BlockCache()
+        for block_id, data in blocks.items():
+            self.assertEqual(store.read(block_id, 'dest'), data)
+        self.assertEqual(store.compact(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
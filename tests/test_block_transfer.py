@@ -0,0 +1,100 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_service'))
+
+from block_store import FileBlockStore, LogBlockStore  # noqa: E402
+from block_transfer import BlockTransferConnection, BlockTransferServer  # noqa: E402
+from connection_pool import ConnectionPool  # noqa: E402
+
+
+class BlockTransferTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.servers = [self.start_server(name) for name in ('a', 'b', 'c')]
+        self.nodes = [('localhost', server.server_address[1]) for server in self.servers]
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+            server.store.close()
+        shutil.rmtree(self.root)
+
+    def make_store(self, name):
+        return FileBlockStore(os.path.join(self.root, name), 'node')
+
+    def start_server(self, name):
+        # port_offset 0: pipeline entries are the transfer ports themselves
+        server = BlockTransferServer(('localhost', 0), self.make_store(name),
+                                     ConnectionPool(connect=BlockTransferConnection), 0, buffer_size=4096)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def stored(self, name, block_id):
+        return self.servers['abc'.index(name)].store.read(block_id, 'dest')
+
+    def test_write_is_chained_and_read_back(self):
+        data = os.urandom(100000)
+        conn = BlockTransferConnection(*self.nodes[0])
+        try:
+            acks = conn.write_block('b1', 'dest', self.nodes[1:], memoryview(data))
+            self.assertEqual(acks, 3)
+            for name in ('a', 'b', 'c'):
+                self.assertEqual(self.stored(name, 'b1'), data)
+            self.assertEqual(conn.read_block('b1', 'dest'), data)
+            self.assertIsNone(conn.read_block('missing', 'dest'))
+            self.assertEqual(conn.read_block('b1', 'dest', 99990, 100), data[99990:])
+            self.assertEqual(conn.read_block('b1', 'dest', 500, 10), data[500:510])
+            self.assertEqual(conn.read_block('b1', 'dest', 200000, 10), b'')
+            # the connection stays usable after every request
+            conn.ping()
+            self.assertEqual(conn.write_block('b2', 'dest', [], b'small'), 1)
+        finally:
+            conn.close()
+
+    def test_dead_downstream_reduces_acks(self):
+        self.servers[2].shutdown()
+        self.servers[2].server_close()
+        self.servers.pop().store.close()
+        conn = BlockTransferConnection(*self.nodes[0])
+        try:
+            acks = conn.write_block('b1', 'dest', self.nodes[1:], os.urandom(10000))
+            self.assertEqual(acks, 2)
+            self.assertIsNotNone(self.stored('a', 'b1'))
+            self.assertIsNotNone(self.stored('b', 'b1'))
+        finally:
+            conn.close()
+
+    def test_copy_pushes_a_stored_block_down_a_pipeline(self):
+        data = os.urandom(20000)
+        conn = BlockTransferConnection(*self.nodes[0])
+        try:
+            self.assertEqual(conn.write_block('b1', 'dest', [], data), 1)
+            start = time.monotonic()
+            # 5 chunks of buffer_size at 40000 bytes per second
+            self.assertEqual(conn.copy_block('b1', 'dest', self.nodes[1:], rate=40000), 2)
+            self.assertGreater(time.monotonic() - start, 0.35)
+            self.assertEqual(self.stored('b', 'b1'), data)
+            self.assertEqual(self.stored('c', 'b1'), data)
+            self.assertIsNone(conn.copy_block('missing', 'dest', self.nodes[1:]))
+            self.assertTrue(conn.delete_block('b1', 'dest'))
+            self.assertFalse(conn.delete_block('b1', 'dest'))
+            self.assertIsNone(conn.read_block('b1', 'dest'))
+        finally:
+            conn.close()
+
+
+
+class LogStoreBlockTransferTest(BlockTransferTest):
+    def make_store(self, name):
+        return LogBlockStore(os.path.join(self.root, name), compact_interval=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
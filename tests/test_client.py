@@ -0,0 +1,551 @@
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+import zlib
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_service'))
+
+from block_cache import TieredBlockCache  # noqa: E402
+from block_store import LogBlockStore  # noqa: E402
+from block_transfer import BlockTransferConnection, BlockTransferServer  # noqa: E402
+from client import BlockUploadError, FilesystemClient, is_local_host  # noqa: E402
+from compression import BlockCompressor  # noqa: E402
+from connection_pool import ConnectionPool  # noqa: E402
+from dedup import content_block_id  # noqa: E402
+from erasure import new_stripe_ids  # noqa: E402
+
+
+class FakeTransportClient(FilesystemClient):
+    """records every send instead of talking to data nodes"""
+
+    def __init__(self, block_size, max_in_flight, max_retries, failing_nodes=(), pool=None, compressor=None,
+                 storage_policy='replication'):
+        super().__init__(block_size, max_in_flight, max_retries, pool=pool, compressor=compressor,
+                         storage_policy=storage_policy)
+        self.failing_nodes = set(failing_nodes)
+        self.sent = []
+        self.attempts = {}
+        self.active_blocks = {}
+        self.peak_blocks = 0
+        self.lock = threading.Lock()
+
+    def send_to_data_node(self, block_id, data_node, block_view, destination, replica_nodes=()):
+        """walks the pipeline like the data nodes do, stopping at the first failing node"""
+        with self.lock:
+            self.active_blocks[block_id] = self.active_blocks.get(block_id, 0) + 1
+            self.peak_blocks = max(self.peak_blocks, len(self.active_blocks))
+        time.sleep(0.01)
+        acks = 0
+        with self.lock:
+            self.active_blocks[block_id] -= 1
+            if not self.active_blocks[block_id]:
+                del self.active_blocks[block_id]
+            for node in (data_node, *replica_nodes):
+                self.attempts[(block_id, node)] = self.attempts.get((block_id, node), 0) + 1
+                if node in self.failing_nodes:
+                    break
+                self.sent.append((block_id, node, bytes(block_view)))
+                acks += 1
+        return acks
+
+
+class UploadTestCase(unittest.TestCase):
+    nodes = [('localhost', 1801), ('localhost', 1802), ('localhost', 1803)]
+
+    def setUp(self):
+        self.content = os.urandom(10 * 1024 + 123)
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.content)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def layout(self, num_blocks, replication=1):
+        primary_blocks, replica_blocks = [], []
+        for i in range(num_blocks):
+            primary_blocks.append((f"block-{i}", self.nodes[i % len(self.nodes)]))
+            for r in range(1, replication + 1):
+                replica_blocks.append((f"block-{i}", self.nodes[(i + r) % len(self.nodes)]))
+        return primary_blocks, replica_blocks
+
+    def upload(self, client, primary_blocks, replica_blocks):
+        with open(self.path, 'rb') as f:
+            with mmap.mmap(f.fileno(), length=0, access=mmap.ACCESS_READ) as mm:
+                return client.upload_blocks(mm, primary_blocks, replica_blocks, 'dest')
+
+
+class UploadBlocksTest(UploadTestCase):
+    def test_offsets_replicas_and_window(self):
+        client = FakeTransportClient(1024, max_in_flight=2, max_retries=2)
+        primary_blocks, replica_blocks = self.layout(11)
+        report = self.upload(client, primary_blocks, replica_blocks)
+        self.assertEqual([result['block_id'] for result in report], [block_id for block_id, _ in primary_blocks])
+        self.assertTrue(all(result['success'] and result['replicas'] == 1 for result in report))
+        sent = {(block_id, data_node): data for block_id, data_node, data in client.sent}
+        for i, (block_id, data_node) in enumerate(primary_blocks):
+            expected = self.content[i * 1024:(i + 1) * 1024]
+            self.assertEqual(sent[(block_id, data_node)], expected)
+            self.assertEqual(sent[(block_id, replica_blocks[i][1])], expected)
+        self.assertEqual(len(sent[('block-10', primary_blocks[10][1])]), 123)
+        self.assertLessEqual(client.peak_blocks, 2)
+
+    def test_retries_stop_and_failures_are_reported(self):
+        client = FakeTransportClient(1024, max_in_flight=3, max_retries=2, failing_nodes=[self.nodes[1]])
+        primary_blocks, replica_blocks = self.layout(11)
+        report = self.upload(client, primary_blocks, replica_blocks)
+        for i, result in enumerate(report):
+            if primary_blocks[i][1] == self.nodes[1]:
+                self.assertFalse(result['stored'])
+                self.assertEqual(result['attempts'], 3)
+            elif replica_blocks[i][1] == self.nodes[1]:
+                self.assertTrue(result['stored'])
+                self.assertTrue(result['under_replicated'])
+                self.assertEqual(result['replicas'], 0)
+                self.assertEqual(client.attempts[(result['block_id'], self.nodes[1])], 3)
+            else:
+                self.assertTrue(result['success'])
+                self.assertEqual(result['replicas'], 1)
+
+
+class CompressedUploadTest(UploadTestCase):
+    def setUp(self):
+        super().setUp()
+        # text blocks compress, random blocks are sent verbatim
+        self.content = b'log line 42 INFO request served\n' * 96 + os.urandom(2048)
+        with open(self.path, 'wb') as f:
+            f.write(self.content)
+        self.compressor = BlockCompressor('zlib', workers=2)
+        self.addCleanup(self.compressor.close)
+
+    def test_poorly_compressing_blocks_are_sent_verbatim(self):
+        client = FakeTransportClient(1024, max_in_flight=2, max_retries=0, compressor=self.compressor)
+        primary_blocks, replica_blocks = self.layout(6)
+        report = self.upload(client, primary_blocks, replica_blocks)
+        self.assertEqual([result['codec'] for result in report], ['zlib'] * 3 + ['none'] * 3)
+        sent = {block_id: data for block_id, _, data in client.sent}
+        self.assertLess(len(sent['block-0']), 100)
+        self.assertEqual(zlib.decompress(sent['block-0']), self.content[:1024])
+        self.assertEqual(sent['block-5'], self.content[5 * 1024:])
+
+    def test_codecs_are_committed_with_the_blocks(self):
+        name_node = mock.MagicMock(closed=False)
+        service = name_node.root.NameNodeService.return_value
+        primary_blocks, replica_blocks = self.layout(6)
+        service.create_blocks.return_value = primary_blocks, replica_blocks
+        client = FakeTransportClient(1024, max_in_flight=2, max_retries=0, compressor=self.compressor,
+                                     pool=ConnectionPool(connect=lambda host, port: name_node))
+        client.create_file(self.path, 'dest')
+        service.commit_blocks.assert_called_once_with(
+            'dest', tuple(primary_blocks), tuple(replica_blocks),
+            (('block-0', 'zlib'), ('block-1', 'zlib'), ('block-2', 'zlib')), False, None, False, len(self.content))
+
+
+class CreateFileTest(UploadTestCase):
+    def test_failed_blocks_raise_with_report(self):
+        name_node = mock.MagicMock(closed=False)
+        service = name_node.root.NameNodeService.return_value
+        service.create_blocks.return_value = self.layout(11)
+        pool = ConnectionPool(connect=lambda host, port: name_node)
+        client = FakeTransportClient(1024, max_in_flight=2, max_retries=0, failing_nodes=[self.nodes[0]],
+                                     pool=pool)
+        with self.assertRaises(BlockUploadError) as error:
+            client.create_file(self.path, 'dest')
+        self.assertEqual(len(error.exception.report), 11)
+        self.assertFalse(error.exception.report[0]['success'])
+        self.assertTrue(error.exception.report[1]['success'])
+        # a block no data node stored keeps the file invisible, compressed or not
+        service.commit_blocks.assert_not_called()
+
+    def test_under_replicated_blocks_are_committed_with_their_acked_copies(self):
+        name_node = mock.MagicMock(closed=False)
+        service = name_node.root.NameNodeService.return_value
+        primary_blocks, replica_blocks = self.layout(11)
+        # nodes[0] only holds replicas, and fails
+        primary_blocks = [(block_id, self.nodes[1 + i % 2]) for i, (block_id, _) in enumerate(primary_blocks)]
+        service.create_blocks.return_value = primary_blocks, replica_blocks
+        client = FakeTransportClient(1024, max_in_flight=2, max_retries=0, failing_nodes=[self.nodes[0]],
+                                     pool=ConnectionPool(connect=lambda host, port: name_node))
+        with self.assertRaises(BlockUploadError):
+            client.create_file(self.path, 'dest')
+        committed_replicas = service.commit_blocks.call_args.args[2]
+        self.assertTrue(committed_replicas)
+        self.assertNotIn(self.nodes[0], {data_node for _, data_node in committed_replicas})
+
+    def test_empty_files_are_committed_without_blocks(self):
+        name_node = mock.MagicMock(closed=False)
+        service = name_node.root.NameNodeService.return_value
+        open(self.path, 'wb').close()
+        client = FakeTransportClient(1024, max_in_flight=2, max_retries=0,
+                                     pool=ConnectionPool(connect=lambda host, port: name_node))
+        self.assertEqual(client.create_file(self.path, 'dest'), [])
+        service.create_blocks.assert_not_called()
+        service.commit_blocks.assert_called_once_with('dest', (), (), (), False, None, False, 0)
+
+
+class DedupUploadTest(UploadTestCase):
+    def test_only_new_blocks_are_sent(self):
+        name_node = mock.MagicMock(closed=False)
+        service = name_node.root.NameNodeService.return_value
+        client = FakeTransportClient(1024, max_in_flight=2, max_retries=0,
+                                     pool=ConnectionPool(connect=lambda host, port: name_node))
+        client.dedup = True
+        block_ids = [content_block_id(self.content[i:i + 1024]) for i in range(0, len(self.content), 1024)]
+        primary_blocks = [(block_id, self.nodes[0]) for block_id in block_ids]
+        service.create_dedup_blocks.return_value = primary_blocks, [], (3, 10), ((block_ids[0], 'zlib'),)
+        report = client.create_file(self.path, 'dest')
+        service.create_dedup_blocks.assert_called_once_with('dest', tuple(block_ids))
+        # reused blocks keep their codec
+        service.commit_blocks.assert_called_once_with('dest', tuple(primary_blocks), (), ((block_ids[0], 'zlib'),),
+                                                      False, None, False, len(self.content))
+        self.assertEqual([result['block_id'] for result in report], [block_ids[3], block_ids[10]])
+        self.assertEqual(sorted(client.sent), sorted([
+            (block_ids[3], self.nodes[0], self.content[3 * 1024:4 * 1024]),
+            (block_ids[10], self.nodes[0], self.content[10 * 1024:])]))
+        service.create_blocks.assert_not_called()
+
+class ErasureCodedTest(UploadTestCase):
+    def test_stripes_are_written_with_parity_and_rebuilt_on_read(self):
+        # 11 data blocks in stripes of 4 + 2, the last stripe holds 3
+        primary_blocks = []
+        for first in range(0, 11, 4):
+            block_ids = new_stripe_ids(4, 2, min(4, 11 - first))
+            primary_blocks.extend((block_id, ('localhost', 1801 + j)) for j, block_id in enumerate(block_ids))
+        name_node = mock.MagicMock(closed=False)
+        service = name_node.root.NameNodeService.return_value
+        service.create_blocks.return_value = primary_blocks, []
+        pool = ConnectionPool(connect=lambda host, port: name_node)
+        client = FakeTransportClient(1024, max_in_flight=2, max_retries=0, pool=pool, storage_policy='rs-4-2')
+        report = client.create_file(self.path, 'dest')
+        service.create_blocks.assert_called_once_with('dest', len(self.content), 'rs-4-2')
+        self.assertEqual(len(report), 17)
+        stored = {block_id: data for block_id, _, data in client.sent}
+        self.assertEqual(stored[primary_blocks[0][0]], self.content[:1024])
+        self.assertEqual(stored[primary_blocks[14][0]], self.content[10 * 1024:])
+
+        reader = FakeReadClient(stored, read_ahead=3)
+        reader.get_block_locations = lambda source_path: FilesystemClient.get_block_locations(reader, source_path)
+        reader.pool = pool
+        service.get_file_table_entry.return_value = primary_blocks, (), (), ()
+        # two blocks of every stripe are lost, data and parity
+        for lost in (0, 5, 6, 8, 12, 15):
+            del stored[primary_blocks[lost][0]]
+        self.assertEqual(reader.read_file('dest'), self.content)
+        self.assertEqual(reader.read_range('dest', 3000, 7000), self.content[3000:10000])
+
+    def test_dedup_can_not_be_erasure_coded(self):
+        client = FakeTransportClient(1024, max_in_flight=2, max_retries=0, storage_policy='rs-4-2')
+        client.dedup = True
+        with self.assertRaises(ValueError):
+            client.create_file(self.path, 'dest')
+
+
+class PackedFilesTest(unittest.TestCase):
+    nodes = (('localhost', 1801), ('localhost', 1802))
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.files = []
+        for i, size in enumerate([100] * 25 + [0, 700, 5000]):
+            path = os.path.join(self.dir, f"f{i}")
+            with open(path, 'wb') as f:
+                f.write(os.urandom(size))
+            self.files.append((path, f"/small/f{i}"))
+        self.name_node = mock.MagicMock(closed=False)
+        self.service = self.name_node.root.NameNodeService.return_value
+        self.service.allocate_container.side_effect = lambda: (f"container-{uuid.uuid4().hex}", self.nodes)
+        self.service.create_blocks.return_value = (
+            tuple((f"block-{i}", self.nodes[0]) for i in range(5)), ())
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def content(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_small_files_are_packed_and_read_back(self):
+        pool = ConnectionPool(connect=lambda host, port: self.name_node)
+        client = FakeTransportClient(1024, max_in_flight=2, max_retries=0, pool=pool)
+        client.small_file_bytes = 1024
+        report = client.put_many(self.files)
+        # 25 * 100 + 0 + 700 bytes fit in 4 containers of 1024, the 5000 byte file is a plain put
+        self.assertEqual(len(report), 4)
+        self.assertEqual(sum(result['files'] for result in report), 27)
+        self.service.create_blocks.assert_called_once_with('/small/f27', 5000, 'replication')
+        entries = {}
+        for call in self.service.commit_container.call_args_list:
+            container_id, data_nodes, codec, files = call.args
+            self.assertEqual((data_nodes, codec), (self.nodes, 'none'))
+            for path, offset, length in files:
+                entries[path] = (((container_id, data_nodes[0]),), ((container_id, data_nodes[1]),), (),
+                                 ((container_id, offset, length),))
+        self.assertEqual(len(entries), 27)
+
+        stored = {block_id: data for block_id, node, data in client.sent if node == self.nodes[0]}
+        reader = FakeReadClient(stored, read_ahead=3)
+        reader.pool = pool
+        self.service.get_file_table_entries.side_effect = lambda paths: tuple(
+            (path, entries[path]) for path in paths if path in entries)
+        paths = [destination for _, destination in self.files[:27]]
+        files = reader.get_many(paths)
+        self.assertEqual(list(files), paths)
+        for local_path, destination in self.files[:27]:
+            self.assertEqual(files[destination], self.content(local_path))
+        # one read per container, not per file
+        self.assertEqual(len(reader.reads), 4)
+
+        reader.reads.clear()
+        self.assertEqual(reader.get_many(['/small/f26'])['/small/f26'], self.content(self.files[26][0]))
+        container_id, offset, length = entries['/small/f26'][3][0]
+        self.assertEqual(reader.reads, [(container_id, offset, length)])
+
+        reader.get_block_locations = lambda source_path: FilesystemClient.block_locations(reader, entries[source_path])
+        self.assertEqual(reader.read_file('/small/f3'), self.content(self.files[3][0]))
+        self.assertEqual(reader.read_range('/small/f3', 90, 50), self.content(self.files[3][0])[90:])
+        with self.assertRaises(FileNotFoundError):
+            reader.get_many(['/small/f3', '/small/missing'])
+
+    def test_failed_containers_raise_with_report(self):
+        pool = ConnectionPool(connect=lambda host, port: self.name_node)
+        client = FakeTransportClient(1024, max_in_flight=2, max_retries=0, failing_nodes=[self.nodes[0]], pool=pool)
+        client.small_file_bytes = 1024
+        with self.assertRaises(BlockUploadError) as raised:
+            client.put_many(self.files[:27])
+        self.assertEqual(len(raised.exception.report), 4)
+        self.service.commit_container.assert_not_called()
+
+
+class FakeReadClient(FilesystemClient):
+    """serves blocks from a dict instead of data nodes"""
+
+    def __init__(self, blocks, read_ahead, codecs=None):
+        super().__init__(1024, read_ahead=read_ahead)
+        self.blocks = blocks
+        self.codecs = codecs or {}
+        self.active = 0
+        self.peak = 0
+        self.reads = []
+        self.lock = threading.Lock()
+
+    def get_block_locations(self, source_path):
+        return [(block_id, ('localhost', 1801)) for block_id in self.blocks], {}, self.codecs, {}, {}
+
+    def read_from_data_node(self, block_id, data_node, replica_blocks, source_path, offset=0, length=None):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            self.reads.append((block_id, offset, length))
+        time.sleep(0.01)
+        with self.lock:
+            self.active -= 1
+        if block_id not in self.blocks:
+            raise Exception("unable to retrieve block(s)")
+        data = self.blocks[block_id]
+        return data[offset:] if length is None else data[offset:offset + length]
+
+
+class ReadFileTest(unittest.TestCase):
+    def setUp(self):
+        self.blocks = {f"block-{i}": os.urandom(1024) for i in range(10)}
+        self.blocks['block-9'] = b'\x00\xff tail'
+
+    def test_blocks_are_yielded_in_order_within_read_ahead(self):
+        client = FakeReadClient(self.blocks, read_ahead=3)
+        self.assertEqual(list(client.iter_blocks('dest')), list(self.blocks.values()))
+        self.assertEqual(client.peak, 3)
+
+    def test_read_file_to_writes_binary(self):
+        client = FakeReadClient(self.blocks, read_ahead=2)
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            written = client.read_file_to('dest', path)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), b''.join(self.blocks.values()))
+            self.assertEqual(written, 9 * 1024 + 7)
+        finally:
+            os.remove(path)
+
+    def test_read_range_only_fetches_covered_slices(self):
+        client = FakeReadClient(self.blocks, read_ahead=2)
+        content = b''.join(self.blocks.values())
+        self.assertEqual(client.read_range('dest', 1000, 100), content[1000:1100])
+        self.assertEqual(client.reads, [('block-0', 1000, 24), ('block-1', 0, 76)])
+        client.reads.clear()
+        self.assertEqual(client.read_range('dest', 3072, 1024), content[3072:4096])
+        self.assertEqual(client.reads, [('block-3', 0, 1024)])
+        self.assertEqual(client.read_range('dest', 9 * 1024 + 5, 100), content[9 * 1024 + 5:])
+        self.assertEqual(client.read_range('dest', 20000, 10), b'')
+        self.assertEqual(client.read_range('dest', 10, 0), b'')
+
+    def test_compressed_blocks_are_decompressed(self):
+        text = b'0123456789abcdef' * 64
+        blocks = dict(self.blocks, **{'block-1': zlib.compress(text)})
+        client = FakeReadClient(blocks, read_ahead=2, codecs={'block-1': 'zlib'})
+        content = b''.join(self.blocks.values())
+        content = content[:1024] + text + content[2048:]
+        self.assertEqual(client.read_file('dest'), content)
+        client.reads.clear()
+        self.assertEqual(client.read_range('dest', 1000, 100), content[1000:1100])
+        # a compressed block is fetched whole
+        self.assertEqual(client.reads, [('block-0', 1000, 24), ('block-1', 0, None)])
+
+    def test_missing_file_does_not_create_local_file(self):
+        client = FakeReadClient(self.blocks, read_ahead=2)
+        client.get_block_locations = mock.Mock(side_effect=FileNotFoundError("File not found: dest"))
+        path = os.path.join(tempfile.mkdtemp(), 'out')
+        with self.assertRaises(FileNotFoundError):
+            client.read_file_to('dest', path)
+        self.assertFalse(os.path.exists(path))
+        os.rmdir(os.path.dirname(path))
+
+
+class CachedReadTest(unittest.TestCase):
+    def setUp(self):
+        self.blocks = {f"block-{i}": os.urandom(1024) for i in range(4)}
+
+    def test_blocks_read_whole_are_served_from_the_cache(self):
+        text = b'0123456789abcdef' * 64
+        blocks = dict(self.blocks, **{'block-1': zlib.compress(text)})
+        client = FakeReadClient(blocks, read_ahead=2, codecs={'block-1': 'zlib'})
+        client.block_cache = TieredBlockCache()
+        content = self.blocks['block-0'] + text + self.blocks['block-2'] + self.blocks['block-3']
+        # a range read of an uncompressed block does not fetch (or cache) the whole block
+        self.assertEqual(client.read_range('dest', 10, 2000), content[10:2010])
+        self.assertEqual(client.reads, [('block-0', 10, 1014), ('block-1', 0, None)])
+        client.reads.clear()
+        self.assertEqual(client.read_file('dest'), content)
+        self.assertEqual(sorted(client.reads), [('block-0', 0, None), ('block-2', 0, None), ('block-3', 0, None)])
+        client.reads.clear()
+        self.assertEqual(client.read_file('dest'), content)
+        self.assertEqual(client.read_range('dest', 1000, 100), content[1000:1100])
+        self.assertEqual(client.reads, [])
+        self.assertEqual(client.cache_stats()['memory_blocks'], 4)
+
+
+class FakeReplicaClient(FilesystemClient):
+    """every data node serves the block after its delay, or fails"""
+
+    def __init__(self, delays, failing=(), **kwargs):
+        super().__init__(1024, **kwargs)
+        self.delays = delays
+        self.failing = set(failing)
+        self.requests = []
+        self.cancelled = []
+        self.lock = threading.Lock()
+
+    def read_from(self, block_id, data_node, source_path, offset=0, length=None, attempt=None):
+        with self.lock:
+            self.requests.append(data_node[1])
+        if data_node in self.failing:
+            raise ConnectionRefusedError(f"{data_node} is down")
+        deadline = time.monotonic() + self.delays[data_node]
+        while time.monotonic() < deadline:
+            if attempt is not None and attempt.cancelled:
+                with self.lock:
+                    self.cancelled.append(data_node[1])
+                raise ConnectionAbortedError("read cancelled")
+            time.sleep(0.002)
+        return f"{block_id}@{data_node[1]}".encode()
+
+
+class HedgedReadTest(unittest.TestCase):
+    primary = ('localhost', 1801)
+    replicas = [('b1', ('localhost', 1802)), ('b1', ('localhost', 1803))]
+
+    def test_a_slow_read_is_hedged_and_the_loser_cancelled(self):
+        client = FakeReplicaClient({self.primary: 0.01, ('localhost', 1802): 0.01, ('localhost', 1803): 0.01},
+                                   hedge_percentile=95, hedge_min_delay=0.01)
+        for _ in range(20):
+            client.latency.record(self.primary, 0.01, 1024)
+            client.latency.record(('localhost', 1802), 0.02, 1024)
+            client.latency.record(('localhost', 1803), 0.03, 1024)
+        client.delays[self.primary] = 5
+        started = time.monotonic()
+        self.assertEqual(client.read_from_data_node('b1', self.primary, self.replicas, 'dest'), b'b1@1802')
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(client.requests, [1801, 1802])
+        deadline = time.monotonic() + 2
+        while not client.cancelled and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(client.cancelled, [1801])
+        # reads that lose to hedges push the slow primary back
+        for _ in range(10):
+            client.requests.clear()
+            self.assertEqual(client.read_from_data_node('b1', self.primary, self.replicas, 'dest'), b'b1@1802')
+            if client.requests == [1802]:
+                break
+        self.assertEqual(client.requests, [1802])
+
+    def test_failures_move_on_at_once_and_rank_the_node_last(self):
+        for hedge_percentile in (95, 0):
+            client = FakeReplicaClient({('localhost', 1803): 0}, failing=[self.primary, ('localhost', 1802)],
+                                       hedge_percentile=hedge_percentile)
+            self.assertEqual(client.read_from_data_node('b1', self.primary, self.replicas, 'dest'), b'b1@1803')
+            self.assertEqual(client.requests, [1801, 1802, 1803])
+            client.requests.clear()
+            self.assertEqual(client.read_from_data_node('b1', self.primary, self.replicas, 'dest'), b'b1@1803')
+            self.assertEqual(client.requests, [1803])
+            self.assertIn('error_rate_localhost:1801', client.replica_stats())
+
+    def test_all_copies_failing_raises(self):
+        client = FakeReplicaClient({}, failing=[self.primary, ('localhost', 1802), ('localhost', 1803)])
+        with self.assertRaises(Exception):
+            client.read_from_data_node('b1', self.primary, self.replicas, 'dest')
+        self.assertEqual(sorted(client.requests), [1801, 1802, 1803])
+
+    def test_closing_the_client_stops_the_hedge_threads(self):
+        with FakeReplicaClient({self.primary: 0.05, ('localhost', 1802): 0}, hedge_min_delay=0.01) as client:
+            for _ in range(20):
+                client.latency.record(self.primary, 0.01, 1024)
+            client.read_from_data_node('b1', self.primary, self.replicas, 'dest')
+            threads = list(client.hedge_executor._threads)
+            self.assertTrue(threads)
+        for thread in threads:
+            thread.join(timeout=2)
+            self.assertFalse(thread.is_alive())
+        with self.assertRaises(RuntimeError):
+            client.hedge_executor.submit(print)
+
+
+class ShortCircuitReadTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.server = BlockTransferServer(('localhost', 0), LogBlockStore(self.dir, compact_interval=0),
+                                          ConnectionPool(connect=BlockTransferConnection), 0)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.node = ('localhost', self.server.server_address[1])
+        self.data = os.urandom(50000)
+        conn = BlockTransferConnection(*self.node)
+        conn.write_block('b1', 'dest', [], self.data)
+        conn.close()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server.store.close()
+        shutil.rmtree(self.dir)
+
+    def test_local_blocks_skip_the_transfer_channel(self):
+        self.assertTrue(is_local_host('localhost'))
+        self.assertFalse(is_local_host('no-such-host.invalid'))
+        client = FilesystemClient(1024, transfer_port_offset=0, short_circuit=True)
+        with mock.patch.object(self.server, 'send_block', side_effect=AssertionError("read over the network")):
+            self.assertEqual(client.read_from_data_node('b1', self.node, [], 'dest'), self.data)
+            self.assertEqual(client.read_from_data_node('b1', self.node, [], 'dest', 49990, 100), self.data[49990:])
+            with self.assertRaises(Exception):
+                client.read_from_data_node('missing', self.node, [], 'dest')
+        client.short_circuit = False
+        self.assertEqual(client.read_from_data_node('b1', self.node, [], 'dest', 10, 10), self.data[10:20])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import os
+import pickle
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_service'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'zookeeper'))
+
+from rpyc.utils.server import ThreadedServer  # noqa: E402
+
+from cluster_state import ClusterState  # noqa: E402
+from zk import ZooKeeper  # noqa: E402
+
+
+def node(port):
+    return pickle.dumps({'host': 'localhost', 'port': port})
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return condition()
+
+
+class ClusterStateEventTest(unittest.TestCase):
+    def setUp(self):
+        self.changes = []
+        self.state = ClusterState('localhost', 0, on_change=self.changes.append)
+
+    def test_snapshot_and_events(self):
+        self.state.reset((('/data_nodes/localhost:1801', node(1801), 1),))
+        self.state.on_event('created', '/data_nodes/localhost:1802', node(1802), 2)
+        self.state.on_event('expired', '/data_nodes/localhost:1801', node(1801), 3)
+        self.assertEqual(self.changes, [(('localhost', 1801),),
+                                        (('localhost', 1801), ('localhost', 1802)),
+                                        (('localhost', 1802),)])
+
+    def test_stale_events_are_ignored(self):
+        self.state.on_event('created', '/data_nodes/localhost:1801', node(1801), 1)
+        self.state.on_event('expired', '/data_nodes/localhost:1801', node(1801), 4)
+        # delivered late, must not bring the expired node back
+        self.state.on_event('changed', '/data_nodes/localhost:1801', node(1801), 3)
+        self.assertEqual(self.state.live_nodes(), ())
+        self.state.on_event('created', '/data_nodes/localhost:1801', node(1801), 5)
+        self.assertEqual(self.state.live_nodes(), (('localhost', 1801),))
+
+    def test_data_changes_do_not_notify(self):
+        self.state.on_event('created', '/data_nodes/localhost:1801', node(1801), 1)
+        self.state.on_event('changed', '/data_nodes/localhost:1801', node(1801), 2)
+        self.assertEqual(len(self.changes), 1)
+
+
+class ZooKeeperWatchTest(unittest.TestCase):
+    def setUp(self):
+        self.zk = ZooKeeper()
+        self.zk.session_timeout = 0.3
+        self.zk.expiry_check_interval = 0.05
+        self.server = ThreadedServer(self.zk, hostname='localhost', port=0,
+                                     protocol_config={'allow_public_attrs': True})
+        threading.Thread(target=self.server.start, daemon=True).start()
+        self.changes = []
+        self.state = ClusterState('localhost', self.server.port, on_change=self.changes.append,
+                                  reconnect_delay=0.05).start()
+
+    def tearDown(self):
+        self.state.stop()
+        self.server.close()
+
+    def test_membership_is_pushed(self):
+        self.zk.exposed_create_node('/data_nodes/localhost:1801', node(1801), ephemeral=True)
+        self.assertTrue(self.state.connected.wait(5))
+        self.zk.exposed_create_node('/data_nodes/localhost:1802', node(1802), ephemeral=True)
+        stop = threading.Event()
+
+        def heartbeat():
+            # only 1802 keeps heartbeating, 1801 expires and the watch reports it
+            while not stop.is_set():
+                self.zk.exposed_touch('/data_nodes/localhost:1802')
+                time.sleep(0.05)
+
+        threading.Thread(target=heartbeat, daemon=True).start()
+        self.addCleanup(stop.set)
+        self.assertTrue(wait_for(lambda: self.state.live_nodes() == (('localhost', 1802),)))
+        self.assertIn((('localhost', 1801), ('localhost', 1802)), self.changes)
+        self.assertFalse(self.zk.exposed_touch('/data_nodes/localhost:1801'))
+        self.assertEqual(self.changes[-1], (('localhost', 1802),))
+
+    def test_touch_does_not_publish(self):
+        self.zk.exposed_create_node('/data_nodes/localhost:1801', node(1801), ephemeral=True)
+        version = self.zk.znodes.get('/data_nodes/localhost:1801')['version']
+        self.zk.exposed_touch('/data_nodes/localhost:1801')
+        self.assertEqual(self.zk.znodes.get('/data_nodes/localhost:1801')['version'], version)
+        self.assertTrue(self.zk.events.empty())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_service'))
+
+from compression import CODECS, BlockCompressor, compress_block, decompress_block  # noqa: E402
+
+TEXT = b'2024-04-27 11:25:32 INFO data_node: stored block 1f0e in 3 ms\n' * 2000
+
+
+class CompressBlockTest(unittest.TestCase):
+    def test_round_trip_of_every_codec(self):
+        for codec in CODECS:
+            used, payload = compress_block(TEXT, codec, 64 * 1024, 0.9)
+            self.assertEqual(used, codec)
+            self.assertLess(len(payload), len(TEXT) // 10)
+            self.assertEqual(decompress_block(payload, codec), TEXT)
+
+    def test_incompressible_blocks_are_skipped(self):
+        data = os.urandom(256 * 1024)
+        codec, payload = compress_block(data, 'zlib', 64 * 1024, 0.9)
+        self.assertEqual(codec, 'none')
+        self.assertIs(payload, data)
+        # the sample compresses but the rest of the block does not
+        mixed = TEXT[:64 * 1024] + os.urandom(1024 * 1024)
+        codec, payload = compress_block(mixed, 'zlib', 64 * 1024, 0.9)
+        self.assertEqual(codec, 'none')
+        self.assertIs(payload, mixed)
+        self.assertEqual(compress_block(b'', 'zlib', 64 * 1024, 0.9), ('none', b''))
+
+    def test_unknown_codecs(self):
+        with self.assertRaises(ValueError):
+            BlockCompressor('snappy')
+        with self.assertRaises(ValueError):
+            decompress_block(b'data', 'snappy')
+
+
+class BlockCompressorTest(unittest.TestCase):
+    def test_none_passes_the_view_through(self):
+        view = memoryview(TEXT)
+        self.assertIs(BlockCompressor('none').submit(view).result()[1], view)
+
+    def test_process_pool(self):
+        compressor = BlockCompressor('zlib', workers=2)
+        try:
+            futures = [compressor.submit(memoryview(TEXT)) for _ in range(4)]
+            for future in futures:
+                codec, payload = future.result()
+                self.assertEqual(decompress_block(payload, codec), TEXT)
+        finally:
+            compressor.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
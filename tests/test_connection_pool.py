@@ -0,0 +1,88 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_service'))
+
+from connection_pool import ConnectionPool, PoolExhaustedError  # noqa: E402
+
+
+class FakeConnection:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.closed = False
+        self.pings = 0
+        self.ping_fails = False
+
+    def ping(self, timeout=None):
+        self.pings += 1
+        if self.ping_fails:
+            raise EOFError("connection lost")
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.created = []
+
+        def connect(host, port):
+            conn = FakeConnection(host, port)
+            self.created.append(conn)
+            return conn
+        self.connect = connect
+
+    def test_connections_are_reused_per_host(self):
+        pool = ConnectionPool(connect=self.connect)
+        for _ in range(3):
+            with pool.connection('localhost', 1801) as conn:
+                self.assertEqual(conn.port, 1801)
+        with pool.connection('localhost', '1802'):
+            pass
+        self.assertEqual([conn.port for conn in self.created], [1801, 1802])
+        self.assertEqual(pool.stats()['reused'], 2)
+        self.assertEqual(pool.stats()['idle'], 2)
+
+    def test_max_per_host(self):
+        pool = ConnectionPool(max_per_host=2, acquire_timeout=0.05, connect=self.connect)
+        first = pool.acquire('localhost', 1801)
+        pool.acquire('localhost', 1801)
+        with self.assertRaises(PoolExhaustedError):
+            pool.acquire('localhost', 1801)
+        pool.release('localhost', 1801, first)
+        self.assertIs(pool.acquire('localhost', 1801), first)
+
+    def test_transport_errors_discard_and_reconnect(self):
+        pool = ConnectionPool(connect=self.connect)
+        with self.assertRaises(EOFError):
+            with pool.connection('localhost', 1801):
+                raise EOFError("server closed")
+        with pool.connection('localhost', 1801) as conn:
+            self.assertIs(conn, self.created[1])
+        self.assertTrue(self.created[0].closed)
+        with self.assertRaises(ValueError):
+            with pool.connection('localhost', 1801):
+                raise ValueError("remote error")
+        self.assertFalse(self.created[1].closed)
+        self.assertEqual(pool.stats()['in_use'], 0)
+
+    def test_health_check_and_idle_eviction(self):
+        pool = ConnectionPool(idle_timeout=10, health_check_after=0, connect=self.connect)
+        with pool.connection('localhost', 1801) as conn:
+            pass
+        conn.ping_fails = True
+        with pool.connection('localhost', 1801) as fresh:
+            self.assertIsNot(fresh, conn)
+        self.assertEqual(pool.stats()['failed_health_checks'], 1)
+        pool.idle_timeout = 0
+        time.sleep(0.01)
+        pool.evict_idle()
+        self.assertTrue(fresh.closed)
+        self.assertEqual(pool.stats()['evicted'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_service'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'metadata_serivce'))
+
+from dedup import DedupGuard, content_block_id, hash_blocks, is_content_addressed  # noqa: E402
+from metadata_db import MetadataDBService  # noqa: E402
+from name_node import NameNodeService  # noqa: E402
+from namespace_cache import NamespaceCache  # noqa: E402
+from placement import PlacementRing  # noqa: E402
+
+
+class HashBlocksTest(unittest.TestCase):
+    def test_ids_follow_block_boundaries(self):
+        data = os.urandom(10 * 1024 + 5)
+        with memoryview(data) as view:
+            block_ids = hash_blocks(view, 1024, workers=3)
+        self.assertEqual(len(block_ids), 11)
+        self.assertEqual(block_ids[0], 'sha256-' + hashlib.sha256(data[:1024]).hexdigest())
+        self.assertEqual(block_ids[-1], content_block_id(data[-5:]))
+        self.assertTrue(is_content_addressed(block_ids[3]))
+        self.assertFalse(is_content_addressed('0b6e2c2a-uuid-block'))
+
+
+class AllocateDedupBlocksTest(unittest.TestCase):
+    nodes = [('localhost', 1801), ('localhost', 1802), ('localhost', 1803)]
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.metadata = MetadataDBService(os.path.join(self.dir, 'metadata_table.db'))
+        class NameNode(NameNodeService.exposed_NameNodeService):
+            metadata = self.metadata
+            data_node_connections = list(self.nodes)
+            namespace_cache = NamespaceCache()
+            placement = PlacementRing()
+            replication_factor = 2
+            gc_delay = 0
+            dedup_guard = DedupGuard(held=False)
+
+        self.name_node = NameNode()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_known_blocks_are_not_sent_again(self):
+        a, b, c = (content_block_id(bytes([i]) * 1024) for i in range(3))
+        primary_blocks, replica_blocks, to_upload, codecs = self.name_node.exposed_create_dedup_blocks(
+            '/data/v1', (a, b, a))
+        self.assertEqual((to_upload, codecs), ((0, 1), ()))
+        self.assertEqual(primary_blocks[0], primary_blocks[2])
+        self.assertEqual(len(replica_blocks), 2)
+        # nothing is visible before the upload is committed
+        self.assertIsNone(self.name_node.exposed_get_file_table_entry('/data/v1'))
+        self.name_node.exposed_commit_blocks('/data/v1', primary_blocks, replica_blocks, ((a, 'zlib'),))
+
+        primary_blocks, replica_blocks, to_upload, codecs = self.name_node.exposed_create_dedup_blocks(
+            '/data/v2', (a, c))
+        self.assertEqual(to_upload, (1,))
+        # the reused block keeps the codec it was stored with
+        self.assertEqual(codecs, ((a, 'zlib'),))
+        self.name_node.exposed_commit_blocks('/data/v2', primary_blocks, replica_blocks, codecs)
+        entry = self.name_node.exposed_get_file_table_entry('/data/v2')
+        self.assertEqual(entry[0], primary_blocks)
+        self.assertEqual(entry[2], ((a, 'zlib'),))
+        self.assertEqual(dict(self.metadata.block_refcounts((a, b, c))), {a: 2, b: 1, c: 1})
+
+    def test_copies_on_dead_data_nodes_are_uploaded_again(self):
+        a = content_block_id(b'a' * 1024)
+        primary_blocks, replica_blocks, _, _ = self.name_node.exposed_create_dedup_blocks('/data/v1', (a,))
+        self.name_node.exposed_commit_blocks('/data/v1', primary_blocks, replica_blocks, ())
+        holders = {primary_blocks[0][1], replica_blocks[0][1]}
+        self.name_node.update_data_node_connections([node for node in self.nodes if node not in holders])
+        _, _, to_upload, _ = self.name_node.exposed_create_dedup_blocks('/data/v2', (a,))
+        self.assertEqual(to_upload, (0,))
+
+    def holders(self, path):
+        primary_blocks, replica_blocks = self.name_node.exposed_get_file_table_entry(path)[:2]
+        return {data_node for _, data_node in primary_blocks + replica_blocks}
+
+    def put(self, path, block_ids):
+        primary_blocks, replica_blocks, _, _ = self.name_node.exposed_create_dedup_blocks(path, block_ids)
+        self.name_node.exposed_commit_blocks(path, primary_blocks, replica_blocks, ())
+        return self.holders(path)
+
+    def test_reserved_blocks_are_not_handed_out(self):
+        a = content_block_id(b'a' * 1024)
+        holders = self.put('/data/v1', (a,))
+        self.name_node.exposed_delete('/data/v1')
+        # a put of the same content is between create_dedup_blocks and commit_blocks
+        primary_blocks, replica_blocks, to_upload, _ = self.name_node.exposed_create_dedup_blocks('/data/v2', (a,))
+        self.assertEqual(to_upload, (0,))
+        for node in holders:
+            self.assertEqual(self.name_node.exposed_block_report(*node), ())
+        self.assertEqual(self.metadata.garbage_count(), len(holders))
+        self.name_node.exposed_commit_blocks('/data/v2', primary_blocks, replica_blocks, ())
+        for node in holders:
+            self.assertEqual(self.name_node.exposed_block_report(*node), ())
+        self.assertEqual(self.metadata.garbage_count(), 0)
+
+    def test_blocks_being_deleted_are_not_placed_on_their_node(self):
+        a = content_block_id(b'a' * 1024)
+        holders = self.put('/data/v1', (a,))
+        self.name_node.exposed_delete('/data/v1')
+        deleting = next(iter(holders))
+        self.assertEqual(self.name_node.exposed_block_report(*deleting), ((a, '/data/v1'),))
+        # the node may delete its copy at any time until it acknowledges it
+        self.assertNotIn(deleting, self.put('/data/v2', (a,)))
+        self.name_node.exposed_delete('/data/v2')
+        self.name_node.exposed_block_report(*deleting, (a,))
+        self.assertIn(deleting, self.put('/data/v3', (a,)))
+
+    def test_content_blocks_are_held_after_a_restart(self):
+        a = content_block_id(b'a' * 1024)
+        holders = self.put('/data/v1', (a,))
+        self.name_node.exposed_delete('/data/v1')
+        # reservations of puts that began before the restart are gone
+        self.name_node.dedup_guard = DedupGuard(timeout=3600)
+        for node in holders:
+            self.assertEqual(self.name_node.exposed_block_report(*node), ())
+        self.assertEqual(self.metadata.garbage_count(), len(holders))
+
+    def test_block_ids_must_be_content_hashes(self):
+        with self.assertRaises(Exception):
+            self.name_node.exposed_create_dedup_blocks('/data/v1', ('not-a-hash',))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import itertools
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_service'))
+
+from erasure import (ReedSolomon, gf_inv, gf_mul, invert, new_stripe_ids, parse_block_id,  # noqa: E402
+                     parse_policy, split_stripes)
+
+
+class GaloisFieldTest(unittest.TestCase):
+    def test_inverse_and_matrix_inverse(self):
+        for a in range(1, 256):
+            self.assertEqual(gf_mul(a, gf_inv(a)), 1)
+        matrix = [[1, 2, 3], [4, 5, 6], [7, 8, 10]]
+        inverse = invert(matrix)
+        for i in range(3):
+            for j in range(3):
+                value = 0
+                for x in range(3):
+                    value ^= gf_mul(matrix[i][x], inverse[x][j])
+                self.assertEqual(value, int(i == j))
+
+
+class ReedSolomonTest(unittest.TestCase):
+    def test_any_m_lost_blocks_are_rebuilt(self):
+        code = ReedSolomon(4, 2)
+        data = [os.urandom(1000) for _ in range(3)] + [os.urandom(17)]
+        blocks = dict(enumerate(data + code.encode(data)))
+        for lost in itertools.combinations(range(6), 2):
+            readable = {j: block for j, block in blocks.items() if j not in lost}
+            self.assertEqual(code.reconstruct(readable, 4), data)
+        with self.assertRaises(ValueError):
+            code.reconstruct({j: blocks[j] for j in (0, 1, 4)}, 4)
+
+    def test_short_last_stripe(self):
+        code = ReedSolomon(4, 2)
+        data = [os.urandom(100), b'']
+        parity = code.encode(data)
+        self.assertEqual(code.reconstruct({1: data[1], 5: parity[1]}, 2), data)
+
+
+class LayoutTest(unittest.TestCase):
+    def test_policies(self):
+        self.assertIsNone(parse_policy('replication'))
+        self.assertEqual(parse_policy('rs-6-3'), (6, 3))
+        for policy in ('rs-6', 'rs-0-2', 'raid5'):
+            with self.assertRaises(ValueError):
+                parse_policy(policy)
+
+    def test_stripes_are_split_into_data_blocks(self):
+        first, last = new_stripe_ids(2, 1, 2), new_stripe_ids(2, 1, 1)
+        primary_blocks = [(block_id, ('localhost', 1801 + i)) for i, block_id in enumerate(first + last)]
+        self.assertEqual(parse_block_id(first[2])[1:], (1, parse_block_id(first[0])[2], 2))
+        data_blocks, stripes = split_stripes(primary_blocks, {first[2]: 'zlib'})
+        self.assertEqual([block_id for block_id, _ in data_blocks], first[:2] + last[:1])
+        self.assertEqual(stripes[first[1]][2], (first[2], ('localhost', 1803), 'zlib'))
+        self.assertEqual(len(stripes[last[0]]), 2)
+        self.assertIsNone(parse_block_id('0b6e2c2a-uuid-block'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,197 @@
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'metadata_serivce'))
+
+from metadata_db import MetadataDBService  # noqa: E402
+
+
+class MetadataDBServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.dir, 'metadata_table.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_blocks_come_back_as_typed_rows_in_order(self):
+        db = MetadataDBService(self.db_file)
+        primary_blocks = [(f"block-{i}", ('localhost', 1801 + i % 2)) for i in range(1000)]
+        replica_blocks = [(f"block-{i}", ('localhost', 1802 - i % 2)) for i in range(1000)]
+        db.save_file_blocks('/data/a', primary_blocks, replica_blocks)
+        rows = db.get_file_blocks('/data/a')
+        self.assertEqual(len(rows), 2000)
+        self.assertEqual(rows[0], (0, 'block-0', 'localhost', 1801, 'primary', 'none', 0, None))
+        self.assertEqual(rows[1], (0, 'block-0', 'localhost', 1802, 'replica', 'none', 0, None))
+        self.assertEqual(rows[-1], (999, 'block-999', 'localhost', 1801, 'replica', 'none', 0, None))
+        self.assertIsNone(db.get_file_blocks('/data/missing'))
+
+    def test_overwrite_and_delete(self):
+        db = MetadataDBService(self.db_file)
+        db.save_file_blocks('/data/a', [('old', ('localhost', 1801))], [])
+        db.save_file_blocks('/data/a', [('new', ('localhost', 1802))], [])
+        self.assertEqual(db.get_file_blocks('/data/a'), ((0, 'new', 'localhost', 1802, 'primary', 'none', 0, None),))
+        db.save_file_blocks('/data/empty', [], [])
+        self.assertEqual(db.get_file_blocks('/data/empty'), ())
+        self.assertTrue(db.delete_file('/data/a'))
+        self.assertFalse(db.delete_file('/data/a'))
+        self.assertIsNone(db.get_file_blocks('/data/a'))
+        count = db.read_connection().execute("SELECT COUNT(*) FROM blocks").fetchone()[0]
+        self.assertEqual(count, 0)
+
+    def test_block_codecs(self):
+        db = MetadataDBService(self.db_file)
+        db.save_file_blocks('/data/a', [('b0', ('localhost', 1801)), ('b1', ('localhost', 1802))],
+                            [('b0', ('localhost', 1802))])
+        db.set_block_codecs('/data/a', (('b0', 'zlib'),))
+        self.assertEqual([row[5] for row in db.get_file_blocks('/data/a')], ['zlib', 'zlib', 'none'])
+
+    def test_codec_column_is_added_to_old_databases(self):
+        conn = sqlite3.connect(self.db_file)
+        conn.executescript('''CREATE TABLE files (file_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                                 file_path TEXT NOT NULL UNIQUE, created_at REAL NOT NULL);
+                              CREATE TABLE blocks (file_id INTEGER NOT NULL, block_index INTEGER NOT NULL,
+                                                   block_id TEXT NOT NULL, host TEXT NOT NULL,
+                                                   port INTEGER NOT NULL, role TEXT NOT NULL);
+                              INSERT INTO files VALUES (1, '/data/old', 0);
+                              INSERT INTO blocks VALUES (1, 0, 'b0', 'localhost', 1801, 'primary');''')
+        conn.close()
+        db = MetadataDBService(self.db_file)
+        self.assertEqual(db.get_file_blocks('/data/old'), ((0, 'b0', 'localhost', 1801, 'primary', 'none', 0, None),))
+        self.assertEqual(db.block_refcounts(['b0']), (('b0', 1),))
+
+    def test_a_database_belongs_to_the_shard_that_opened_it(self):
+        MetadataDBService(self.db_file, owner=18005)
+        MetadataDBService(self.db_file, owner=18005)
+        MetadataDBService(self.db_file)
+        with self.assertRaises(Exception):
+            MetadataDBService(self.db_file, owner=18006)
+
+    def test_shared_blocks_are_reference_counted(self):
+        db = MetadataDBService(self.db_file)
+        shared, other = 'sha256-aa', 'sha256-bb'
+        # a block repeated within a file is one reference
+        db.save_file_blocks('/data/a', [(shared, ('localhost', 1801)), (shared, ('localhost', 1801))],
+                            [(shared, ('localhost', 1802))], ((shared, 'zlib'),))
+        db.save_file_blocks('/data/b', [(shared, ('localhost', 1801)), (other, ('localhost', 1803))], [],
+                            ((shared, 'zlib'),))
+        self.assertEqual(db.block_refcounts([shared, other, 'sha256-cc']), ((shared, 2), (other, 1)))
+        self.assertEqual([row[:2] + row[4:6] for row in db.get_file_blocks('/data/a')],
+                         [(0, shared, 'primary', 'zlib'), (0, shared, 'replica', 'zlib'),
+                          (1, shared, 'primary', 'zlib')])
+        self.assertEqual(db.find_blocks([shared, other]), (
+            (shared, 'localhost', 1801, 'primary', 'zlib'), (shared, 'localhost', 1802, 'replica', 'zlib'),
+            (other, 'localhost', 1803, 'primary', 'none')))
+        # overwriting /data/b drops its references
+        db.save_file_blocks('/data/b', [(other, ('localhost', 1803))], [])
+        self.assertEqual(db.block_refcounts([shared, other]), ((shared, 1), (other, 1)))
+        self.assertTrue(db.delete_file('/data/a'))
+        self.assertEqual(db.block_refcounts([shared, other]), ((other, 1),))
+        self.assertEqual(db.find_blocks([shared]), ())
+
+    def test_packed_files_share_their_container(self):
+        db = MetadataDBService(self.db_file)
+        data_nodes = (('localhost', 1801), ('localhost', 1802))
+        db.save_file_blocks('/small/b', [('old', ('localhost', 1803))], [])
+        db.save_packed_files('container-1', data_nodes, 'zlib',
+                             (('/small/a', 0, 10), ('/small/b', 10, 5), ('/small/c', 15, 0)))
+        self.assertEqual(db.get_file_blocks('/small/b'), (
+            (0, 'container-1', 'localhost', 1801, 'primary', 'zlib', 10, 5),
+            (0, 'container-1', 'localhost', 1802, 'replica', 'zlib', 10, 5)))
+        self.assertEqual(db.block_refcounts(['container-1', 'old']), (('container-1', 3),))
+        files = dict(db.get_files_blocks(['/small/c', '/small/a', '/small/missing']))
+        self.assertEqual(sorted(files), ['/small/a', '/small/c'])
+        self.assertEqual(files['/small/c'][0][6:], (15, 0))
+        self.assertTrue(db.delete_file('/small/a'))
+        self.assertEqual(db.block_refcounts(['container-1']), (('container-1', 2),))
+
+    def test_block_copies_are_listed_and_relocated(self):
+        db = MetadataDBService(self.db_file)
+        shared = 'sha256-aa'
+        db.save_file_blocks('/data/a', [(shared, ('localhost', 1801))], [(shared, ('localhost', 1802))])
+        db.save_file_blocks('/data/b', [(shared, ('localhost', 1801)), ('b1', ('localhost', 1802))], [])
+        copies = db.list_block_copies()
+        self.assertEqual([row[1:] for row in copies], [
+            (shared, '/data/a', 'localhost', 1801), (shared, '/data/a', 'localhost', 1802),
+            (shared, '/data/b', 'localhost', 1801), ('b1', '/data/b', 'localhost', 1802)])
+        self.assertEqual(db.list_block_copies(copies[1][0], 1), copies[2:3])
+        paths = db.relocate_block(shared, ('localhost', 1801), ('localhost', 1803))
+        self.assertEqual(sorted(paths), ['/data/a', '/data/b'])
+        self.assertEqual(db.get_file_blocks('/data/b')[0][2:5], ('localhost', 1803, 'primary'))
+        db.relocate_block('b1', None, ('localhost', 1804))
+        self.assertEqual([row[2:5] for row in db.get_file_blocks('/data/b')[1:]],
+                         [('localhost', 1802, 'primary'), ('localhost', 1804, 'replica')])
+        self.assertEqual(db.block_refcounts([shared, 'b1']), (('b1', 1), (shared, 2)))
+
+    def test_directories_are_listed_in_pages(self):
+        db = MetadataDBService(self.db_file)
+        for path in ['/d/a', '/d/b', '/d/sub/x', '/d/sub/deep/y', '/d/sub2/z', '/d/z', '/dx', '/e/f']:
+            db.save_file_blocks(path, [(path + '-b', ('localhost', 1801))], [], size=len(path))
+        names = [entry[0] for entry in db.list_directory('/d/')]
+        self.assertEqual(names, ['a', 'b', 'sub/', 'sub2/', 'z'])
+        self.assertEqual(db.list_directory('/d/', limit=2)[1][:2], ('b', 4))
+        self.assertEqual(db.list_directory('/d/', 'b', 2), (('sub/', None, None), ('sub2/', None, None)))
+        self.assertEqual([entry[0] for entry in db.list_directory('/d/', 'sub2/')], ['z'])
+        self.assertEqual([entry[0] for entry in db.list_directory('/')], ['d/', 'dx', 'e/'])
+        self.assertEqual(db.list_directory('/missing/'), ())
+        size, created_at, blocks = db.stat_file('/d/sub/x')
+        self.assertEqual((size, blocks), (8, 1))
+        self.assertIsNone(db.stat_file('/d/sub'))
+        self.assertTrue(db.has_prefix('/d/sub/'))
+        self.assertFalse(db.has_prefix('/d/su/'))
+
+    def test_deleted_blocks_become_garbage_until_reclaimed(self):
+        db = MetadataDBService(self.db_file)
+        node, other = ('localhost', 1801), ('localhost', 1802)
+        shared = 'sha256-aa'
+        db.save_file_blocks('/data/a', [('a0', node), (shared, node)], [('a0', other)])
+        db.save_file_blocks('/data/b', [(shared, node)], [])
+        self.assertTrue(db.delete_file('/data/a'))
+        self.assertFalse(db.delete_file('/data/a'))
+        # the shared block is still referenced by /data/b
+        self.assertEqual(db.pending_garbage(node, time.time() + 1), (('a0', '/data/a'),))
+        self.assertEqual(db.pending_garbage(other, time.time() + 1), (('a0', '/data/a'),))
+        self.assertEqual(db.pending_garbage(node, 0), ())
+        # overwriting drops the old blocks too
+        db.save_file_blocks('/data/b', [('b1', node)], [])
+        self.assertEqual(db.garbage_count(), 3)
+        # a deduplicated block written again is no longer garbage
+        db.save_file_blocks('/data/c', [(shared, node)], [])
+        self.assertEqual(db.pending_garbage(node, time.time() + 1), (('a0', '/data/a'),))
+        db.clear_garbage(node, ['a0'])
+        self.assertEqual(db.garbage_count(), 1)
+
+    def test_prefixes_are_deleted_in_batches(self):
+        db = MetadataDBService(self.db_file)
+        for i in range(5):
+            db.save_file_blocks(f"/logs/{i}", [(f"b{i}", ('localhost', 1801))], [])
+        db.save_file_blocks('/logs-old', [('c', ('localhost', 1801))], [])
+        self.assertEqual(db.delete_prefix('/logs/', 3), ('/logs/0', '/logs/1', '/logs/2'))
+        self.assertEqual(db.delete_prefix('/logs/', 3), ('/logs/3', '/logs/4'))
+        self.assertEqual(db.delete_prefix('/logs/', 3), ())
+        self.assertIsNotNone(db.stat_file('/logs-old'))
+        self.assertEqual(db.garbage_count(), 5)
+
+    def test_legacy_table_is_migrated(self):
+        conn = sqlite3.connect(self.db_file)
+        conn.execute("CREATE TABLE metadata_table (file_path TEXT PRIMARY KEY, primary_blocks TEXT, replica_blocks TEXT)")
+        conn.execute("INSERT INTO metadata_table VALUES (?, ?, ?)", (
+            '/data/legacy', json.dumps([['b1', ['localhost', 1802]]]), json.dumps([['b1', ['localhost', 1801]]])))
+        conn.commit()
+        conn.close()
+        db = MetadataDBService(self.db_file)
+        self.assertEqual(db.get_file_blocks('/data/legacy'), (
+            (0, 'b1', 'localhost', 1802, 'primary', 'none', 0, None),
+            (0, 'b1', 'localhost', 1801, 'replica', 'none', 0, None)))
+        self.assertIsNone(db.read_connection().execute(
+            "SELECT 1 FROM sqlite_master WHERE name='metadata_table'").fetchone())
+
+
+if __name__ == '__main__':
+    unittest.main()
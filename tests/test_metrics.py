@@ -0,0 +1,93 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_service'))
+
+from metrics import MetricsRegistry, MetricsService, SamplingProfiler, instrument  # noqa: E402
+
+
+class RegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_counters_histograms_and_gauges(self):
+        self.registry.inc('blocks_stored_total')
+        self.registry.inc('block_bytes_written_total', 1024)
+        self.registry.inc('block_bytes_written_total', 1024)
+        self.registry.observe('rpc_seconds', 0.003, service='name_node', method='create_blocks')
+        self.registry.observe('rpc_seconds', 20, service='name_node', method='create_blocks')
+        self.registry.register_gauges('namespace_cache', lambda: {'hits': 3, 'hit_rate': 0.75, 'name': 'x'})
+        samples = {(name, labels): value for name, labels, value in self.registry.samples()}
+        self.assertEqual(samples[('block_bytes_written_total', ())], 2048)
+        labels = (('method', 'create_blocks'), ('service', 'name_node'))
+        self.assertEqual(samples[('rpc_seconds_count', labels)], 2)
+        self.assertEqual(samples[('rpc_seconds_bucket', labels + (('le', '0.005'),))], 1)
+        self.assertEqual(samples[('rpc_seconds_bucket', labels + (('le', '+Inf'),))], 2)
+        self.assertEqual(samples[('namespace_cache_hit_rate', ())], 0.75)
+        # only numbers become gauges
+        self.assertNotIn(('namespace_cache_name', ()), samples)
+
+    def test_prometheus_text(self):
+        self.registry.inc('blocks_stored_total')
+        self.registry.observe('rpc_seconds', 0.001, service='zookeeper', method='touch')
+        self.registry.register_gauges('pool', lambda: {'idle': 2})
+        text = self.registry.prometheus_text()
+        self.assertIn('# TYPE blocks_stored_total counter\nblocks_stored_total 1', text)
+        self.assertEqual(text.count('# TYPE rpc_seconds histogram'), 1)
+        self.assertIn('rpc_seconds_bucket{method="touch",service="zookeeper",le="0.001"} 1', text)
+        self.assertIn('rpc_seconds_count{method="touch",service="zookeeper"} 1', text)
+        self.assertIn('# TYPE pool_idle gauge\npool_idle 2', text)
+
+
+class InstrumentTest(unittest.TestCase):
+    def test_exposed_methods_are_timed(self):
+        registry = MetricsRegistry()
+
+        @instrument('test', registry)
+        class Service(MetricsService):
+            def exposed_ok(self):
+                return 'ok'
+
+            def exposed_fail(self):
+                raise ValueError('fail')
+
+        Service.registry = registry
+        service = Service()
+        self.assertEqual(service.exposed_ok(), 'ok')
+        with self.assertRaises(ValueError):
+            service.exposed_fail()
+        samples = {(name, labels): value for name, labels, value in service.exposed_metrics()}
+        self.assertEqual(samples[('rpc_seconds_count', (('method', 'ok'), ('service', 'test')))], 1)
+        self.assertEqual(samples[('rpc_errors_total', (('method', 'fail'), ('service', 'test')))], 1)
+        # the metrics calls themselves are not timed
+        self.assertNotIn(('rpc_seconds_count', (('method', 'metrics'), ('service', 'test'))), samples)
+
+
+def busy_loop(seconds):
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        sum(range(100))
+
+
+class ProfilerTest(unittest.TestCase):
+    def test_samples_the_busy_thread(self):
+        profiler = SamplingProfiler(interval=0.001).start()
+        busy_loop(0.2)
+        stacks = profiler.stop()
+        self.assertGreater(profiler.samples, 10)
+        # idle threads of other tests are sampled as well
+        self.assertTrue(any('busy_loop' in stack for _, stack in stacks))
+
+    def test_toggle_through_the_service(self):
+        service = MetricsService()
+        self.assertEqual(service.exposed_stop_profiler(), ())
+        self.assertTrue(service.exposed_start_profiler(0.001))
+        self.assertFalse(service.exposed_start_profiler(0.001))
+        busy_loop(0.05)
+        self.assertTrue(service.exposed_stop_profiler())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_service'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'metadata_serivce'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from metadata_db import MetadataDBService  # noqa: E402
+from name_node import NameNodeService  # noqa: E402
+from namespace_cache import NamespaceCache  # noqa: E402
+from placement import PlacementRing  # noqa: E402
+from test_streaming import StreamingClient  # noqa: E402
+
+
+class NamespaceTest(unittest.TestCase):
+    nodes = [('localhost', 1801), ('localhost', 1802), ('localhost', 1803)]
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.metadata = MetadataDBService(os.path.join(self.dir, 'metadata_table.db'))
+
+        class NameNode(NameNodeService.exposed_NameNodeService):
+            metadata = self.metadata
+            data_node_connections = list(self.nodes)
+            namespace_cache = NamespaceCache()
+            placement = PlacementRing()
+            replication_factor = 2
+            append_lock = threading.Lock()
+            gc_delay = 0
+            gc_batch_size = 3
+
+        self.name_node = NameNode()
+        self.client = StreamingClient(self.name_node)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def put(self, path, data):
+        with self.client.open_write(path) as writer:
+            writer.write(data)
+
+    def test_streamed_files_record_their_size(self):
+        self.put('/logs/a', b'x' * 2500)
+        stat = self.client.stat('/logs/a')
+        self.assertEqual((stat['type'], stat['size'], stat['blocks']), ('file', 2500, 3))
+        for extra in (b'y' * 100, b'z' * 2000):
+            with self.client.append('/logs/a') as writer:
+                writer.write(extra)
+        self.assertEqual(self.client.stat('/logs/a')['size'], 4600)
+        self.assertEqual(self.client.stat('/logs')['type'], 'directory')
+        self.assertEqual(self.client.stat('/')['type'], 'directory')
+        with self.assertRaises(FileNotFoundError):
+            self.client.stat('/logs/missing')
+
+    def test_directories_are_listed_page_by_page(self):
+        for i in range(7):
+            self.put(f"/data/f{i}", b'%d' % i)
+        self.put('/data/sub/g', b'g')
+        self.assertEqual([entry[:2] for entry in self.client.list('/data', limit=3)],
+                         [('f0', 1), ('f1', 1), ('f2', 1)])
+        self.assertEqual([entry[0] for entry in self.client.iter_list('/data/', page_size=3)],
+                         [f"f{i}" for i in range(7)] + ['sub/'])
+        self.assertEqual(self.client.list('/'), [('data/', None, None)])
+        with self.assertRaises(FileNotFoundError):
+            self.client.list('/missing')
+
+    def test_deleted_blocks_are_handed_out_by_block_reports(self):
+        self.put('/data/a', b'a' * 3000)
+        self.assertEqual(self.client.read_file('/data/a'), b'a' * 3000)
+        blocks = {block_id for block_id, _ in self.name_node.exposed_get_file_table_entry('/data/a')[0]}
+        self.assertTrue(self.client.delete('/data/a'))
+        self.assertFalse(self.client.delete('/data/a'))
+        self.assertIsNone(self.name_node.exposed_get_file_table_entry('/data/a'))
+        reported = {}
+        for node in self.nodes:
+            garbage = self.name_node.exposed_block_report(*node)
+            self.assertLessEqual(len(garbage), 3)
+            self.assertTrue(all(file_path == '/data/a' for _, file_path in garbage))
+            reported[node] = tuple(block_id for block_id, _ in garbage)
+        self.assertEqual(set().union(*reported.values()), blocks)
+        for node, block_ids in reported.items():
+            self.assertEqual(self.name_node.exposed_block_report(*node, block_ids), ())
+        self.assertEqual(self.metadata.garbage_count(), 0)
+
+    def test_garbage_waits_for_gc_delay_and_spares_referenced_blocks(self):
+        self.put('/data/a', b'a' * 100)
+        self.client.delete('/data/a')
+        self.name_node.gc_delay = 3600
+        self.assertEqual(sum(len(self.name_node.exposed_block_report(*node)) for node in self.nodes), 0)
+        self.name_node.gc_delay = 0
+        node = next(node for node in self.nodes if self.metadata.pending_garbage(node, float('inf')))
+        block_id, _ = self.metadata.pending_garbage(node, float('inf'))[0]
+        # a file on another metadata shard references the block again, e.g. a deduplicated one
+        with mock.patch.object(self.metadata, 'block_refcounts', return_value=((block_id, 1),)):
+            self.assertEqual(self.name_node.exposed_block_report(*node), ())
+        self.assertEqual(self.metadata.pending_garbage(node, float('inf')), ())
+
+    def test_recursive_deletes_go_in_batches(self):
+        for i in range(5):
+            self.put(f"/tmp/run/{i}", b'x')
+        self.put('/tmp/run', b'a file next to the directory')
+        self.put('/tmp/keep', b'k')
+        self.assertEqual(self.name_node.exposed_delete_recursive('/tmp/run', 2), 2)
+        self.assertEqual(self.client.delete_recursive('/tmp/run', batch_size=2), 4)
+        self.assertEqual([entry[0] for entry in self.client.list('/tmp')], ['keep'])
+        with self.assertRaises(FileNotFoundError):
+            self.client.read_file('/tmp/run/4')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_service'))
+
+from namespace_cache import NamespaceCache  # noqa: E402
+
+
+def blocks(name, count=1):
+    primary_blocks = tuple((f"{name}-{i}", ('localhost', 1801)) for i in range(count))
+    replica_blocks = tuple((f"{name}-{i}", ('localhost', 1802)) for i in range(count))
+    return primary_blocks, replica_blocks
+
+
+class NamespaceCacheTest(unittest.TestCase):
+    def test_hits_misses_and_invalidation(self):
+        cache = NamespaceCache()
+        self.assertIsNone(cache.get('/a'))
+        cache.put('/a', blocks('a'))
+        self.assertEqual(cache.get('/a'), blocks('a'))
+        cache.put('/a', blocks('b'))
+        self.assertEqual(cache.get('/a'), blocks('b'))
+        cache.invalidate('/a')
+        self.assertIsNone(cache.get('/a'))
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['invalidations']), (2, 2, 1))
+        self.assertEqual((stats['entries'], stats['bytes']), (0, 0))
+
+    def test_lru_eviction_by_entries(self):
+        cache = NamespaceCache(max_entries=2)
+        cache.put('/a', blocks('a'))
+        cache.put('/b', blocks('b'))
+        cache.get('/a')
+        cache.put('/c', blocks('c'))
+        self.assertIsNone(cache.get('/b'))
+        self.assertIsNotNone(cache.get('/a'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_eviction_by_bytes(self):
+        small = NamespaceCache().entry_size('/a', blocks('a'))
+        cache = NamespaceCache(max_bytes=small * 3)
+        cache.put('/a', blocks('a'))
+        cache.put('/b', blocks('b'))
+        cache.put('/big', blocks('big', 10))
+        self.assertIsNone(cache.get('/big'))
+        self.assertEqual(cache.stats()['entries'], 2)
+        cache.put('/c', blocks('c'))
+        cache.put('/d', blocks('d'))
+        self.assertIsNone(cache.get('/a'))
+        self.assertLessEqual(cache.stats()['bytes'], small * 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
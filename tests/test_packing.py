@@ -0,0 +1,75 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_service'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'metadata_serivce'))
+
+from metadata_db import MetadataDBService  # noqa: E402
+from name_node import NameNodeService  # noqa: E402
+from namespace_cache import NamespaceCache  # noqa: E402
+from packing import Container, is_container  # noqa: E402
+from placement import PlacementRing  # noqa: E402
+
+
+class ContainerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_files_are_appended_until_full(self):
+        a, b, c = os.urandom(60), b'', os.urandom(50)
+        container = Container(100)
+        self.assertTrue(container.add_file(self.write('a', a), '/small/a'))
+        self.assertTrue(container.add_file(self.write('b', b), '/small/b'))
+        self.assertFalse(container.add_file(self.write('c', c), '/small/c'))
+        self.assertEqual(container.files, [('/small/a', 0, 60), ('/small/b', 60, 0)])
+        with container.view() as view:
+            self.assertEqual(bytes(view), a)
+
+
+class PackedEntriesTest(unittest.TestCase):
+    nodes = [('localhost', 1801), ('localhost', 1802), ('localhost', 1803)]
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.metadata = MetadataDBService(os.path.join(self.dir, 'metadata_table.db'))
+        class NameNode(NameNodeService.exposed_NameNodeService):
+            metadata = self.metadata
+            data_node_connections = list(self.nodes)
+            namespace_cache = NamespaceCache()
+            placement = PlacementRing()
+            replication_factor = 2
+
+        self.name_node = NameNode()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_committed_files_are_windows_of_their_container(self):
+        container_id, data_nodes = self.name_node.exposed_allocate_container()
+        self.assertTrue(is_container(container_id))
+        self.assertEqual(len(set(data_nodes)), 2)
+        self.assertIsNone(self.name_node.exposed_get_file_table_entry('/small/a'))
+        self.name_node.exposed_commit_container(container_id, data_nodes, 'zlib',
+                                                (('/small/a', 0, 10), ('/small/b', 10, 20)))
+        entry = self.name_node.exposed_get_file_table_entry('/small/b')
+        self.assertEqual(entry, (((container_id, data_nodes[0]),), ((container_id, data_nodes[1]),),
+                                 ((container_id, 'zlib'),), ((container_id, 10, 20),)))
+        entries = dict(self.name_node.exposed_get_file_table_entries(('/small/a', '/small/b', '/small/c')))
+        self.assertEqual(sorted(entries), ['/small/a', '/small/b'])
+        self.assertEqual(entries['/small/a'][3], ((container_id, 0, 10),))
+
+
+if __name__ == '__main__':
+    unittest.main()
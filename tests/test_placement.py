@@ -0,0 +1,70 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_service'))
+
+from placement import PlacementRing  # noqa: E402
+
+GB = 1024 ** 3
+
+
+def cluster(count, racks=2, capacity=100 * GB, used=0):
+    return {(f"host-{i}", 1801): {'capacity': capacity, 'used': used, 'rack': f"/rack-{i % racks}"}
+            for i in range(count)}
+
+
+class PlacementRingTest(unittest.TestCase):
+    def test_copies_go_to_distinct_racks_and_hosts(self):
+        ring = PlacementRing()
+        ring.update(cluster(6, racks=3))
+        for i in range(200):
+            data_nodes = ring.select(f"block-{i}", 3)
+            self.assertEqual(len({ring.racks[node] for node in data_nodes}), 3)
+
+        nodes = {('a', 1801): None, ('a', 1802): None, ('b', 1801): None}
+        ring = PlacementRing()
+        ring.update(nodes)
+        for i in range(200):
+            data_nodes = ring.select(f"block-{i}", 2)
+            self.assertEqual(len({host for host, _ in data_nodes}), 2)
+        # never more copies than nodes
+        self.assertEqual(len(ring.select('block', 5)), 3)
+
+    def test_weighted_by_free_space(self):
+        nodes = cluster(2, racks=1)
+        nodes[('host-1', 1801)]['used'] = 75 * GB
+        ring = PlacementRing()
+        ring.update(nodes)
+        self.assertEqual(ring.weights, {('host-0', 1801): 160, ('host-1', 1801): 40})
+        primaries = [ring.select(f"block-{i}", 1)[0] for i in range(5000)]
+        self.assertGreater(primaries.count(('host-0', 1801)), 3 * primaries.count(('host-1', 1801)))
+
+        nodes[('host-1', 1801)]['used'] = 100 * GB
+        ring.update(nodes)
+        self.assertEqual({ring.select(f"block-{i}", 1)[0] for i in range(200)}, {('host-0', 1801)})
+
+    def test_adding_a_node_moves_few_placements(self):
+        nodes = cluster(20)
+        ring = PlacementRing()
+        ring.update(nodes)
+        before = [ring.select(f"block-{i}", 1)[0] for i in range(5000)]
+        nodes[('host-new', 1801)] = {'capacity': 100 * GB, 'used': 0, 'rack': '/rack-0'}
+        self.assertTrue(ring.update(nodes))
+        after = [ring.select(f"block-{i}", 1)[0] for i in range(5000)]
+        moved = [new for old, new in zip(before, after) if old != new]
+        # every moved block went to the new node, about 1/21 of them
+        self.assertEqual(set(moved), {('host-new', 1801)})
+        self.assertLess(len(moved) / 5000, 2 / 21)
+
+    def test_unchanged_nodes_do_not_rebuild(self):
+        ring = PlacementRing()
+        self.assertEqual(ring.select('block', 2), [])
+        self.assertTrue(ring.update(cluster(3)))
+        self.assertFalse(ring.update(cluster(3)))
+        # a small change of usage keeps the same number of points
+        self.assertFalse(ring.update(cluster(3, used=GB // 10)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_service'))
+
+from replica_selection import NodeLatency, ReadAttempt  # noqa: E402
+
+FAST = ('localhost', 1801)
+SLOW = ('localhost', 1802)
+NEW = ('localhost', 1803)
+
+
+class NodeLatencyTest(unittest.TestCase):
+    def test_faster_and_unknown_nodes_come_first(self):
+        latency = NodeLatency()
+        for _ in range(5):
+            latency.record(FAST, 0.01)
+            latency.record(SLOW, 0.1)
+        self.assertEqual(latency.order([SLOW, FAST]), [FAST, SLOW])
+        # never read from, so it gets measured
+        self.assertEqual(latency.order([SLOW, FAST, NEW]), [NEW, FAST, SLOW])
+
+    def test_errors_push_a_node_back_and_fade(self):
+        latency = NodeLatency(error_half_life=10)
+        latency.record(FAST, 0.01)
+        latency.record(SLOW, 0.05)
+        for _ in range(3):
+            latency.record_error(FAST)
+        self.assertEqual(latency.order([FAST, SLOW]), [SLOW, FAST])
+        self.assertGreater(latency.stats()['error_rate_localhost:1801'], 0.4)
+        now = latency.errors[FAST][1]
+        with mock.patch('replica_selection.time.monotonic', return_value=now + 100):
+            self.assertEqual(latency.order([FAST, SLOW]), [FAST, SLOW])
+
+    def test_cancelled_reads_only_raise_the_average(self):
+        latency = NodeLatency(alpha=0.5)
+        latency.record(FAST, 0.1)
+        latency.record_slow(FAST, 0.05)
+        self.assertEqual(latency.latency[FAST], 0.1)
+        latency.record_slow(FAST, 0.3)
+        self.assertAlmostEqual(latency.latency[FAST], 0.2)
+        self.assertEqual(latency.percentile(100), 0.1)
+
+    def test_percentiles_per_size_class(self):
+        latency = NodeLatency()
+        self.assertIsNone(latency.percentile(95, 1000))
+        for i in range(1, 101):
+            latency.record(FAST, i / 1000, 1000)
+        latency.record(FAST, 5.0, 1 << 20)
+        self.assertEqual(latency.percentile(95, 1000), 0.095)
+        self.assertEqual(latency.percentile(50, 1200), 0.05)
+        self.assertEqual(latency.percentile(95, 1 << 20), 5.0)
+
+
+class ReadAttemptTest(unittest.TestCase):
+    def test_cancel_shuts_the_connection_of_a_running_read(self):
+        attempt = ReadAttempt()
+        connection = mock.Mock()
+        attempt.started(connection)
+        attempt.cancel()
+        connection.sock.shutdown.assert_called_once()
+        with self.assertRaises(ConnectionAbortedError):
+            attempt.finished()
+
+    def test_a_finished_or_cancelled_attempt_leaves_connections_alone(self):
+        attempt = ReadAttempt()
+        connection = mock.Mock()
+        attempt.started(connection)
+        attempt.finished()
+        attempt.cancel()
+        connection.sock.shutdown.assert_not_called()
+        with self.assertRaises(ConnectionAbortedError):
+            attempt.started(connection)
+
+
+if __name__ == '__main__':
+    unittest.main()
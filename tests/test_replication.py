@@ -0,0 +1,191 @@
+import contextlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_service'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'metadata_serivce'))
+
+from metadata_db import MetadataDBService  # noqa: E402
+from placement import PlacementRing  # noqa: E402
+from replication import ReplicationManager  # noqa: E402
+
+
+class FakeTransferPool:
+    """data nodes as sets of block ids, copies walk the pipeline like BlockTransferServer"""
+
+    def __init__(self, disks):
+        self.disks = disks  # (host, port): set of block ids
+        self.lock = threading.Lock()
+        self.active = {}
+        self.peak = 0
+        self.deleted = []
+
+    @contextlib.contextmanager
+    def connection(self, host, port):
+        yield FakeTransferConnection(self, (host, port))
+
+
+class FakeTransferConnection:
+    def __init__(self, pool, node):
+        self.pool = pool
+        self.node = node
+
+    def copy_block(self, block_id, source_path, pipeline, rate=None):
+        pool = self.pool
+        nodes = (self.node, *map(tuple, pipeline))
+        with pool.lock:
+            if block_id not in pool.disks.get(self.node, ()):
+                return None
+            for node in nodes:
+                pool.active[node] = pool.active.get(node, 0) + 1
+                pool.peak = max(pool.peak, pool.active[node])
+        time.sleep(0.01)
+        acks = 0
+        with pool.lock:
+            for node in nodes:
+                pool.active[node] -= 1
+            for node in nodes[1:]:
+                if node not in pool.disks:
+                    break
+                pool.disks[node].add(block_id)
+                acks += 1
+        return acks
+
+    def delete_block(self, block_id, source_path):
+        with self.pool.lock:
+            self.pool.deleted.append((self.node, block_id))
+            self.pool.disks[self.node].discard(block_id)
+        return True
+
+
+class ReplicationManagerTest(unittest.TestCase):
+    nodes = [('localhost', 1801 + i) for i in range(4)]
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.metadata = MetadataDBService(os.path.join(self.dir, 'metadata_table.db'))
+        self.disks = {node: set() for node in self.nodes}
+        self.transfer = FakeTransferPool(self.disks)
+        self.usage = {}
+        self.live = list(self.nodes)
+        self.invalidated = []
+        self.threads = []
+
+    def tearDown(self):
+        self.manager.stop()
+        for thread in self.threads:
+            thread.join()
+        shutil.rmtree(self.dir)
+
+    def make_manager(self, replication_factor, **kwargs):
+        self.manager = ReplicationManager(
+            self.metadata, self.transfer, PlacementRing(),
+            lambda: {node: self.usage.get(node) for node in self.live}, replication_factor, 10,
+            transfer_port_offset=0, retry_delay=0.05, on_relocate=self.invalidated.extend, **kwargs)
+        self.manager.nodes_changed(self.live)
+        self.manager.load()
+        return self.manager
+
+    def store(self, path, block_ids, primary, replicas=()):
+        self.metadata.save_file_blocks(path, [(block_id, primary) for block_id in block_ids],
+                                       [(block_id, node) for node in replicas for block_id in block_ids])
+        for node in (primary, *replicas):
+            self.disks[node].update(block_ids)
+
+    def run_workers(self, count):
+        for _ in range(count):
+            thread = threading.Thread(target=self.manager.run, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def wait_idle(self, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            stats = self.manager.stats()
+            if not stats['queued'] and not stats['streams']:
+                return stats
+            time.sleep(0.02)
+        self.fail(f"replication did not finish: {self.manager.stats()}")
+
+    def copies(self, block_id):
+        return {(host, port) for _, host, port, _, _ in self.metadata.find_blocks([block_id])}
+
+    def test_fewest_live_copies_come_first(self):
+        self.store('/data/a', ['a'], self.nodes[0])
+        self.store('/data/b', ['b'], self.nodes[0], [self.nodes[1]])
+        manager = self.make_manager(3)
+        task = manager.next_task()
+        self.assertEqual(task[:2], ('replicate', 'a'))
+        self.assertEqual(len(task[5]), 2)
+        self.assertEqual(manager.next_task()[:2], ('replicate', 'b'))
+
+    def test_copies_of_a_lost_node_are_replaced(self):
+        block_ids = [f"block-{i}" for i in range(30)]
+        for i, block_id in enumerate(block_ids):
+            self.store(f"/data/f{i}", [block_id], self.nodes[i % 2], [self.nodes[2 + i % 2]])
+        manager = self.make_manager(2, streams_per_node=2)
+        self.assertEqual(manager.stats()['queued'], 0)
+        self.run_workers(6)
+        lost = self.nodes[0]
+        self.live.remove(lost)
+        del self.disks[lost]
+        manager.nodes_changed(self.live)
+        stats = self.wait_idle()
+        self.assertEqual(stats['replicated'], 15)
+        self.assertLessEqual(self.transfer.peak, 2)
+        for block_id in block_ids:
+            copies = self.copies(block_id)
+            self.assertEqual(len(copies), 2)
+            self.assertNotIn(lost, copies)
+            self.assertTrue(all(block_id in self.disks[node] for node in copies))
+        # the new copy took the lost primary's row
+        self.assertEqual(self.metadata.get_file_blocks('/data/f0')[0][4], 'primary')
+        self.assertIn('/data/f0', self.invalidated)
+
+    def test_blocks_without_a_live_copy_are_reported_lost(self):
+        self.store('/data/a', ['a'], self.nodes[0])
+        manager = self.make_manager(1)
+        self.live.remove(self.nodes[0])
+        manager.nodes_changed(self.live)
+        self.assertEqual(manager.stats()['lost'], 1)
+        self.assertIsNone(manager.next_task())
+
+    def test_reclaimed_copies_are_forgotten(self):
+        self.store('/data/a', ['a'], self.nodes[0], [self.nodes[1]])
+        manager = self.make_manager(2)
+        self.metadata.delete_file('/data/a')
+        manager.remove_copies(self.nodes[0], ['a'])
+        self.assertEqual(manager.stats()['blocks'], 1)
+        manager.remove_copies(self.nodes[1], ['a', 'unknown'])
+        self.assertEqual(manager.stats()['blocks'], 0)
+        self.assertIsNone(manager.next_task())
+
+    def test_rebalance_moves_blocks_to_a_new_node(self):
+        for i in range(16):
+            self.store(f"/data/f{i}", [f"block-{i}"], self.nodes[i % 2])
+        self.live = self.nodes[:2]
+        manager = self.make_manager(1)
+        self.run_workers(4)
+        self.live = self.nodes[:3]
+        self.usage = {self.nodes[0]: {'capacity': 100, 'used': 80}, self.nodes[1]: {'capacity': 100, 'used': 80},
+                      self.nodes[2]: {'capacity': 100, 'used': 0}}
+        manager.nodes_changed(self.live)
+        self.assertEqual(manager.rebalance(0.6), 0)
+        moves = manager.rebalance()
+        self.assertEqual(moves, 6)
+        stats = self.wait_idle()
+        self.assertEqual(stats['moved'], 6)
+        moved = list(self.disks[self.nodes[2]])
+        self.assertEqual(len(moved), 6)
+        for block_id in moved:
+            self.assertEqual(self.copies(block_id), {self.nodes[2]})
+        self.assertEqual(sorted(block_id for _, block_id in self.transfer.deleted), sorted(moved))
+
+
+if __name__ == '__main__':
+    unittest.main()
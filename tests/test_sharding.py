@@ -0,0 +1,170 @@
+import contextlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_service'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'metadata_serivce'))
+
+from metadata_db import MetadataDBService  # noqa: E402
+from sharding import SLOTS, MetadataRouter, parse_hosts, path_slot  # noqa: E402
+
+
+class FakeMetadataPool:
+    """one MetadataDBService per (host, port), like the metadata services behind a ConnectionPool"""
+
+    def __init__(self, shards):
+        self.shards = shards
+
+    @contextlib.contextmanager
+    def connection(self, host, port):
+        yield mock.MagicMock(closed=False, root=self.shards[(host, port)])
+
+
+class MetadataRouterTest(unittest.TestCase):
+    hosts = [('localhost', 18005 + i) for i in range(4)]
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.shards = {host: MetadataDBService(os.path.join(self.dir, f"shard-{host[1]}.db")) for host in self.hosts}
+        self.pool = FakeMetadataPool(self.shards)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def router(self, count=3):
+        return MetadataRouter(self.hosts[:count], self.pool).load()
+
+    def holder(self, path):
+        return [host for host, shard in self.shards.items() if shard.get_file_blocks(path) is not None]
+
+    def test_parse_hosts(self):
+        self.assertEqual(parse_hosts("a:1, b:2"), [('a', 1), ('b', 2)])
+
+    def test_files_live_on_the_shard_of_their_slot(self):
+        router = self.router()
+        self.assertEqual([slots for _, _, slots in router.shard_map()], [1366, 1365, 1365])
+        paths = [f"/data/f{i}" for i in range(30)]
+        for path in paths:
+            router.save_file_blocks(path, ((path + '-block', ('localhost', 1801)),), ())
+        for path in paths:
+            self.assertEqual(self.holder(path), [self.hosts[path_slot(path) % 3]])
+            self.assertEqual(router.get_file_blocks(path)[0][1], path + '-block')
+        self.assertIsNone(router.get_file_blocks('/data/missing'))
+        entries = dict(router.get_files_blocks(tuple(paths) + ('/data/missing',)))
+        self.assertEqual(sorted(entries), sorted(paths))
+
+    def test_block_ops_span_every_shard(self):
+        router = self.router()
+        paths = [f"/data/f{i}" for i in range(12)]
+        for path in paths:
+            router.save_file_blocks(path, (('shared', ('localhost', 1801)),), (('shared', ('localhost', 1802)),))
+        self.assertEqual(router.block_refcounts(('shared',)), (('shared', 12),))
+        self.assertEqual(router.find_blocks(('shared',)),
+                         (('shared', 'localhost', 1801, 'primary', 'none'), ('shared', 'localhost', 1802, 'replica', 'none')))
+        self.assertEqual(router.relocate_block('shared', ('localhost', 1802), ('localhost', 1803)), tuple(sorted(paths)))
+        copies = []
+        after = 0
+        while True:
+            rows = router.list_block_copies(after, 5)
+            if not rows:
+                break
+            copies.extend(rows)
+            after = rows[-1][0]
+        self.assertEqual(len(copies), 24)
+        self.assertEqual({row[2] for row in copies}, set(paths))
+
+    def test_packed_files_count_references_on_each_shard(self):
+        router = self.router()
+        files = tuple((f"/small/f{i}", 10 * i, 10) for i in range(10))
+        router.save_packed_files('container-1', (('localhost', 1801),), 'none', files)
+        self.assertEqual(router.block_refcounts(('container-1',)), (('container-1', 10),))
+        self.assertEqual(router.get_file_blocks('/small/f3')[0][6:], (30, 10))
+
+    def test_directories_merge_the_entries_of_every_shard(self):
+        router = self.router()
+        paths = [f"/data/f{i:02}" for i in range(20)] + [f"/data/sub/g{i}" for i in range(10)]
+        for path in paths:
+            router.save_file_blocks(path, ((path + '-block', ('localhost', 1801)),), (), size=7)
+        self.assertGreater(len({self.holder(path)[0] for path in paths}), 1)
+        names = []
+        after = ''
+        while True:
+            entries = router.list_directory('/data/', after, 6)
+            names.extend(entry[0] for entry in entries)
+            if len(entries) < 6:
+                break
+            after = entries[-1][0]
+        self.assertEqual(names, [f"f{i:02}" for i in range(20)] + ['sub/'])
+        self.assertEqual(router.stat_file('/data/f03')[0], 7)
+        self.assertTrue(router.has_prefix('/data/sub/'))
+        deleted = router.delete_prefix('/data/sub/', 2)
+        self.assertLessEqual(len(deleted), 6)
+        while router.delete_prefix('/data/sub/', 2):
+            pass
+        self.assertFalse(router.has_prefix('/data/sub/'))
+        self.assertTrue(router.delete_file('/data/f00'))
+        self.assertEqual(router.garbage_count(), 11)
+        garbage = router.pending_garbage(('localhost', 1801), float('inf'), 4)
+        self.assertEqual(len(garbage), 4)
+        router.clear_garbage(('localhost', 1801), [block_id for block_id, _ in garbage])
+        self.assertEqual(router.garbage_count(), 7)
+
+    def test_moved_slots_keep_their_files(self):
+        router = self.router()
+        paths = [f"/data/f{i}" for i in range(40)]
+        for path in paths:
+            router.save_file_blocks(path, ((path + '-block', ('localhost', 1801)),), ())
+        router = MetadataRouter(self.hosts, self.pool).load()
+        self.assertEqual(router.shard_map()[3][2], 0)
+        moves = router.balance_plan()
+        self.assertEqual(len(moves), SLOTS // 4)
+        router.move_slots(moves)
+        self.assertEqual([slots for _, _, slots in router.shard_map()], [SLOTS // 4] * 4)
+        self.assertEqual(router.stats()['slots_moved'], SLOTS // 4)
+        for path in paths:
+            self.assertEqual(self.holder(path), [self.hosts[router.owners[path_slot(path)]]])
+            self.assertEqual(router.get_file_blocks(path)[0][1], path + '-block')
+        self.assertEqual(dict(router.block_refcounts([path + '-block' for path in paths])),
+                         {path + '-block': 1 for path in paths})
+        # a restarted router finds the same map
+        self.assertEqual(MetadataRouter(self.hosts, self.pool).load().owners, router.owners)
+
+    def test_newest_claim_wins_after_an_interrupted_move(self):
+        router = self.router()
+        path = '/data/moved'
+        router.save_file_blocks(path, (('block', ('localhost', 1801)),), ())
+        slot = path_slot(path)
+        source = router.owners[slot]
+        target = (source + 1) % 3
+        # the target imported the slot, the source was not dropped yet
+        self.shards[self.hosts[target]].import_slot(slot, self.shards[self.hosts[source]].export_slot(slot), 2 ** 62)
+        self.assertEqual(len(self.holder(path)), 2)
+        router = self.router()
+        self.assertEqual(router.owners[slot], target)
+        self.assertEqual(self.holder(path), [self.hosts[target]])
+        self.assertEqual(router.block_refcounts(('block',)), (('block', 1),))
+
+    def test_unowned_slots_are_an_error(self):
+        self.router(3)
+        with self.assertRaises(Exception):
+            MetadataRouter(self.hosts[:2], self.pool).load()
+
+    def test_shards_sharing_a_database_are_an_error(self):
+        # two shards started on one db_file both serve every claim of it
+        self.shards[self.hosts[1]] = self.shards[self.hosts[0]]
+        router = self.router()
+        path = next(f'/data/{i}' for i in range(SLOTS) if router.owners[path_slot(f'/data/{i}')] == 1)
+        router.save_file_blocks(path, (('block', ('localhost', 1801)),), ())
+        claims = self.shards[self.hosts[0]].owned_slots()
+        with self.assertRaises(Exception):
+            self.router()
+        self.assertEqual(self.shards[self.hosts[0]].owned_slots(), claims)
+        self.assertIsNotNone(self.shards[self.hosts[0]].get_file_blocks(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,204 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_service'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'metadata_serivce'))
+
+from client import BlockUploadError, FilesystemClient  # noqa: E402
+from compression import BlockCompressor  # noqa: E402
+from connection_pool import ConnectionPool  # noqa: E402
+from metadata_db import MetadataDBService  # noqa: E402
+from name_node import NameNodeService  # noqa: E402
+from namespace_cache import NamespaceCache  # noqa: E402
+from placement import PlacementRing  # noqa: E402
+
+
+class RemoteNameNode:
+    """calls name_node like an rpyc client, without the exposed_ prefix"""
+
+    def __init__(self, name_node):
+        self.name_node = name_node
+
+    def __getattr__(self, name):
+        return getattr(self.name_node, 'exposed_' + name)
+
+
+class StreamingClient(FilesystemClient):
+    """talks to an in-process NameNode, data nodes are a dict of block_id -> bytes"""
+
+    def __init__(self, name_node, block_size=1024, failing_nodes=(), **kwargs):
+        remote = mock.MagicMock(closed=False)
+        remote.root.NameNodeService.return_value = RemoteNameNode(name_node)
+        super().__init__(block_size, max_in_flight=2, max_retries=0,
+                         pool=ConnectionPool(connect=lambda host, port: remote), **kwargs)
+        self.failing_nodes = set(failing_nodes)
+        self.stored = {}
+        self.in_flight = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def send_to_data_node(self, block_id, data_node, block_view, destination, replica_nodes=()):
+        with self.lock:
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        try:
+            if data_node in self.failing_nodes:
+                return 0
+            self.stored[block_id] = bytes(block_view)
+            return 1 + len(replica_nodes)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def read_from_data_node(self, block_id, data_node, replica_blocks, source_path, offset=0, length=None):
+        data = self.stored[block_id]
+        return data[offset:] if length is None else data[offset:offset + length]
+
+
+class StreamWriterTest(unittest.TestCase):
+    nodes = [('localhost', 1801), ('localhost', 1802), ('localhost', 1803)]
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.metadata = MetadataDBService(os.path.join(self.dir, 'metadata_table.db'))
+
+        class NameNode(NameNodeService.exposed_NameNodeService):
+            metadata = self.metadata
+            data_node_connections = list(self.nodes)
+            block_size = 1024
+            namespace_cache = NamespaceCache()
+            placement = PlacementRing()
+            replication_factor = 2
+            append_lock = threading.Lock()
+
+        self.name_node = NameNode()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def chunks(self, data, size=100):
+        for start in range(0, len(data), size):
+            yield data[start:start + size]
+
+    def test_blocks_are_placed_as_they_fill_and_committed_on_close(self):
+        client = StreamingClient(self.name_node)
+        data = os.urandom(5000)
+        with client.open_write('/stream/a') as writer:
+            for chunk in self.chunks(data):
+                writer.write(chunk)
+            # nothing is visible before close
+            self.assertIsNone(self.name_node.exposed_get_file_table_entry('/stream/a'))
+        self.assertEqual(writer.written, 5000)
+        self.assertEqual([result['bytes'] for result in writer.report], [1024] * 4 + [904])
+        self.assertLessEqual(client.peak, 2)
+        primary_blocks, replica_blocks, _, _ = self.name_node.exposed_get_file_table_entry('/stream/a')
+        self.assertEqual(len(primary_blocks), 5)
+        self.assertEqual(len(replica_blocks), 5)
+        self.assertEqual(client.read_file('/stream/a'), data)
+        self.assertEqual(client.read_range('/stream/a', 1000, 100), data[1000:1100])
+
+    def test_empty_and_failed_streams(self):
+        client = StreamingClient(self.name_node)
+        with client.open_write('/stream/empty'):
+            pass
+        self.assertEqual(client.read_file('/stream/empty'), b'')
+        with self.assertRaises(RuntimeError):
+            with client.open_write('/stream/aborted') as writer:
+                writer.write(os.urandom(3000))
+                raise RuntimeError("producer failed")
+        self.assertIsNone(self.name_node.exposed_get_file_table_entry('/stream/aborted'))
+        client.failing_nodes = set(self.nodes)
+        with self.assertRaises(BlockUploadError):
+            with client.open_write('/stream/lost') as writer:
+                writer.write(os.urandom(3000))
+        self.assertIsNone(self.name_node.exposed_get_file_table_entry('/stream/lost'))
+
+    def test_appends_rewrite_a_partial_last_block(self):
+        compressor = BlockCompressor('zlib', workers=1)
+        self.addCleanup(compressor.close)
+        client = StreamingClient(self.name_node, compressor=compressor)
+        data = b'log line 42 INFO request served\n' * 50
+        with client.open_write('/stream/log') as writer:
+            writer.write(data)
+        first_blocks = self.name_node.exposed_get_file_table_entry('/stream/log')[0]
+        for i in range(5):
+            line = b'appended line %d\n' % i * 40
+            with client.append('/stream/log') as writer:
+                writer.write(line)
+            data += line
+            self.assertEqual(client.read_file('/stream/log'), data)
+        primary_blocks, replica_blocks, codecs, _ = self.name_node.exposed_get_file_table_entry('/stream/log')
+        self.assertEqual(len(primary_blocks), (len(data) + 1023) // 1024)
+        self.assertEqual(len(replica_blocks), len(primary_blocks))
+        # full blocks are kept, compressed ones with their codec
+        self.assertEqual(primary_blocks[0], first_blocks[0])
+        self.assertIn((first_blocks[0][0], 'zlib'), codecs)
+        # an append of nothing changes nothing
+        with client.append('/stream/log'):
+            pass
+        self.assertEqual(self.name_node.exposed_get_file_table_entry('/stream/log')[0], primary_blocks)
+        with self.assertRaises(Exception):
+            client.append('/stream/missing')
+
+    def test_a_concurrent_append_fails(self):
+        client = StreamingClient(self.name_node)
+        with client.open_write('/stream/a') as writer:
+            writer.write(b'x' * 1500)
+        first = client.append('/stream/a')
+        first.write(b'first')
+        with client.append('/stream/a') as second:
+            second.write(b'second')
+        with self.assertRaises(Exception):
+            first.close()
+        self.assertEqual(client.read_file('/stream/a'), b'x' * 1500 + b'second')
+
+    def test_puts_become_visible_with_their_codecs_after_the_upload(self):
+        compressor = BlockCompressor('zlib', workers=1)
+        self.addCleanup(compressor.close)
+        client = StreamingClient(self.name_node, compressor=compressor)
+        data = b'log line 42 INFO request served\n' * 100
+        path = os.path.join(self.dir, 'put')
+        with open(path, 'wb') as f:
+            f.write(data)
+        visible = []
+        send = client.send_to_data_node
+
+        def observed_send(*args, **kwargs):
+            visible.append(self.name_node.exposed_get_file_table_entry('/put/a'))
+            return send(*args, **kwargs)
+
+        client.send_to_data_node = observed_send
+        client.create_file(path, '/put/a')
+        self.assertEqual(visible, [None] * 4)
+        _, _, codecs, _ = self.name_node.exposed_get_file_table_entry('/put/a')
+        self.assertEqual([codec for _, codec in codecs], ['zlib'] * 4)
+        self.assertEqual(client.read_file('/put/a'), data)
+        # an overwrite that fails midway never records blocks without their codec
+        with open(path, 'wb') as f:
+            f.write(data[::-1])
+        client.failing_nodes = set(self.nodes)
+        with self.assertRaises(BlockUploadError):
+            client.create_file(path, '/put/a')
+        self.assertEqual(client.read_file('/put/a'), data)
+
+    def test_packed_files_are_appended_to_through_a_new_block(self):
+        client = StreamingClient(self.name_node)
+        container_id, data_nodes = self.name_node.exposed_allocate_container()
+        client.stored[container_id] = b'aaaa' + b'bbbbbb'
+        self.name_node.exposed_commit_container(container_id, data_nodes, 'none',
+                                                (('/small/a', 0, 4), ('/small/b', 4, 6)))
+        with client.append('/small/b') as writer:
+            writer.write(b'cc')
+        self.assertEqual(client.read_file('/small/b'), b'bbbbbbcc')
+        self.assertEqual(client.read_file('/small/a'), b'aaaa')
+        with self.assertRaises(Exception):
+            self.name_node.exposed_commit_blocks('/small/a', (), (), (), True, container_id, False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import os
+import pickle
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'zookeeper'))
+
+from zk import ZnodeTree, ZooKeeper  # noqa: E402
+
+
+def node(port):
+    return pickle.dumps({'host': 'localhost', 'port': port})
+
+
+class ZnodeTreeTest(unittest.TestCase):
+    def test_prefix_listing_and_pruning(self):
+        tree = ZnodeTree()
+        tree.insert('/data_nodes/a:1', 1)
+        tree.insert('/data_nodes/b:2', 2)
+        tree.insert('/data_nodes_old/c:3', 3)
+        self.assertEqual(sorted(tree.items('/data_nodes')), [('/data_nodes/a:1', 1), ('/data_nodes/b:2', 2)])
+        self.assertEqual(tree.get('/data_nodes/b:2'), 2)
+        self.assertEqual(tree.remove('/data_nodes/a:1'), 1)
+        self.assertEqual(tree.remove('/data_nodes/b:2'), 2)
+        self.assertIsNone(tree.remove('/data_nodes/b:2'))
+        self.assertEqual(list(tree.root['children']), ['data_nodes_old'])
+        self.assertEqual(list(tree.items('/missing')), [])
+
+
+class ZooKeeperRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.zk = ZooKeeper()
+        # expiry is driven by the test
+        self.zk.expiry_check_interval = 3600
+        self.zk.session_timeout = 0.2
+
+    def test_data_is_stored_decoded(self):
+        self.zk.exposed_create_node('/data_nodes/localhost:1801', node(1801), ephemeral=True)
+        self.zk.exposed_set_data('/data_nodes/localhost:1801', node(1901))
+        self.assertEqual(self.zk.znodes.get('/data_nodes/localhost:1801')['data'], {'host': 'localhost', 'port': 1901})
+        self.assertEqual(self.zk.exposed_get_all_data_nodes('/data_nodes'), (('localhost', 1901),))
+
+    def test_expiry_pops_only_due_deadlines(self):
+        self.zk.exposed_create_node('/data_nodes/localhost:1801', node(1801), ephemeral=True)
+        self.zk.exposed_create_node('/data_nodes/localhost:1802', node(1802), ephemeral=True)
+        self.zk.exposed_create_node('/config', {'block_size': 1})
+        self.assertEqual(len(self.zk.deadlines), 2)
+        time.sleep(0.1)
+        self.assertTrue(self.zk.exposed_touch('/data_nodes/localhost:1802'))
+        time.sleep(0.15)
+        self.zk.remove_expired_nodes()
+        # 1802 was touched, its entry is pushed again with the new deadline
+        self.assertEqual(self.zk.exposed_get_all_data_nodes('/data_nodes'), (('localhost', 1802),))
+        self.assertEqual([path for _, _, path in self.zk.deadlines], ['/data_nodes/localhost:1802'])
+        self.assertFalse(self.zk.exposed_touch('/data_nodes/localhost:1801'))
+        time.sleep(0.25)
+        self.zk.remove_expired_nodes()
+        self.assertEqual(self.zk.exposed_get_all_data_nodes('/data_nodes'), ())
+        self.assertIsNotNone(self.zk.znodes.get('/config'))
+
+    def test_stale_deadline_of_a_recreated_node_is_skipped(self):
+        self.zk.exposed_create_node('/data_nodes/localhost:1801', node(1801), ephemeral=True)
+        time.sleep(0.25)
+        self.zk.remove_expired_nodes()
+        self.zk.exposed_create_node('/data_nodes/localhost:1801', node(1801), ephemeral=True)
+        # an old entry of the previous session must not expire the new one
+        self.zk.deadlines.insert(0, (0, 1, '/data_nodes/localhost:1801'))
+        self.zk.remove_expired_nodes()
+        self.assertTrue(self.zk.exposed_touch('/data_nodes/localhost:1801'))
+
+
+if __name__ == '__main__':
+    unittest.main()
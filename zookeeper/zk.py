@@ -1,14 +1,108 @@
+import heapq
+import logging
+import os
+import queue
+import sys
 import threading
 import time
 import pickle
 import rpyc
 
+# metrics is shared with the data services
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_service'))
+from metrics import REGISTRY, MetricsService, instrument, setup_logging  # noqa: E402
+
+logger = logging.getLogger('zookeeper')
+
+
+def is_under(path, prefix):
+    prefix = prefix.rstrip('/')
+    return not prefix or path == prefix or path.startswith(prefix + '/')
+
+
+class ZnodeTree:
+    """znodes indexed by path component, so listing a prefix only visits its subtree"""
+
+    def __init__(self):
+        self.root = {'children': {}, 'znode': None}
+
+    def parts(self, path):
+        return [part for part in path.split('/') if part]
+
+    def entry(self, path):
+        entry = self.root
+        for part in self.parts(path):
+            entry = entry['children'].get(part)
+            if entry is None:
+                return None
+        return entry
+
+    def get(self, path):
+        entry = self.entry(path)
+        return entry['znode'] if entry is not None else None
+
+    def insert(self, path, znode):
+        entry = self.root
+        for part in self.parts(path):
+            entry = entry['children'].setdefault(part, {'children': {}, 'znode': None})
+        entry['znode'] = znode
+
+    def remove(self, path):
+        parts = self.parts(path)
+        entries = [self.root]
+        for part in parts:
+            entry = entries[-1]['children'].get(part)
+            if entry is None:
+                return None
+            entries.append(entry)
+        znode, entries[-1]['znode'] = entries[-1]['znode'], None
+        # prune the branches left empty
+        for parent, part, entry in reversed(list(zip(entries, parts, entries[1:]))):
+            if entry['children'] or entry['znode'] is not None:
+                break
+            del parent['children'][part]
+        return znode
+
+    def items(self, prefix):
+        """(path, znode) of prefix itself and every znode below it"""
+        entry = self.entry(prefix)
+        if entry is None:
+            return
+        stack = [('/' + '/'.join(self.parts(prefix)), entry)]
+        while stack:
+            path, entry = stack.pop()
+            if entry['znode'] is not None:
+                yield path, entry['znode']
+            for part, child in entry['children'].items():
+                stack.append((f"{path.rstrip('/')}/{part}", child))
+
+
+@instrument('zookeeper')
+class ZooKeeper(MetricsService, rpyc.Service):
+    """znodes are {'data': dict, 'version': int, 'ephemeral': bool, 'touched': float,
+                   'session': int, 'expired': bool}
+       1) create, set_data and expiry bump the version and push an event to every watch
+          registered on a prefix of the path
+       2) touch only refreshes the session of an ephemeral node, heartbeats do not fire events
+          and only take the session lock stripe of their path, never the global lock
+       3) session deadlines sit in a min-heap, an expiry check only pops the due entries, a
+          node touched since its entry was pushed is pushed again with its new deadline
+       4) events are delivered in order by one dispatcher thread, outside of the lock
+    """
 
-class ZooKeeper(rpyc.Service):
     def __init__(self):
         self.lock = threading.Lock()
-        self.watched_nodes = {}
-        self.expiry_check_interval = 6  # Interval in seconds for checking node expiry
+        self.znodes = ZnodeTree()
+        self.session_timeout = 5  # ephemeral nodes not touched for this long expire
+        self.expiry_check_interval = 1  # Interval in seconds for checking node expiry
+        self.deadlines = []  # heap of (deadline, session, path)
+        self.session_locks = [threading.Lock() for _ in range(64)]
+        self.next_session = 0
+        self.version = 0
+        self.watches = {}  # watch_id: (prefix, callback)
+        self.next_watch_id = 0
+        self.events = queue.Queue()
+        threading.Thread(target=self.dispatch_events, daemon=True).start()
         self.start_expiry_checker()
 
     def start_expiry_checker(self):
@@ -21,78 +115,152 @@ class ZooKeeper(rpyc.Service):
                 self.remove_expired_nodes()
                 time.sleep(self.expiry_check_interval)
         except Exception as e:
-            print(f"Error occurred at check_node_expiry_loop: {e}")
+            logger.error("Error occurred at check_node_expiry_loop: %s", e)
             self.check_node_expiry_loop()
 
+    def session_lock(self, path):
+        return self.session_locks[hash(path) % len(self.session_locks)]
+
     def remove_expired_nodes(self):
         try:
             current_time = time.time()
             expired_nodes = []
             with self.lock:
-                # Use list() to avoid concurrent modification
-                for path, data in list(self.watched_nodes.items()):
-                    data_loads = pickle.loads(data)
-                    if 'timestamp' in data_loads:
-                        node_timestamp = data_loads['timestamp']
-                        if current_time - node_timestamp > 5:
-                            # Node has expired, remove it from the watched list
-                            expired_nodes.append(path)
-                            del self.watched_nodes[path]
-            print("Expired nodes:", expired_nodes)
+                while self.deadlines and self.deadlines[0][0] <= current_time:
+                    _, session, path = heapq.heappop(self.deadlines)
+                    znode = self.znodes.get(path)
+                    if znode is None or znode['session'] != session:
+                        # removed, or created again with a new session since
+                        continue
+                    with self.session_lock(path):
+                        deadline = znode['touched'] + self.session_timeout
+                        if deadline > current_time:
+                            heapq.heappush(self.deadlines, (deadline, session, path))
+                            continue
+                        znode['expired'] = True
+                    # Node has expired, remove it from the watched list
+                    self.znodes.remove(path)
+                    expired_nodes.append(path)
+                    self.publish('expired', path, znode)
+            if expired_nodes:
+                REGISTRY.inc('sessions_expired_total', len(expired_nodes))
+                logger.info("Expired nodes: %s", expired_nodes)
         except Exception as e:
-            print(f"Error occurred at remove_expired_nodes: {e}")
-            self.check_node_expiry_loop()
+            logger.error("Error occurred at remove_expired_nodes: %s", e)
+
+    def decode(self, data):
+        data = data or {}
+        # If data is provided as bytes, decode it into a dictionary
+        if isinstance(data, bytes):
+            try:
+                data = pickle.loads(data)
+            except pickle.UnpicklingError:
+                # Handle unpickling errors, e.g., invalid data format
+                raise ValueError(
+                    "Invalid data format. Expected pickled dictionary.")
+        return dict(data)
+
+    def publish(self, event, path, znode):
+        """queues event for the watches on a prefix of path, callers hold self.lock"""
+        self.version += 1
+        znode['version'] = self.version
+        callbacks = [(watch_id, callback) for watch_id, (prefix, callback) in self.watches.items()
+                     if is_under(path, prefix)]
+        REGISTRY.inc('events_published_total', event=event)
+        if callbacks:
+            self.events.put((callbacks, (event, path, pickle.dumps(znode['data']), znode['version'])))
+
+    def dispatch_events(self):
+        while True:
+            callbacks, event = self.events.get()
+            for watch_id, callback in callbacks:
+                try:
+                    # the watcher serves its connection in its own thread, do not wait for it
+                    rpyc.async_(callback)(*event)
+                except Exception as e:
+                    logger.warning("Dropping watch %s: %s", watch_id, e)
+                    with self.lock:
+                        self.watches.pop(watch_id, None)
 
     def exposed_create_node(self, path, data=None, ephemeral=False):
+        data = self.decode(data)
         with self.lock:
-            data = data or {}
-            # If data is provided as bytes, decode it into a dictionary
-            if isinstance(data, bytes):
-                try:
-                    data = pickle.loads(data)
-                except pickle.UnpicklingError:
-                    # Handle unpickling errors, e.g., invalid data format
-                    raise ValueError(
-                        "Invalid data format. Expected pickled dictionary.")
-            """If ephemeral is False in the create_node method of the ZooKeeperClient, 
+            """If ephemeral is False in the create_node method of the ZooKeeperClient,
                            it means that the node being created is not ephemeral. In this case, we won't attach any session ID or
                             ephemeral information to the node's data."""
-            if path not in self.watched_nodes:
+            if self.znodes.get(path) is None:
+                self.next_session += 1
+                znode = {'data': data, 'version': 0, 'ephemeral': ephemeral, 'touched': time.time(),
+                         'session': self.next_session, 'expired': False}
+                self.znodes.insert(path, znode)
                 if ephemeral:
-                    pass
-                    # session_id = threading.current_thread().ident  # Simulating session ID
-                    # data["session_id"] = session_id
-                    print(f"data: {data}")
-                self.watched_nodes[path] = data
+                    heapq.heappush(self.deadlines,
+                                   (znode['touched'] + self.session_timeout, znode['session'], path))
+                self.publish('created', path, znode)
+                return znode['version']
 
     def exposed_set_data(self, path, data):
+        data = self.decode(data)
         with self.lock:
-            print("Data node server signal: ", data)
-            if path in self.watched_nodes:
-                self.watched_nodes[path] = data
+            znode = self.znodes.get(path)
+            if znode is not None:
+                znode['data'] = data
+                znode['touched'] = time.time()
+                self.publish('changed', path, znode)
+                return znode['version']
             else:
                 raise ValueError(f"Node does not exist: {path}")
 
+    def exposed_touch(self, path):
+        """heartbeat of an ephemeral node, returns False if it expired and must be created again"""
+        znode = self.znodes.get(path)
+        if znode is None:
+            return False
+        with self.session_lock(path):
+            if znode['expired']:
+                return False
+            znode['touched'] = time.time()
+            return True
+
     def exposed_get_data(self, path):
         with self.lock:
-            if path in self.watched_nodes:
-                return self.watched_nodes[path]
+            znode = self.znodes.get(path)
+            if znode is not None:
+                return pickle.dumps(znode['data'])
             else:
                 return None
 
     def exposed_get_all_data_nodes(self, node_path):
         data_nodes = []
         with self.lock:
-            for path, data in self.watched_nodes.items():
-                if path.startswith(node_path):
-                    data_loads = pickle.loads(data)
-                    print(f"Data node details: {data_loads}", )
-                    data_nodes.append((data_loads['host'], data_loads['port']))
-            return data_nodes
+            for path, znode in self.znodes.items(node_path):
+                data_nodes.append((znode['data']['host'], znode['data']['port']))
+            return tuple(data_nodes)
+
+    def exposed_watch(self, prefix, callback):
+        """registers callback(event, path, pickled_data, version) for every znode under prefix
+           returns (watch_id, snapshot) where snapshot holds (path, pickled_data, version) of
+           the current children, taken atomically with the registration so no event is missed
+        """
+        with self.lock:
+            self.next_watch_id += 1
+            self.watches[self.next_watch_id] = (prefix, callback)
+            snapshot = tuple((path, pickle.dumps(znode['data']), znode['version'])
+                             for path, znode in self.znodes.items(prefix))
+            return self.next_watch_id, snapshot
+
+    def exposed_unwatch(self, watch_id):
+        with self.lock:
+            self.watches.pop(watch_id, None)
 
 
 if __name__ == "__main__":
     from rpyc.utils.server import ThreadedServer
-    print("ZooKeeper server started")
-    zk_server = ThreadedServer(ZooKeeper(), port=18861)
+    setup_logging()
+    zk = ZooKeeper()
+    REGISTRY.register_gauges('zookeeper', lambda: {'watches': len(zk.watches), 'deadlines': len(zk.deadlines),
+                                                   'pending_events': zk.events.qsize()})
+    zk_server = ThreadedServer(zk, port=int(sys.argv[1]) if len(sys.argv) > 1 else 18861,
+                               logger=logging.getLogger('rpyc.zookeeper'))
+    logger.info("ZooKeeper server started on port %s", zk_server.port)
     zk_server.start()